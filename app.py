@@ -3,27 +3,64 @@ Bildwerkzeug - A web-based image editing tool with user management
 Images are stored temporarily on the server (per user).
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, flash, session
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, flash, session, g, Response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, AnonymousUserMixin
-from PIL import Image, ImageFilter, ImageEnhance
+from PIL import Image
+from werkzeug.wsgi import get_input_stream
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import datetime
 import io
 import base64
 import os
 import uuid
 import zipfile
+import hashlib
 import shutil
 import json
+import re
+import tempfile
 import threading
 import time
 
 from config import get_config
-from models import db, User, init_db
+from models import db, User, Preset, init_db, user_cache
+from expiry import ExpiryIndex, CleanupLock
+from events import EventLog
+from imaging import (
+    base64_to_image, image_to_base64, apply_operation_to_image, encode_image, encode_image_timed,
+    decode_base64, max_size_encoding, probe_image, open_image, open_preview, open_reduced, pillow_image, metadata_of, available_export_formats,
+    EXPORT_FORMATS, EXPORT_PROFILES, JPEG_SUBSAMPLING, SLOW_EXPORT_FORMATS
+)
+from exports import ExportPool, ExportBusy, EXPORT_FOLDER, load_job, clear_cached_exports, prune_exports
+import tiles
+import resumable
+import history
+from frames import Animation, set_frame_workers
+from pipeline import compile_operations, compile_cached, run_pipeline, resolve_auto_steps, resolve_params, PipelineError
+import sharding
+import similarity
+from stats import AUTO_OPERATIONS, STATS_SIZE, STATS_VERSION, compute_stats, make_proxy, resolve_auto_operation
+from concurrent.futures import ThreadPoolExecutor
 
 # Temporary upload folder
 UPLOAD_FOLDER = 'uploads'
-TEMP_IMAGE_LIFETIME_HOURS = 24  # Delete images after 24 hours
+
+# Files stored per image: current version, uploaded bytes (and the PNG originals
+# of older versions), thumbnail, statistics
+IMAGE_FILE_SUFFIXES = ['.png', '_original', '_original.png', '_thumb.png', '_stats.json']
+
+# Deleted images remembered per user, so clients can be told about them
+MAX_TOMBSTONES = 1000
+
+# Largest page of the image list
+MAX_PAGE_SIZE = 500
+
+# The image list is cached by the browser but checked with its version each time
+LISTING_CACHE_CONTROL = 'private, no-cache'
+
+# Event streams: not cached or buffered by proxies, a comment line after this many idle seconds
+EVENT_STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+EVENTS_HEARTBEAT_SECONDS = 15
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -48,6 +85,8 @@ class AnonymousUser(AnonymousUserMixin):
 
 def get_user_id():
     """Returns the user ID (for anonymous sessions the session_id)"""
+    if 'session_user_id' in g:
+        return g.session_user_id
     if current_user.is_authenticated:
         return current_user.id
     elif hasattr(current_user, 'session_id'):
@@ -67,6 +106,37 @@ def optional_login_required(f):
     return decorated_function
 
 
+def session_protection_passed(sess):
+    """True if Flask-Login's session protection would take the session as it is for the
+    current request: protection is off, or the session was made for this client
+    (address and user agent). Otherwise only Flask-Login knows what to do."""
+    login_manager = app.login_manager
+    mode = app.config.get('SESSION_PROTECTION', login_manager.session_protection)
+    if mode not in ('basic', 'strong'):
+        return True
+    return sess.get('_id') == login_manager._session_identifier_generator()
+
+
+def image_login_required(f):
+    """Like optional_login_required, for static-like image endpoints (thumbnails, tiles).
+    
+    A logged-in user found in the user cache is taken from the session
+    without loading the user at all, if the session passes Flask-Login's
+    session protection; everything else goes through Flask-Login.
+    """
+    login_checked = optional_login_required(f)
+    
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user_id = session.get('_user_id')
+        if user_id and str(user_id).isdigit() and session_protection_passed(session) and \
+                user_cache.get(int(user_id)) is not None:
+            g.session_user_id = int(user_id)
+            return f(*args, **kwargs)
+        return login_checked(*args, **kwargs)
+    return decorated_function
+
+
 def create_app():
     """Flask App Factory"""
     app = Flask(__name__)
@@ -88,7 +158,9 @@ def create_app():
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return user_cache.load(int(user_id))
+    
+    user_cache.init_app(app, os.path.join(UPLOAD_FOLDER, '.users_changed'))
     
     # Create database and admin
     init_db(app)
@@ -111,24 +183,42 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # ==================== TEMPORARY IMAGE STORAGE ====================
 
-def get_user_upload_folder(user_id=None):
+expiry_index = ExpiryIndex(
+    os.path.join(UPLOAD_FOLDER, '.expiry.db'),
+    default_ttl_hours=app.config['TEMP_IMAGE_LIFETIME_HOURS']
+)
+cleanup_lock = CleanupLock(os.path.join(UPLOAD_FOLDER, '.cleanup.lock'))
+event_log = EventLog(
+    os.path.join(UPLOAD_FOLDER, '.events.db'),
+    retention_seconds=app.config['EVENTS_RETENTION_SECONDS']
+)
+
+# Workspaces spread over several nodes (None: everything is stored here)
+shard_nodes = sharding.parse_nodes(app.config['SHARD_NODES'])
+shard_ring = sharding.HashRing(shard_nodes) if shard_nodes else None
+if shard_ring and app.config['SHARD_SELF'] not in shard_nodes:
+    raise sharding.ShardError(f"SHARD_SELF {app.config['SHARD_SELF']!r} is not one of SHARD_NODES")
+
+
+def get_user_upload_folder(user_id=None, create=True):
     """Returns the upload folder for a user"""
     if user_id is None:
         user_id = get_user_id()
     folder = os.path.join(UPLOAD_FOLDER, f'user_{user_id}')
-    os.makedirs(folder, exist_ok=True)
+    if create:
+        os.makedirs(folder, exist_ok=True)
     return folder
 
 
-def get_user_metadata_file(user_id):
+def get_user_metadata_file(user_id, create=True):
     """Returns the path to the metadata file"""
-    folder = get_user_upload_folder(user_id)
+    folder = get_user_upload_folder(user_id, create=create)
     return os.path.join(folder, 'metadata.json')
 
 
 def load_user_metadata(user_id):
     """Loads metadata for a user"""
-    meta_file = get_user_metadata_file(user_id)
+    meta_file = get_user_metadata_file(user_id, create=False)
     if os.path.exists(meta_file):
         try:
             with open(meta_file, 'r') as f:
@@ -139,121 +229,928 @@ def load_user_metadata(user_id):
 
 
 def save_user_metadata(user_id, metadata):
-    """Saves metadata for a user"""
+    """Saves metadata for a user.
+    
+    A save that changes something advances the listing version (see
+    stamp_listing_version), so clients can fetch only what changed.
+    """
     meta_file = get_user_metadata_file(user_id)
+    stamp_listing_version(load_user_metadata(user_id), metadata)
     with open(meta_file, 'w') as f:
         json.dump(metadata, f)
 
 
-def save_image_to_disk(user_id, image_id, img, is_original=False):
-    """Saves a PIL image to disk"""
+def _entry_without_stamp(image_info):
+    return {key: value for key, value in image_info.items() if key != 'changed'} if image_info else None
+
+
+def stamp_listing_version(previous, metadata):
+    """Compares metadata with the saved previous state and advances its version if anything changed.
+    
+    Added and changed entries get the new version as 'changed'; removed ones
+    are kept as tombstones in 'deleted' (the last MAX_TOMBSTONES of them).
+    'tombstones_from' is the oldest version changes can be listed from.
+    """
+    previous_version = previous.get('version')
+    if previous_version is None:
+        # New folder (also after clearing) or metadata from before versions. Counted
+        # from the clock, so the version stays above any a client saw before.
+        version = int(time.time() * 1000)
+        for image_info in metadata['images']:
+            image_info['changed'] = version
+        metadata.update(version=version, deleted=[], tombstones_from=version)
+        return
+    
+    old_entries = {i['id']: i for i in previous['images']}
+    new_ids = {i['id'] for i in metadata['images']}
+    changed = [i for i in metadata['images']
+               if _entry_without_stamp(old_entries.get(i['id'])) != _entry_without_stamp(i)]
+    removed = [image_id for image_id in old_entries if image_id not in new_ids]
+    
+    deleted = previous.get('deleted', [])
+    tombstones_from = previous.get('tombstones_from', previous_version)
+    if not changed and not removed and metadata.get('current_id') == previous.get('current_id'):
+        metadata.update(version=previous_version, deleted=deleted, tombstones_from=tombstones_from)
+        return
+    
+    version = previous_version + 1
+    for image_info in changed:
+        image_info['changed'] = version
+    deleted = deleted + [{'id': image_id, 'version': version} for image_id in removed]
+    if len(deleted) > MAX_TOMBSTONES:
+        # Clients that saw a version before the newest forgotten deletion have to reload
+        tombstones_from = deleted[-MAX_TOMBSTONES - 1]['version']
+        deleted = deleted[-MAX_TOMBSTONES:]
+    metadata.update(version=version, deleted=deleted, tombstones_from=tombstones_from)
+
+
+def stage_files(files):
+    """Writes files of an image next to their place. Returns the staged (tmp_path, filepath, size change).
+    
+    files are (filepath, write) pairs; write(path) creates the file.
+    """
+    staged = []
+    try:
+        for filepath, write in files:
+            tmp_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+            old_size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+            staged.append((tmp_path, filepath, 0))
+            write(tmp_path)
+            staged[-1] = (tmp_path, filepath, os.path.getsize(tmp_path) - old_size)
+    except BaseException:
+        discard_staged(staged)
+        raise
+    return staged
+
+
+def discard_staged(staged):
+    for tmp_path, _, _ in staged:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def commit_staged(user_id, image_id, staged):
+    """Moves staged files into place and records the size change in the expiry index"""
+    for tmp_path, filepath, change in staged:
+        os.replace(tmp_path, filepath)
+        expiry_index.add_bytes(user_id, image_id, change)
+
+
+def write_tracked_files(user_id, image_id, files, quota_mb, evict=True):
+    """Writes files of an image as one change within the storage quota and records
+    the size change in the expiry index. Returns the ids of evicted images.
+    Raises QuotaExceeded.
+    
+    The files are staged first (see stage_files), so the quota is checked with
+    the size of the encoded output and nothing changes if it would be exceeded.
+    """
+    staged = stage_files(files)
+    try:
+        evicted = ensure_storage_quota(user_id, sum(change for _, _, change in staged), quota_mb,
+                                       keep=image_id, evict=evict)
+    except BaseException:
+        discard_staged(staged)
+        raise
+    commit_staged(user_id, image_id, staged)
+    return evicted
+
+
+def write_tracked_file(user_id, image_id, filepath, write, quota_mb, evict=True):
+    """Writes a file via write(path) within the storage quota (see write_tracked_files)"""
+    write_tracked_files(user_id, image_id, [(filepath, write)], quota_mb, evict)
+    return filepath
+
+
+def png_writer(img):
+    """write(path) of the stored current version (PNG, keeps ICC profile and EXIF)"""
+    return lambda path: img.save(path, 'PNG', **metadata_of(img))
+
+
+def thumbnail_writer(img):
+    """write(path) of the thumbnail of an image"""
+    thumb = pillow_image(img).copy()
+    thumb.thumbnail((150, 150), Image.Resampling.LANCZOS)
+    return lambda path: thumb.save(path, 'PNG')
+
+
+def stats_writer(image_stats):
+    """write(path) of the statistics sidecar"""
+    def write(path):
+        with open(path, 'w') as f:
+            json.dump(image_stats, f)
+    return write
+
+
+def save_image_to_disk(user_id, image_id, img, quota_mb):
+    """Saves the current version of an image to disk (PNG, keeps ICC profile and EXIF).
+    
+    Animations are stored as animated PNG; afterwards they read the saved
+    frames, so their operations do not run again for the response.
+    """
     folder = get_user_upload_folder(user_id)
-    suffix = '_original' if is_original else ''
-    filepath = os.path.join(folder, f'{image_id}{suffix}.png')
-    img.save(filepath, 'PNG')
+    filepath = os.path.join(folder, f'{image_id}.png')
+    write_tracked_file(user_id, image_id, filepath, png_writer(img), quota_mb)
+    if isinstance(img, Animation):
+        img.rebase(filepath)
     return filepath
 
 
-def save_thumbnail_to_disk(user_id, image_id, img):
+def save_original_to_disk(user_id, image_id, source, quota_mb):
+    """Saves the uploaded bytes unchanged as the original (source: bytes, or a file that is moved)"""
+    folder = get_user_upload_folder(user_id)
+    filepath = os.path.join(folder, f'{image_id}_original')
+    
+    def write(path):
+        if isinstance(source, (bytes, bytearray)):
+            with open(path, 'wb') as f:
+                f.write(source)
+        else:
+            os.replace(source, path)
+    return write_tracked_file(user_id, image_id, filepath, write, quota_mb)
+
+
+def save_thumbnail_to_disk(user_id, image_id, img, quota_mb):
     """Saves a thumbnail to disk"""
     folder = get_user_upload_folder(user_id)
     filepath = os.path.join(folder, f'{image_id}_thumb.png')
-    thumb = img.copy()
-    thumb.thumbnail((150, 150), Image.Resampling.LANCZOS)
-    thumb.save(filepath, 'PNG')
-    return filepath
+    return write_tracked_file(user_id, image_id, filepath, thumbnail_writer(img), quota_mb)
+
+
+def save_stats_to_disk(user_id, image_id, img, quota_mb, size=None):
+    """Computes the statistics of the current version (img may be a proxy of it, size: the full size)"""
+    folder = get_user_upload_folder(user_id)
+    filepath = os.path.join(folder, f'{image_id}_stats.json')
+    try:
+        image_stats = compute_stats(img, size)
+    except Exception as e:
+        print(f"⚠️ Statistics of image {image_id} not computed: {e}")
+        return None
+    
+    try:
+        # Only a cache: not worth evicting images for, computed again next time
+        write_tracked_file(user_id, image_id, filepath, stats_writer(image_stats), quota_mb, evict=False)
+    except QuotaExceeded as e:
+        print(f"⚠️ Statistics of image {image_id} not stored: {e}")
+    return image_stats
+
 
+def load_image_stats(user_id, image_id, quota_mb):
+    """Returns the statistics of the current version of an image (computed from a proxy if missing), or None"""
+    filepath = os.path.join(get_user_upload_folder(user_id, create=False), f'{image_id}_stats.json')
+    try:
+        with open(filepath, 'r') as f:
+            image_stats = json.load(f)
+        if image_stats.get('version') == STATS_VERSION:
+            return image_stats
+    except (OSError, ValueError):
+        pass
+    
+    # Stored before statistics were kept
+    image_path = get_image_path(user_id, image_id)
+    if not image_path:
+        return None
+    source = probe_image(image_path)
+    proxy = pillow_image(open_reduced(image_path, STATS_SIZE))
+    return save_stats_to_disk(user_id, image_id, proxy, quota_mb, (source['width'], source['height']))
+
+
+def resolve_auto_for_image(user_id, image_id, operation, params, quota_mb, img=None):
+    """Resolves an automatic operation from the cached statistics of a stored image
+    (without them from the statistics of img, if given). Returns (operation, params)."""
+    if operation not in AUTO_OPERATIONS:
+        return operation, params
+    image_stats = load_image_stats(user_id, image_id, quota_mb)
+    if image_stats is None:
+        if img is None:
+            return operation, params
+        image_stats = compute_stats(pillow_image(img))
+    return resolve_auto_operation(operation, params, image_stats)
+
+
+def get_tiles_root(user_id, image_id):
+    """Folder with the tile pyramids of an image"""
+    return os.path.join(get_user_upload_folder(user_id, create=False), f'{image_id}_tiles')
+
+
+def mark_image_changed(user_id, image_id, image_info):
+    """Advances the version of an edited image and drops tiles and exports of the old one"""
+    expiry_index.add_bytes(user_id, image_id, -tiles.remove_tiles(get_tiles_root(user_id, image_id)))
+    clear_cached_exports(get_user_export_folder(user_id), image_id)
+    if image_info is not None:
+        image_info['version'] = image_info.get('version', 0) + 1
+
+
+def get_history_dir(user_id, image_id):
+    """Folder with the undo/redo history of an image"""
+    return os.path.join(get_user_upload_folder(user_id, create=False), f'{image_id}_history')
+
+
+def prepare_history_step(user_id, image_id, img, step):
+    """Prepares an edit (img is its result) for the undo/redo history of an image
+    (see history.prepare). Returns the step, or None if there is no history."""
+    max_steps = app.config.get('HISTORY_MAX_STEPS', 50)
+    if not max_steps:
+        return None
+    try:
+        return history.prepare(get_history_dir(user_id, image_id), img, step, max_steps,
+                               max(1, app.config.get('HISTORY_KEYFRAME_INTERVAL', 5)))
+    except Exception as e:
+        print(f"⚠️ History of image {image_id} not updated: {e}")
+        return None
 
-def load_image_from_disk(user_id, image_id, is_original=False):
-    """Loads an image from disk"""
+
+def record_history(user_id, image_id, step):
+    """Adds a prepared step to the undo/redo history of an image"""
+    try:
+        written = history.record(get_history_dir(user_id, image_id), step, app.config.get('HISTORY_MAX_STEPS', 50),
+                                 app.config.get('HISTORY_MAX_MB', 50) * 1024 * 1024)
+        expiry_index.add_bytes(user_id, image_id, written)
+    except Exception as e:
+        print(f"⚠️ History of image {image_id} not updated: {e}")
+
+
+def store_processed_image(user_id, image_id, img, metadata, quota_mb, step=None):
+    """Saves an edited image with thumbnail and updates its entry in metadata (not saved).
+    
+    step describes the edit for undo/redo (see history.py); None saves without recording.
+    Raises QuotaExceeded (before anything changes) if the files written, history
+    keyframe included, do not fit into quota_mb. Images evicted to make room
+    are dropped from metadata as well.
+    """
+    image_info = next((i for i in metadata['images'] if i['id'] == image_id), None)
+    recording = step is not None and app.config.get('HISTORY_MAX_STEPS', 50)
+    evicted = []
+    
+    # Edited before there was a history: that version is as far back as undo goes
+    history_dir = get_history_dir(user_id, image_id)
+    if recording and image_info and image_info.get('version', 0) > 0 and not os.path.isdir(history_dir):
+        current_path = get_image_path(user_id, image_id)
+        if current_path and current_path.endswith('.png'):
+            evicted += ensure_storage_quota(user_id, os.path.getsize(current_path), quota_mb, keep=image_id)
+            expiry_index.add_bytes(user_id, image_id, history.set_base(history_dir, current_path))
+    
+    # Thumbnail and statistics come from one scaled down copy
+    proxy = make_proxy(pillow_image(img))
+    try:
+        image_stats = compute_stats(proxy, img.size)
+    except Exception as e:
+        print(f"⚠️ Statistics of image {image_id} not computed: {e}")
+        image_stats = None
+    
     folder = get_user_upload_folder(user_id)
-    suffix = '_original' if is_original else ''
-    filepath = os.path.join(folder, f'{image_id}{suffix}.png')
+    files = [(os.path.join(folder, f'{image_id}.png'), png_writer(img)),
+             (os.path.join(folder, f'{image_id}_thumb.png'), thumbnail_writer(proxy))]
+    if image_stats is not None:
+        files.append((os.path.join(folder, f'{image_id}_stats.json'), stats_writer(image_stats)))
+    
+    # The history keyframe is checked together with the files
+    staged = stage_files(files)
+    prepared = prepare_history_step(user_id, image_id, img, step) if recording else None
+    try:
+        growth = sum(change for _, _, change in staged) + (prepared['bytes'] if prepared else 0)
+        evicted += ensure_storage_quota(user_id, growth, quota_mb, keep=image_id)
+    except BaseException:
+        discard_staged(staged)
+        if prepared:
+            history.discard(history_dir, prepared)
+        raise
+    commit_staged(user_id, image_id, staged)
+    if prepared:
+        record_history(user_id, image_id, prepared)
+    for evicted_id in evicted:
+        drop_image_entry(metadata, evicted_id)
+    
+    if isinstance(img, Animation):
+        img.rebase(files[0][0])
+    mark_image_changed(user_id, image_id, image_info)
+    if image_info:
+        image_info['width'] = img.width
+        image_info['height'] = img.height
+        image_info['dhash'] = similarity.dhash(proxy)
+        publish_event(user_id, 'image', {
+            'id': image_id,
+            'width': img.width,
+            'height': img.height,
+            'version': image_info['version']
+        })
+    return image_info
+
+
+def get_original_path(user_id, image_id):
+    """Returns the path of the original of an image, or None"""
+    folder = get_user_upload_folder(user_id, create=False)
+    for suffix in ['_original', '_original.png']:
+        filepath = os.path.join(folder, f'{image_id}{suffix}')
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+
+def get_image_path(user_id, image_id):
+    """Returns the path of the current version of an image (the original if not edited), or None"""
+    folder = get_user_upload_folder(user_id, create=False)
+    filepath = os.path.join(folder, f'{image_id}.png')
     if os.path.exists(filepath):
-        return Image.open(filepath)
+        return filepath
+    return get_original_path(user_id, image_id)
+
+
+def load_image_from_disk(user_id, image_id, is_original=False, max_dimension=None):
+    """Loads an image from disk (the original if it was not edited yet), optionally scaled down"""
+    if is_original:
+        filepath = get_original_path(user_id, image_id)
+    else:
+        filepath = get_image_path(user_id, image_id)
+    if filepath:
+        expiry_index.touch(user_id, image_id)
+        if max_dimension:
+            return open_reduced(filepath, max_dimension)
+        return open_image(filepath)
     return None
 
 
 def delete_image_from_disk(user_id, image_id):
     """Deletes all files of an image"""
-    folder = get_user_upload_folder(user_id)
-    for suffix in ['', '_original', '_thumb']:
-        filepath = os.path.join(folder, f'{image_id}{suffix}.png')
+    folder = get_user_upload_folder(user_id, create=False)
+    for suffix in IMAGE_FILE_SUFFIXES:
+        filepath = os.path.join(folder, f'{image_id}{suffix}')
         if os.path.exists(filepath):
             os.remove(filepath)
+    tiles.remove_tiles(get_tiles_root(user_id, image_id))
+    history.remove(get_history_dir(user_id, image_id))
+    clear_cached_exports(get_user_export_folder(user_id), image_id)
+    expiry_index.forget(user_id, image_id)
 
 
-def cleanup_old_uploads():
-    """Deletes old upload folders (older than TEMP_IMAGE_LIFETIME_HOURS)"""
+def remove_image(user_id, image_id):
+    """Deletes an image and removes it from the user's metadata. Returns the metadata."""
+    delete_image_from_disk(user_id, image_id)
+    
+    metadata = drop_image_entry(load_user_metadata(user_id), image_id)
+    
+    folder = get_user_upload_folder(user_id, create=False)
+    if os.path.exists(folder):
+        save_user_metadata(user_id, metadata)
+    return metadata
+
+
+def drop_image_entry(metadata, image_id):
+    """Removes an image from metadata (not saved). Returns the metadata."""
+    metadata['images'] = [img for img in metadata['images'] if img['id'] != image_id]
+    
+    # If deleted image was current, select new one
+    if metadata.get('current_id') == image_id:
+        metadata['current_id'] = metadata['images'][0]['id'] if metadata['images'] else None
+    return metadata
+
+
+def remove_user_folder(user_id):
+    """Deletes the whole upload folder of a user"""
+    folder = get_user_upload_folder(user_id, create=False)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    expiry_index.forget_user(user_id)
+
+
+def ingest_image(user_id, data, filename, quota_mb, ttl_hours=None, max_dimension=0):
+    """Stores an uploaded image and adds it to the user's metadata. Returns the image info.
+    
+    data is the uploaded bytes or the path of a finished upload, which is
+    moved into place. Only the header is parsed for size, orientation and
+    color profile. The bytes are stored unchanged as the original and the
+    current version is written on the first edit, so the only decode is a
+    reduced one for the thumbnail. The EXIF orientation is applied whenever
+    the image is opened.
+    
+    With max_dimension, larger images are decoded straight to that size and
+    stored as the current version; the original is only read again on reset.
+    
+    Statistics for the automatic operations and the perceptual hash are
+    computed from the same reduced decode as the thumbnail.
+    """
+    source = probe_image(data)
+    image_id = str(uuid.uuid4())[:8]
+    expiry_index.touch(user_id, image_id, ttl_hours=ttl_hours, force=True)
+    
+    width, height = source['width'], source['height']
+    try:
+        if max_dimension and max(width, height) > max_dimension:
+            img = open_reduced(data, max_dimension)
+            save_image_to_disk(user_id, image_id, img, quota_mb)
+            width, height = img.width, img.height
+            thumbnail = img
+        else:
+            max_dimension = 0
+            thumbnail = open_preview(data, (STATS_SIZE, STATS_SIZE))
+            thumbnail.load()
+        save_original_to_disk(user_id, image_id, data, quota_mb)
+        save_thumbnail_to_disk(user_id, image_id, thumbnail, quota_mb)
+    except QuotaExceeded:
+        delete_image_from_disk(user_id, image_id)
+        raise
+    save_stats_to_disk(user_id, image_id, pillow_image(thumbnail), quota_mb, (width, height))
+    
+    metadata = load_user_metadata(user_id)
+    image_info = {
+        'id': image_id,
+        'filename': filename,
+        'width': width,
+        'height': height,
+        'created_at': datetime.now().isoformat(),
+        'source': source,
+        'dhash': similarity.dhash(pillow_image(thumbnail))
+    }
+    if max_dimension:
+        image_info['max_dimension'] = max_dimension
+    metadata['images'].append(image_info)
+    if not metadata.get('current_id'):
+        metadata['current_id'] = image_id
+    save_user_metadata(user_id, metadata)
+    return image_info
+
+
+def get_ingest_max_dimension(user=None, preset=None):
+    """Returns the longest side uploads are scaled down to in px (0 = keep full size)"""
+    if preset is not None and preset.ingest_max_dimension is not None:
+        return preset.ingest_max_dimension
+    if user is None and current_user.is_authenticated:
+        user = current_user
+    if user is not None and getattr(user, 'ingest_max_dimension', None) is not None:
+        return user.ingest_max_dimension
+    return app.config['INGEST_MAX_DIMENSION']
+
+
+def requested_max_dimension(data):
+    """Ingest size for an upload request: max_dimension, else that of preset_id, else the user's.
+    
+    Raises ValueError for invalid values.
+    """
+    max_dimension = data.get('max_dimension')
+    if max_dimension not in (None, ''):
+        if not str(max_dimension).isdigit():
+            raise ValueError('max_dimension must be a non-negative number')
+        return int(max_dimension)
+    
+    preset = None
+    if data.get('preset_id') not in (None, ''):
+        preset = get_visible_preset(int(data['preset_id']))
+        if not preset:
+            raise ValueError('Preset not found')
+    return get_ingest_max_dimension(preset=preset)
+
+
+# ==================== QUOTAS ====================
+
+def get_user_quota_mb(user=None):
+    """Returns the storage quota of a user in MB (0 = unlimited)"""
+    if user is None and current_user.is_authenticated:
+        user = current_user
+    if user is not None and getattr(user, 'quota_mb', None) is not None:
+        return user.quota_mb
+    return app.config['USER_QUOTA_MB']
+
+
+def get_workspace_quota_mb(user_id):
+    """Returns the storage quota in MB of the owner of a workspace (0 = unlimited).
+    
+    Needs an app context but no request, so the quota can be passed to the
+    storage functions from the CLI, the cleaner or a worker thread as well.
+    """
+    if str(user_id).isdigit():
+        user = user_cache.load(int(user_id))
+        if user is not None and user.quota_mb is not None:
+            return user.quota_mb
+    return app.config['USER_QUOTA_MB']
+
+
+class QuotaExceeded(Exception):
+    """A write would exceed the user's or the server's storage quota"""
+
+
+def check_storage_quota(user_id, incoming_bytes, quota_mb, keep=None, evict=True):
+    """Makes room for incoming_bytes in a workspace with quota_mb (0 = unlimited).
+    
+    Returns (error message if a quota would be exceeded, ids of evicted images).
+    Eviction (with QUOTA_POLICY=evict) never removes the image keep; evicted
+    images are removed from the saved metadata, copies the caller holds have
+    to drop them too.
+    """
+    global_quota = app.config['GLOBAL_QUOTA_MB'] * 1024 * 1024
+    if global_quota and expiry_index.total_bytes() + incoming_bytes > global_quota:
+        return 'Server storage is full', []
+    
+    quota = quota_mb * 1024 * 1024
+    if not quota or expiry_index.user_bytes(user_id) + incoming_bytes <= quota:
+        return None, []
+    
+    if not evict or app.config['QUOTA_POLICY'] != 'evict' or incoming_bytes > quota:
+        return 'Storage quota exceeded', []
+    
+    # Evict the user's least recently used images until the upload fits
+    evicted = []
+    while expiry_index.user_bytes(user_id) + incoming_bytes > quota:
+        entries = [entry for entry in expiry_index.oldest(2, user_id=user_id) if entry[1] != keep]
+        if not entries:
+            return 'Storage quota exceeded', evicted
+        remove_image(user_id, entries[0][1])
+        evicted.append(entries[0][1])
+    return None, evicted
+
+
+def ensure_storage_quota(user_id, incoming_bytes, quota_mb, keep=None, evict=True):
+    """Like check_storage_quota, but raises QuotaExceeded. Returns the ids of evicted images.
+    Shrinking writes always pass."""
+    if incoming_bytes <= 0:
+        return []
+    quota_error, evicted = check_storage_quota(user_id, incoming_bytes, quota_mb, keep, evict)
+    if quota_error:
+        raise QuotaExceeded(quota_error)
+    return evicted
+
+
+# ==================== EXPORTS ====================
+
+export_pool = ExportPool(app.config['EXPORT_WORKERS'], app.config['EXPORT_MAX_PENDING'])
+
+# Encodes the sizes of a rendition export in parallel (Pillow releases the GIL while encoding)
+rendition_executor = ThreadPoolExecutor(max_workers=app.config['RENDITION_THREADS'])
+
+# Frames of animated images are edited in parallel, a few frames ahead of the encoder
+set_frame_workers(app.config['FRAME_WORKERS'])
+
+MAX_RENDITION_WIDTHS = 10
+
+_available_export_formats = None
+
+
+def get_available_export_formats():
+    """Formats offered for export, detected on first use so startup does not load encoder plugins"""
+    global _available_export_formats
+    if _available_export_formats is None:
+        _available_export_formats = available_export_formats()
+        print(f"🖼️  Export formats: {', '.join(_available_export_formats)}")
+    return _available_export_formats
+
+
+def get_user_export_folder(user_id):
+    """Returns the folder with cached exports and export jobs of a user (not created)"""
+    return os.path.join(get_user_upload_folder(user_id, create=False), EXPORT_FOLDER)
+
+
+def requested_quality(data, default):
+    """Encoder quality of a request (0-100). Raises ValueError('Invalid quality')."""
+    try:
+        quality = int(data.get('quality', default))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid quality')
+    if not 0 <= quality <= 100:
+        raise ValueError('Invalid quality')
+    return quality
+
+
+def get_export_options(data):
+    """Reads profile, lossless and subsampling of a download request (ValueError if invalid)"""
+    format_type = (data.get('format') or 'png').lower()
+    available = get_available_export_formats()
+    if format_type not in available:
+        raise ValueError(f"Unsupported format (available: {', '.join(available)})")
+    
+    profile = (data.get('profile') or app.config['EXPORT_PROFILE']).lower()
+    if profile not in EXPORT_PROFILES:
+        raise ValueError(f"Unknown profile (available: {', '.join(EXPORT_PROFILES)})")
+    
+    subsampling = data.get('subsampling')
+    if subsampling and subsampling not in JPEG_SUBSAMPLING:
+        raise ValueError(f"Invalid subsampling (available: {', '.join(JPEG_SUBSAMPLING)})")
+    
+    return {'profile': profile, 'lossless': data.get('lossless'), 'subsampling': subsampling}
+
+
+def encode_export(img, format_type, quality, export_options, held=False):
+    """Encodes an image for download; slow formats run on the export pool
+    (held: in room reserved with export_pool.hold). Returns (bytes, mimetype, seconds)."""
+    options = (export_options['profile'], export_options['lossless'], export_options['subsampling'])
+    if format_type.lower() in SLOW_EXPORT_FORMATS:
+        # copy(): plain Image, the file plugin classes do not survive pickling
+        return export_pool.run(encode_image_timed, img.copy(), format_type, quality, *options, held=held)
+    return encode_image_timed(img, format_type, quality, *options)
+
+
+def add_export_headers(response, profile, output_bytes, encode_seconds):
+    """Reports the profile, encoded size and encode time of a download"""
+    response.headers['X-Export-Profile'] = profile
+    response.headers['X-Output-Bytes'] = str(output_bytes)
+    response.headers['X-Encode-Time-Ms'] = f'{encode_seconds * 1000:.1f}'
+    return response
+
+
+# ==================== CLEANUP ====================
+
+def _expire_images(entries):
+    """Deletes the given (user_id, image_id) pairs and empty user folders.
+    
+    Workspaces being moved to another node are left alone. Returns the
+    number of entries handled.
+    """
+    handled = 0
+    for user_id, image_id in entries:
+        try:
+            lock_file = lock_workspace(user_id)
+        except sharding.WorkspaceMoving:
+            continue
+        handled += 1
+        try:
+            metadata = remove_image(user_id, image_id)
+            if not metadata['images']:
+                remove_user_folder(user_id)
+            print(f"Cleaned up image {image_id} of user {user_id}")
+        except Exception as e:
+            print(f"Error cleaning up {image_id} of user {user_id}: {e}")
+            expiry_index.forget(user_id, image_id)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+    return handled
+
+
+def seed_expiry_index():
+    """Indexes folders that predate the expiry index and removes empty ones (runs once)"""
     if not os.path.exists(UPLOAD_FOLDER):
         return
     
-    cutoff_time = datetime.now() - timedelta(hours=TEMP_IMAGE_LIFETIME_HOURS)
+    lifetime = app.config['TEMP_IMAGE_LIFETIME_HOURS'] * 3600
+    cutoff = time.time() - lifetime
     
     for folder_name in os.listdir(UPLOAD_FOLDER):
         folder_path = os.path.join(UPLOAD_FOLDER, folder_name)
-        if os.path.isdir(folder_path):
-            # Check folder modification date
-            folder_mtime = datetime.fromtimestamp(os.path.getmtime(folder_path))
-            if folder_mtime < cutoff_time:
-                try:
-                    shutil.rmtree(folder_path)
-                    print(f"Cleaned up old folder: {folder_name}")
-                except Exception as e:
-                    print(f"Error cleaning up {folder_name}: {e}")
+        if not folder_name.startswith('user_') or not os.path.isdir(folder_path):
+            continue
+        user_id = folder_name[len('user_'):]
+        metadata = load_user_metadata(user_id)
+        
+        if not metadata['images']:
+            if os.path.getmtime(folder_path) < cutoff:
+                remove_user_folder(user_id)
+            continue
+        
+        index_user_images(user_id, metadata)
+
+
+def index_user_images(user_id, metadata):
+    """Adds the images of a user folder to the expiry index (as just accessed)"""
+    folder_path = get_user_upload_folder(user_id, create=False)
+    for image_info in metadata['images']:
+        image_id = image_info['id']
+        size = 0
+        for suffix in IMAGE_FILE_SUFFIXES:
+            filepath = os.path.join(folder_path, f'{image_id}{suffix}')
+            if os.path.exists(filepath):
+                size += os.path.getsize(filepath)
+        expiry_index.touch(user_id, image_id, force=True)
+        expiry_index.add_bytes(user_id, image_id, size)
+
+
+def cleanup_old_uploads():
+    """Deletes expired images and evicts the oldest ones above the disk high-water mark"""
+    batch_size = app.config['CLEANUP_BATCH_SIZE']
+    pause = app.config['CLEANUP_BATCH_PAUSE']
+    
+    removed = prune_exports(UPLOAD_FOLDER, app.config['EXPORT_CACHE_HOURS'] * 3600)
+    if removed:
+        print(f"Removed {removed} cached exports")
+    removed = resumable.prune_uploads(UPLOAD_FOLDER, app.config['PARTIAL_UPLOAD_HOURS'] * 3600)
+    if removed:
+        print(f"Removed {removed} abandoned uploads")
+    
+    # Expired images, in rate-limited chunks
+    now = time.time()
+    while True:
+        entries = expiry_index.expired(now, batch_size)
+        if not entries or not _expire_images(entries):
+            break
+        time.sleep(pause)
+    
+    # Disk-quota-driven eviction, least recently used first
+    high_water = app.config['UPLOAD_HIGH_WATER_MB'] * 1024 * 1024
+    if not high_water or expiry_index.total_bytes() <= high_water:
+        return
+    low_water = app.config['UPLOAD_LOW_WATER_MB'] * 1024 * 1024 or int(high_water * 0.9)
+    while expiry_index.total_bytes() > low_water:
+        entries = expiry_index.oldest(batch_size)
+        if not entries or not _expire_images(entries):
+            break
+        time.sleep(pause)
 
 
 def start_cleanup_thread():
-    """Starts a background thread for periodic cleanup"""
+    """Starts a background thread for periodic cleanup.
+    
+    Every worker starts the thread, but only the one holding the cleanup lock
+    actually deletes anything. The others keep retrying in case it exits.
+    """
+    seed_marker = os.path.join(UPLOAD_FOLDER, '.expiry_seeded')
+    
     def cleanup_loop():
         while True:
-            time.sleep(3600)  # Jede Stunde
-            cleanup_old_uploads()
+            time.sleep(app.config['CLEANUP_INTERVAL_SECONDS'])
+            if not cleanup_lock.acquire():
+                continue
+            try:
+                if not os.path.exists(seed_marker):
+                    seed_expiry_index()
+                    open(seed_marker, 'w').close()
+                cleanup_old_uploads()
+            except Exception as e:
+                print(f"Error during cleanup: {e}")
     
     thread = threading.Thread(target=cleanup_loop, daemon=True)
     thread.start()
 
 
-# Cleanup-Thread starten
-start_cleanup_thread()
+# ==================== STARTUP ====================
 
+# Startup times for the time-to-first-request log. gunicorn.conf.py sets the
+# server start; 'worker' is set when a worker process is initialized.
+startup_times = {'server': float(os.environ.get('BILDWERKZEUG_STARTED_AT') or time.time())}
+_background_lock = threading.Lock()
+_background_pid = None
+_first_request_pid = None
 
-# ==================== HILFSFUNKTIONEN ====================
 
-def base64_to_image(base64_string):
-    """Converts Base64 string to PIL Image"""
-    if ',' in base64_string:
-        base64_string = base64_string.split(',')[1]
+def start_background_tasks():
+    """Starts the cleanup thread of this process (once).
     
-    img_data = base64.b64decode(base64_string)
-    img = Image.open(io.BytesIO(img_data))
+    Nothing is started while the module is imported, so gunicorn can preload
+    the app in the master and fork the workers without threads.
+    """
+    global _background_pid
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+    start_cleanup_thread()
+
+
+def init_worker():
+    """Prepares a worker process: own database connections, background tasks"""
+    startup_times['worker'] = time.time()
+    with app.app_context():
+        # Connections opened by the preloading master must not be shared
+        db.engine.dispose(close=False)
+    start_background_tasks()
+
+
+@app.before_request
+def log_first_request():
+    """Logs the time to the first request of a worker and makes sure its background tasks run"""
+    global _first_request_pid
+    if _first_request_pid == os.getpid():
+        return
+    _first_request_pid = os.getpid()
+    start_background_tasks()
     
-    if img.mode == 'P':
-        img = img.convert('RGBA')
+    now = time.time()
+    since_init = f", {now - startup_times['worker']:.2f}s after worker init" if 'worker' in startup_times else ''
+    print(f"⏱️  Worker {os.getpid()}: first request {now - startup_times['server']:.2f}s after start{since_init}")
+
+
+# ==================== SHARDING ====================
+
+# Endpoints every node answers itself (no workspace involved)
+SHARD_EXEMPT_ENDPOINTS = {'static', 'login', 'logout', 'get_formats', 'import_workspace'}
+
+
+def shard_for_user(user_id):
+    """Node holding a user's workspace: this one while the folder is here (also if the
+    ring now points elsewhere and it was not moved yet), else the one the ring picks"""
+    if shard_ring is None or os.path.isdir(get_user_upload_folder(user_id, create=False)):
+        return app.config['SHARD_SELF'] or None
+    return shard_ring.node_for(user_id)
+
+
+def lock_workspace(user_id):
+    """Takes the write lock of a user's workspace on this node, so rebalance waits for
+    the write (see sharding.lock_for_writing). Returns the lock file to close, or None
+    without sharding or a workspace. Raises sharding.WorkspaceMoving during a move."""
+    if shard_ring is None:
+        return None
+    folder = get_user_upload_folder(user_id, create=False)
+    return sharding.lock_for_writing(folder) if os.path.isdir(folder) else None
+
+
+@app.before_request
+def route_to_shard():
+    """Sends requests of users whose workspace is on another node there.
+    
+    Answers 421 naming the node in the shard header (for a reverse proxy to
+    retry there), or redirects with SHARD_REDIRECT. Requests that may write
+    hold the workspace lock until they end; while the workspace is being
+    moved they get 503 and reads are still served here.
+    """
+    if shard_ring is None or request.endpoint in SHARD_EXEMPT_ENDPOINTS or request.endpoint is None:
+        return None
+    if app.config.get('LOGIN_REQUIRED', True) and not current_user.is_authenticated:
+        return None
+    user_id = get_user_id()
+    if user_id is None:
+        return None
     
-    return img
+    g.shard = shard_for_user(user_id)
+    if g.shard == app.config['SHARD_SELF']:
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return None
+        try:
+            g.workspace_lock = lock_workspace(user_id)
+        except sharding.WorkspaceMoving as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        return None
+    if app.config['SHARD_REDIRECT']:
+        return redirect(shard_nodes[g.shard] + request.full_path.rstrip('?'), 307)
+    return jsonify({'error': 'Workspace is on another node', 'shard': g.shard}), 421
+
 
+@app.teardown_request
+def release_workspace_lock(exc):
+    lock_file = g.pop('workspace_lock', None)
+    if lock_file is not None:
+        lock_file.close()
 
-def image_to_base64(img, format='PNG'):
-    """Converts a PIL Image to Base64 string"""
-    buffered = io.BytesIO()
+
+@app.after_request
+def add_shard_headers(response):
+    """Names the node of the user's workspace in a header and a cookie, for sticky routing"""
+    shard = g.get('shard')
+    if shard:
+        response.headers[sharding.SHARD_HEADER] = shard
+        if request.cookies.get(sharding.SHARD_COOKIE) != shard:
+            response.set_cookie(sharding.SHARD_COOKIE, shard, httponly=True, samesite='Lax',
+                                domain=app.config['SESSION_COOKIE_DOMAIN'])
+    return response
+
+
+@app.route('/internal/workspaces/<user_id>', methods=['PUT'])
+def import_workspace(user_id):
+    """Takes over a workspace sent by another node (python -m bildwerkzeug rebalance).
     
-    if format.upper() == 'JPEG':
-        if img.mode == 'RGBA':
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            background.paste(img, mask=img.split()[3])
-            img = background
-        elif img.mode != 'RGB':
-            img = img.convert('RGB')
-        img.save(buffered, format='JPEG', quality=95)
-        mime = 'image/jpeg'
-    else:
-        img.save(buffered, format='PNG')
-        mime = 'image/png'
+    The body is a tar archive of the user folder, signed with SHARD_SECRET.
+    """
+    if not re.fullmatch(r'[\w-]+', user_id):
+        return jsonify({'error': 'Invalid user'}), 400
+    try:
+        digest = sharding.verify(app.config['SHARD_SECRET'], user_id, request.headers)
+    except sharding.ShardError as e:
+        return jsonify({'error': str(e)}), 403
     
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:{mime};base64,{img_str}"
+    try:
+        folder = get_user_upload_folder(user_id, create=False)
+        if os.path.exists(folder):
+            return jsonify({'error': 'Workspace already exists'}), 409
+        
+        # Workspaces can be larger than an upload: read around MAX_CONTENT_LENGTH
+        # (None on the request would fall back to it)
+        stream = get_input_stream(request.environ)
+        with tempfile.TemporaryFile() as archive:
+            if sharding.copy_with_digest(stream, archive) != digest:
+                return jsonify({'error': 'Archive does not match its digest'}), 400
+            archive.seek(0)
+            try:
+                sharding.unpack_workspace(archive, folder)
+            except sharding.ShardError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        metadata = load_user_metadata(user_id)
+        index_user_images(user_id, metadata)
+        print(f"📦 Workspace of user {user_id} imported ({len(metadata['images'])} images)")
+        return jsonify({'success': True, 'images': len(metadata['images'])})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
+# ==================== HILFSFUNKTIONEN ====================
 
 def admin_required(f):
     """Decorator for admin-only routes"""
@@ -265,103 +1162,6 @@ def admin_required(f):
     return decorated_function
 
 
-def apply_operation_to_image(img, operation, params):
-    """Applies an operation to an image"""
-    if operation == 'resize':
-        width = int(params.get('width', img.width))
-        height = int(params.get('height', img.height))
-        keep_aspect = params.get('keep_aspect', True)
-        
-        if keep_aspect:
-            img.thumbnail((width, height), Image.Resampling.LANCZOS)
-        else:
-            img = img.resize((width, height), Image.Resampling.LANCZOS)
-    
-    elif operation == 'resize_percent':
-        percent = float(params.get('percent', 100))
-        new_width = max(1, int(img.width * percent / 100))
-        new_height = max(1, int(img.height * percent / 100))
-        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    elif operation == 'resize_max_size':
-        max_size_mb = float(params.get('max_size_mb', 1.0))
-        format_type = params.get('format', 'jpeg').upper()
-        quality = int(params.get('quality', 85))
-        max_bytes = int(max_size_mb * 1024 * 1024)
-        
-        if format_type in ('JPEG', 'JPG'):
-            format_type = 'JPEG'
-            if img.mode == 'RGBA':
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3])
-                img = background
-        
-        scale = 1.0
-        while scale > 0.1:
-            test_img = img.copy()
-            if scale < 1.0:
-                new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
-                test_img = img.resize(new_size, Image.Resampling.LANCZOS)
-            
-            buffer = io.BytesIO()
-            if format_type == 'PNG':
-                test_img.save(buffer, format=format_type)
-            else:
-                test_img.save(buffer, format=format_type, quality=quality)
-            
-            if buffer.tell() <= max_bytes:
-                img = test_img
-                break
-            
-            scale -= 0.05
-            
-    elif operation == 'rotate':
-        angle = int(params.get('angle', 90))
-        img = img.rotate(-angle, expand=True)
-        
-    elif operation == 'flip_horizontal':
-        img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
-        
-    elif operation == 'flip_vertical':
-        img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
-        
-    elif operation == 'grayscale':
-        img = img.convert('L').convert('RGB')
-        
-    elif operation == 'blur':
-        radius = float(params.get('radius', 2))
-        img = img.filter(ImageFilter.GaussianBlur(radius=radius))
-        
-    elif operation == 'sharpen':
-        factor = float(params.get('factor', 2))
-        enhancer = ImageEnhance.Sharpness(img)
-        img = enhancer.enhance(factor)
-        
-    elif operation == 'brightness':
-        factor = float(params.get('factor', 1.0))
-        enhancer = ImageEnhance.Brightness(img)
-        img = enhancer.enhance(factor)
-        
-    elif operation == 'contrast':
-        factor = float(params.get('factor', 1.0))
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(factor)
-        
-    elif operation == 'saturation':
-        factor = float(params.get('factor', 1.0))
-        enhancer = ImageEnhance.Color(img)
-        img = enhancer.enhance(factor)
-        
-    elif operation == 'crop':
-        left = int(params.get('left', 0))
-        top = int(params.get('top', 0))
-        right = int(params.get('right', img.width))
-        bottom = int(params.get('bottom', img.height))
-        img = img.crop((left, top, right, bottom))
-    
-    return img
-
-
 # ==================== AUTH ROUTES ====================
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -423,9 +1223,16 @@ def admin_panel():
 def get_users():
     """Get all users"""
     users = User.query.all()
+    usage = expiry_index.usage_by_user()
     return jsonify({
         'success': True,
-        'users': [user.to_dict() for user in users]
+        'users': [
+            {**user.to_dict(), 'storage_bytes': usage.get(str(user.id), 0),
+             'effective_quota_mb': get_user_quota_mb(user)}
+            for user in users
+        ],
+        'default_quota_mb': app.config['USER_QUOTA_MB'],
+        'default_ingest_max_dimension': app.config['INGEST_MAX_DIMENSION']
     })
 
 
@@ -440,6 +1247,8 @@ def create_user():
     email = data.get('email', '').strip()
     password = data.get('password', '')
     is_admin = data.get('is_admin', False)
+    quota_mb = data.get('quota_mb')
+    ingest_max_dimension = data.get('ingest_max_dimension')
     
     if not username or not email or not password:
         return jsonify({'error': 'All fields are required'}), 400
@@ -453,11 +1262,19 @@ def create_user():
     if User.query.filter_by(email=email).first():
         return jsonify({'error': 'Email already taken'}), 400
     
+    if quota_mb not in (None, '') and (not str(quota_mb).isdigit()):
+        return jsonify({'error': 'Quota must be a non-negative number'}), 400
+    
+    if ingest_max_dimension not in (None, '') and (not str(ingest_max_dimension).isdigit()):
+        return jsonify({'error': 'Max. upload size must be a non-negative number'}), 400
+    
     user = User(
         username=username,
         email=email,
         is_admin=is_admin,
-        is_active=True
+        is_active=True,
+        quota_mb=int(quota_mb) if quota_mb not in (None, '') else None,
+        ingest_max_dimension=int(ingest_max_dimension) if ingest_max_dimension not in (None, '') else None
     )
     user.set_password(password)
     
@@ -508,7 +1325,26 @@ def update_user(user_id):
             return jsonify({'error': 'You cannot deactivate yourself'}), 400
         user.is_active = data['is_active']
     
+    if 'quota_mb' in data:
+        quota_mb = data['quota_mb']
+        if quota_mb in (None, ''):
+            user.quota_mb = None
+        elif str(quota_mb).isdigit():
+            user.quota_mb = int(quota_mb)
+        else:
+            return jsonify({'error': 'Quota must be a non-negative number'}), 400
+    
+    if 'ingest_max_dimension' in data:
+        ingest_max_dimension = data['ingest_max_dimension']
+        if ingest_max_dimension in (None, ''):
+            user.ingest_max_dimension = None
+        elif str(ingest_max_dimension).isdigit():
+            user.ingest_max_dimension = int(ingest_max_dimension)
+        else:
+            return jsonify({'error': 'Max. upload size must be a non-negative number'}), 400
+    
     db.session.commit()
+    user_cache.invalidate()
     
     return jsonify({
         'success': True,
@@ -528,6 +1364,7 @@ def delete_user(user_id):
     
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate()
     
     return jsonify({'success': True})
 
@@ -543,21 +1380,141 @@ def index():
 
 # ==================== TEMPORARY IMAGE API ====================
 
+def encode_cursor(image_info):
+    """Opaque position after an image in the list"""
+    position = json.dumps([image_info.get('created_at'), image_info['id']])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def page_start(images, cursor):
+    """Index of the first image after a cursor. Raises ValueError for invalid cursors."""
+    try:
+        created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    for index, image_info in enumerate(images):
+        if image_info['id'] == image_id:
+            return index + 1
+    # The image was deleted since: continue after the images uploaded before it
+    return next((index for index, image_info in enumerate(images)
+                 if (image_info.get('created_at') or '') > (created_at or '')), len(images))
+
+
+def listing_page(metadata, limit=None, cursor=None):
+    """Response data for a page of the image list (all images without limit)"""
+    images = metadata.get('images', [])
+    start = page_start(images, cursor) if cursor else 0
+    page = images[start:start + min(max(limit, 1), MAX_PAGE_SIZE)] if limit else images[start:]
+    has_more = start + len(page) < len(images)
+    return {
+        'success': True,
+        'images': page,
+        'current_id': metadata.get('current_id'),
+        'version': metadata.get('version', 0),
+        'total': len(images),
+        'next_cursor': encode_cursor(page[-1]) if page and has_more else None
+    }
+
+
+def listing_etag(metadata):
+    return str(metadata.get('version', 0))
+
+
+def listing_response(payload, metadata):
+    """JSON response tagged with the listing version, so unchanged lists are answered with 304"""
+    response = jsonify(payload)
+    response.set_etag(listing_etag(metadata))
+    response.headers['Cache-Control'] = LISTING_CACHE_CONTROL
+    return response
+
+
+def listing_not_modified(metadata):
+    """304 response if the client has the current listing version, else None"""
+    if request.if_none_match.contains(listing_etag(metadata)):
+        response = Response(status=304)
+        response.set_etag(listing_etag(metadata))
+        response.headers['Cache-Control'] = LISTING_CACHE_CONTROL
+        return response
+    return None
+
+
 @app.route('/api/images', methods=['GET'])
 @optional_login_required
 def get_images():
-    """List of all saved images for the current user"""
+    """List of the saved images for the current user.
+    
+    With ?limit= the list is returned in pages; next_cursor is passed as
+    ?cursor= for the next one. Answers 304 if If-None-Match holds the
+    current version.
+    """
     try:
         metadata = load_user_metadata(get_user_id())
-        return jsonify({
-            'success': True,
-            'images': metadata.get('images', []),
-            'current_id': metadata.get('current_id')
-        })
+        expiry_index.touch_user(get_user_id())
+        not_modified = listing_not_modified(metadata)
+        if not_modified:
+            return not_modified
+        
+        try:
+            payload = listing_page(metadata, request.args.get('limit', type=int), request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return listing_response(payload, metadata)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/changes', methods=['GET'])
+@optional_login_required
+def get_image_changes():
+    """Images added or changed and ids deleted since a listing version (?since=).
+    
+    If the changes since then are no longer known (or the version is from
+    before the images were cleared), the whole list is returned with reset.
+    """
+    try:
+        since = request.args.get('since', type=int)
+        if since is None:
+            return jsonify({'error': 'since is required'}), 400
+        
+        metadata = load_user_metadata(get_user_id())
+        expiry_index.touch_user(get_user_id())
+        not_modified = listing_not_modified(metadata)
+        if not_modified:
+            return not_modified
+        
+        version = metadata.get('version', 0)
+        images = metadata.get('images', [])
+        payload = {'success': True, 'version': version, 'current_id': metadata.get('current_id')}
+        if since > version or since < metadata.get('tombstones_from', version):
+            payload.update(reset=True, changed=images, deleted=[])
+        else:
+            payload.update(
+                reset=False,
+                changed=[i for i in images if i.get('changed', 0) > since],
+                deleted=[entry['id'] for entry in metadata.get('deleted', []) if entry['version'] > since]
+            )
+        return listing_response(payload, metadata)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def requested_ttl_hours(data):
+    """Per-image lifetime of an upload request in hours (None if not given).
+    
+    Raises ValueError unless it is a number up to MAX_IMAGE_TTL_HOURS.
+    """
+    ttl_hours = data.get('ttl_hours')
+    if ttl_hours is None:
+        return None
+    try:
+        ttl_hours = float(ttl_hours)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid ttl_hours')
+    if not 0 < ttl_hours <= app.config['MAX_IMAGE_TTL_HOURS']:
+        raise ValueError('Invalid ttl_hours')
+    return ttl_hours
+
+
 @app.route('/api/images', methods=['POST'])
 @optional_login_required
 def upload_image():
@@ -570,38 +1527,191 @@ def upload_image():
         if not image_data:
             return jsonify({'error': 'No image provided'}), 400
         
-        # Process image
-        img = base64_to_image(image_data)
-        image_id = str(uuid.uuid4())[:8]
+        try:
+            ttl_hours = requested_ttl_hours(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Save image and original
-        save_image_to_disk(get_user_id(), image_id, img, is_original=True)
-        save_image_to_disk(get_user_id(), image_id, img, is_original=False)
-        save_thumbnail_to_disk(get_user_id(), image_id, img)
+        try:
+            max_dimension = requested_max_dimension(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Update metadata
-        metadata = load_user_metadata(get_user_id())
-        image_info = {
-            'id': image_id,
-            'filename': filename,
-            'width': img.width,
-            'height': img.height,
-            'created_at': datetime.now().isoformat()
-        }
-        metadata['images'].append(image_info)
-        if not metadata.get('current_id'):
-            metadata['current_id'] = image_id
-        save_user_metadata(get_user_id(), metadata)
+        img_data = decode_base64(image_data)
         
-        # Update folder timestamp for cleanup
-        folder = get_user_upload_folder(get_user_id())
-        os.utime(folder, None)
+        # Rejects uploads that cannot fit before decoding; every file written
+        # (here and on later edits) is checked with its real size
+        quota_mb = get_workspace_quota_mb(get_user_id())
+        quota_error, _ = check_storage_quota(get_user_id(), len(img_data), quota_mb)
+        if quota_error:
+            return jsonify({'error': quota_error}), 413
+        
+        image_info = ingest_image(get_user_id(), img_data, filename, quota_mb, ttl_hours=ttl_hours,
+                                  max_dimension=max_dimension)
         
         return jsonify({
             'success': True,
             'image': image_info
         })
         
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ---- Resumable uploads (create, PATCH chunks at Upload-Offset, finish) ----
+
+def upload_payload(state):
+    """Upload state for the client"""
+    return {
+        'success': True,
+        'upload': {key: state[key] for key in ('id', 'filename', 'size', 'offset')},
+        'chunk_size': app.config['UPLOAD_CHUNK_MB'] * 1024 * 1024
+    }
+
+
+def upload_headers(state):
+    return {
+        'Upload-Offset': str(state['offset']),
+        'Upload-Length': str(state['size']),
+        'Cache-Control': 'no-store'
+    }
+
+
+def upload_response(state, status=200):
+    """Upload state as JSON with the offset also in the Upload-Offset header"""
+    response = jsonify(upload_payload(state))
+    response.status_code = status
+    response.headers.update(upload_headers(state))
+    return response
+
+
+@app.route('/api/uploads', methods=['POST'])
+@optional_login_required
+def create_upload():
+    """
+    Start a resumable upload.
+    Expects filename, size (bytes) and optionally sha256, ttl_hours and
+    max_dimension or preset_id (see upload_image).
+    """
+    try:
+        data = request.get_json() or {}
+        filename = data.get('filename', 'image.png')
+        
+        try:
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'size must be given in bytes'}), 400
+        if size <= 0:
+            return jsonify({'error': 'size must be given in bytes'}), 400
+        if size > app.config['MAX_RESUMABLE_UPLOAD_MB'] * 1024 * 1024:
+            return jsonify({'error': f"File too large (max {app.config['MAX_RESUMABLE_UPLOAD_MB']} MB)"}), 413
+        
+        try:
+            ttl_hours = requested_ttl_hours(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            max_dimension = requested_max_dimension(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Same check as a direct upload: the original has to fit
+        quota_error, _ = check_storage_quota(get_user_id(), size, get_workspace_quota_mb(get_user_id()))
+        if quota_error:
+            return jsonify({'error': quota_error}), 413
+        
+        state = resumable.create_upload(get_user_upload_folder(), filename, size, sha256=data.get('sha256'),
+                                        ttl_hours=ttl_hours, max_dimension=max_dimension)
+        response = upload_response(state, 201)
+        response.headers['Location'] = url_for('patch_upload', upload_id=state['id'])
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET', 'HEAD'])
+@optional_login_required
+def get_upload(upload_id):
+    """Offset of an upload, to resume after a dropped connection"""
+    try:
+        state = resumable.load_upload(get_user_upload_folder(create=False), upload_id)
+    except resumable.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    if not state:
+        return jsonify({'error': 'Upload not found'}), 404
+    return upload_response(state)
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+@optional_login_required
+def patch_upload(upload_id):
+    """
+    Append a chunk (raw request body) at the Upload-Offset header.
+    An optional Upload-Checksum header ('sha256 <base64>') is checked per chunk.
+    """
+    try:
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Upload-Offset header required'}), 400
+        
+        folder = get_user_upload_folder(create=False)
+        checksum = resumable.parse_checksum(request.headers.get('Upload-Checksum'))
+        resumable.append_chunk(folder, upload_id, offset, request.stream, checksum)
+        return upload_response(resumable.load_upload(folder, upload_id))
+        
+    except resumable.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+@optional_login_required
+def cancel_upload(upload_id):
+    """Abort an upload"""
+    try:
+        resumable.remove_upload(get_user_upload_folder(create=False), upload_id)
+    except resumable.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify({'success': True})
+
+
+@app.route('/api/uploads/<upload_id>/finish', methods=['POST'])
+@optional_login_required
+def finish_upload(upload_id):
+    """Verify the SHA-256 of a complete upload and add it like a normal upload"""
+    try:
+        data = request.get_json(silent=True) or {}
+        folder = get_user_upload_folder(create=False)
+        
+        data_path, state = resumable.finish_upload(folder, upload_id, data.get('sha256'))
+        try:
+            probe_image(data_path)
+        except Exception:
+            resumable.remove_upload(folder, upload_id)
+            return jsonify({'error': 'Not a valid image'}), 400
+        
+        try:
+            image_info = ingest_image(get_user_id(), data_path, state['filename'],
+                                      get_workspace_quota_mb(get_user_id()), ttl_hours=state['ttl_hours'],
+                                      max_dimension=state.get('max_dimension') or 0)
+        except QuotaExceeded as e:
+            resumable.remove_upload(folder, upload_id)
+            return jsonify({'error': str(e)}), 413
+        resumable.remove_upload(folder, upload_id)
+        
+        return jsonify({
+            'success': True,
+            'image': image_info,
+            'sha256': state['sha256_actual']
+        })
+        
+    except resumable.UploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -617,7 +1727,7 @@ def get_image(image_id):
         
         return jsonify({
             'success': True,
-            'image': image_to_base64(img),
+            **image_payload(get_user_id(), image_id, img),
             'width': img.width,
             'height': img.height
         })
@@ -626,15 +1736,104 @@ def get_image(image_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/images/<image_id>/thumbnail', methods=['GET'])
+def get_tile_info(user_id, image_id, image_info=None):
+    """Describes the tile pyramid of the current version of an image, or None"""
+    if image_info is None:
+        metadata = load_user_metadata(user_id)
+        image_info = next((i for i in metadata['images'] if i['id'] == image_id), None)
+    source_path = get_image_path(user_id, image_id)
+    if not image_info or not source_path:
+        return None
+    
+    with Image.open(source_path) as source:
+        tile_format = tiles.tile_format_for(source.mode)
+    version = image_info.get('version', 0)
+    return {
+        **tiles.describe(image_info['width'], image_info['height'], tile_format),
+        'version': version,
+        'url': f'/api/images/{image_id}/tiles/{version}/{{level}}/{{col}}_{{row}}.{tile_format}'
+    }
+
+
+def image_payload(user_id, image_id, img, image_info=None):
+    """The image for the editor: Base64, or only the tile pyramid for huge stored images"""
+    if image_id and img.width * img.height >= app.config['TILED_VIEW_MIN_PIXELS']:
+        tile_info = get_tile_info(user_id, image_id, image_info)
+        if tile_info:
+            return {'tiled': True, 'tiles': tile_info}
+    return {'image': image_to_base64(img)}
+
+
+@app.route('/api/images/<image_id>/tiles', methods=['GET'])
 @optional_login_required
+def get_image_tiles(image_id):
+    """Tile pyramid description (DeepZoom layout) of the current image version"""
+    tile_info = get_tile_info(get_user_id(), image_id)
+    if not tile_info:
+        return jsonify({'error': 'Image not found'}), 404
+    response = jsonify({'success': True, 'tiles': tile_info})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# Private: tiles belong to the user's session
+TILE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+
+def get_tile_file(user_id, image_id, version, level, col, row, tile_format, quota_mb):
+    """Returns the path of a tile, generating its level if needed, or None.
+    Raises QuotaExceeded if the level would not fit into quota_mb."""
+    tile_info = get_tile_info(user_id, image_id)
+    if not tile_info or tile_info['version'] != version or tile_info['format'] != tile_format:
+        return None
+    if level > tile_info['max_level']:
+        return None
+    
+    tiles_dir = os.path.join(get_tiles_root(user_id, image_id), str(version))
+    if not tiles.level_ready(tiles_dir, level):
+        source_path = get_image_path(user_id, image_id)
+        ensure_storage_quota(user_id, tiles.estimate_bytes(os.path.getsize(source_path), tile_info['max_level'], level),
+                             quota_mb, keep=image_id)
+        written = tiles.ensure_level(source_path, tiles_dir, level, tile_format)
+        expiry_index.add_bytes(user_id, image_id, written)
+    
+    tile_path = tiles.tile_path(tiles_dir, level, col, row, tile_format)
+    if not os.path.exists(tile_path):
+        return None
+    expiry_index.touch(user_id, image_id)
+    return tile_path
+
+
+@app.route('/api/images/<image_id>/tiles/<int:version>/<int:level>/<int:col>_<int:row>.<tile_format>', methods=['GET'])
+@image_login_required
+def get_image_tile(image_id, version, level, col, row, tile_format):
+    """A single tile. Levels are generated on first access; tiles never change for a version."""
+    try:
+        tile_path = get_tile_file(get_user_id(), image_id, version, level, col, row, tile_format,
+                                  get_workspace_quota_mb(get_user_id()))
+        if not tile_path:
+            return jsonify({'error': 'Tile not found'}), 404
+        
+        response = send_file(tile_path, mimetype=EXPORT_FORMATS[tile_format][1])
+        response.headers['Cache-Control'] = TILE_CACHE_CONTROL
+        return response
+        
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/<image_id>/thumbnail', methods=['GET'])
+@image_login_required
 def get_image_thumbnail(image_id):
     """Get thumbnail of an image"""
     try:
-        folder = get_user_upload_folder(get_user_id())
+        folder = get_user_upload_folder(get_user_id(), create=False)
         thumb_path = os.path.join(folder, f'{image_id}_thumb.png')
         
         if os.path.exists(thumb_path):
+            expiry_index.touch(get_user_id(), image_id)
             return send_file(thumb_path, mimetype='image/png')
         
         return jsonify({'error': 'Thumbnail not found'}), 404
@@ -646,9 +1845,12 @@ def get_image_thumbnail(image_id):
 @app.route('/api/images/<image_id>/original', methods=['GET'])
 @optional_login_required
 def get_image_original(image_id):
-    """Get original image (als Base64)"""
+    """Get original image (als Base64), at the size it was uploaded with"""
     try:
-        img = load_image_from_disk(get_user_id(), image_id, is_original=True)
+        metadata = load_user_metadata(get_user_id())
+        image_info = next((i for i in metadata['images'] if i['id'] == image_id), None)
+        img = load_image_from_disk(get_user_id(), image_id, is_original=True,
+                                   max_dimension=image_info.get('max_dimension') if image_info else None)
         if not img:
             return jsonify({'error': 'Original not found'}), 404
         
@@ -680,14 +1882,12 @@ def update_image(image_id):
         if not image_info:
             return jsonify({'error': 'Image not found'}), 404
         
-        # Save new image
+        # Save new image (pixels from the client: kept as a snapshot in the history)
         img = base64_to_image(image_data)
-        save_image_to_disk(get_user_id(), image_id, img, is_original=False)
-        save_thumbnail_to_disk(get_user_id(), image_id, img)
+        store_processed_image(get_user_id(), image_id, img, metadata, get_workspace_quota_mb(get_user_id()),
+                              step=history.pixels_step())
         
         # Update metadata
-        image_info['width'] = img.width
-        image_info['height'] = img.height
         image_info['updated_at'] = datetime.now().isoformat()
         save_user_metadata(get_user_id(), metadata)
         
@@ -698,6 +1898,8 @@ def update_image(image_id):
             'height': img.height
         })
         
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -705,54 +1907,134 @@ def update_image(image_id):
 @app.route('/api/images/<image_id>/reset', methods=['POST'])
 @optional_login_required
 def reset_image(image_id):
-    """Reset image to original"""
+    """Reset image to original (scaled down again if it was uploaded with a max_dimension)"""
     try:
+        metadata = load_user_metadata(get_user_id())
+        image_info = next((img for img in metadata['images'] if img['id'] == image_id), None)
+        
         # Load original
-        original = load_image_from_disk(get_user_id(), image_id, is_original=True)
+        original = load_image_from_disk(get_user_id(), image_id, is_original=True,
+                                        max_dimension=image_info.get('max_dimension') if image_info else None)
         if not original:
             return jsonify({'error': 'Original not found'}), 404
         
-        # Save as current image
-        save_image_to_disk(get_user_id(), image_id, original, is_original=False)
-        save_thumbnail_to_disk(get_user_id(), image_id, original)
+        # Save as current image (undo goes back to the version before the reset)
+        store_processed_image(get_user_id(), image_id, original, metadata, get_workspace_quota_mb(get_user_id()),
+                              step=history.original_step())
         
         # Update metadata
-        metadata = load_user_metadata(get_user_id())
-        image_info = next((img for img in metadata['images'] if img['id'] == image_id), None)
         if image_info:
-            image_info['width'] = original.width
-            image_info['height'] = original.height
             image_info['updated_at'] = datetime.now().isoformat()
             save_user_metadata(get_user_id(), metadata)
         
         return jsonify({
             'success': True,
-            'image': image_to_base64(original),
+            **image_payload(get_user_id(), image_id, original, image_info),
             'width': original.width,
             'height': original.height
         })
         
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/images/<image_id>', methods=['DELETE'])
+@app.route('/api/images/<image_id>/history', methods=['GET'])
 @optional_login_required
-def delete_image(image_id):
-    """Delete image"""
+def get_image_history(image_id):
+    """Undo/redo steps of an image"""
     try:
-        # Delete files
-        delete_image_from_disk(get_user_id(), image_id)
+        metadata = load_user_metadata(get_user_id())
+        if not any(img['id'] == image_id for img in metadata['images']):
+            return jsonify({'error': 'Image not found'}), 404
         
-        # Update metadata
+        image_history = history.load(get_history_dir(get_user_id(), image_id))
+        return jsonify({'success': True, 'history': history.summary(image_history)})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/<image_id>/stats', methods=['GET'])
+@optional_login_required
+def get_image_stats(image_id):
+    """Statistics of the current version of an image (histograms, entropy and edge maps)"""
+    try:
         metadata = load_user_metadata(get_user_id())
-        metadata['images'] = [img for img in metadata['images'] if img['id'] != image_id]
+        if not any(img['id'] == image_id for img in metadata['images']):
+            return jsonify({'error': 'Image not found'}), 404
         
-        # If deleted image was current, select new one
-        if metadata.get('current_id') == image_id:
-            metadata['current_id'] = metadata['images'][0]['id'] if metadata['images'] else None
+        image_stats = load_image_stats(get_user_id(), image_id, get_workspace_quota_mb(get_user_id()))
+        if image_stats is None:
+            return jsonify({'error': 'Image not found'}), 404
+        return jsonify({'success': True, 'stats': image_stats})
         
-        save_user_metadata(get_user_id(), metadata)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def move_in_history(image_id, offset):
+    """Restores the version offset steps back (negative) or forward in the history"""
+    user_id = get_user_id()
+    metadata = load_user_metadata(user_id)
+    image_info = next((img for img in metadata['images'] if img['id'] == image_id), None)
+    if not image_info:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    def load_original():
+        return load_image_from_disk(user_id, image_id, is_original=True,
+                                    max_dimension=image_info.get('max_dimension'))
+    
+    try:
+        img, image_history = history.move(get_history_dir(user_id, image_id), offset, load_original)
+    except history.HistoryError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    store_processed_image(user_id, image_id, img, metadata, get_workspace_quota_mb(user_id))
+    image_info['updated_at'] = datetime.now().isoformat()
+    save_user_metadata(user_id, metadata)
+    
+    return jsonify({
+        'success': True,
+        **image_payload(user_id, image_id, img, image_info),
+        'width': img.width,
+        'height': img.height,
+        'history': history.summary(image_history)
+    })
+
+
+@app.route('/api/images/<image_id>/undo', methods=['POST'])
+@optional_login_required
+def undo_image(image_id):
+    """Undo the last edit of an image"""
+    try:
+        return move_in_history(image_id, -1)
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/<image_id>/redo', methods=['POST'])
+@optional_login_required
+def redo_image(image_id):
+    """Redo an undone edit of an image"""
+    try:
+        return move_in_history(image_id, 1)
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/<image_id>', methods=['DELETE'])
+@optional_login_required
+def delete_image(image_id):
+    """Delete image"""
+    try:
+        # Delete files and update metadata
+        metadata = remove_image(get_user_id(), image_id)
         
         return jsonify({
             'success': True,
@@ -791,9 +2073,7 @@ def set_current_image():
 def clear_all_images():
     """Delete all images of the user"""
     try:
-        folder = get_user_upload_folder(get_user_id())
-        if os.path.exists(folder):
-            shutil.rmtree(folder)
+        remove_user_folder(get_user_id())
         
         return jsonify({'success': True})
         
@@ -801,6 +2081,169 @@ def clear_all_images():
         return jsonify({'error': str(e)}), 500
 
 
+# ==================== EVENTS ====================
+
+def publish_event(user_id, event_type, data):
+    """Publishes an event to the event streams of a user (see events.py)"""
+    try:
+        event_log.publish(user_id, event_type, data)
+    except Exception as e:
+        print(f"⚠️ Event {event_type} for user {user_id} not published: {e}")
+
+
+def new_batch_id(data):
+    """Id the progress of a batch is published under; the client may choose it to follow the batch"""
+    return str(data.get('batch_id') or uuid.uuid4().hex[:8])[:64]
+
+
+def publish_batch_progress(user_id, batch_id, done, total):
+    publish_event(user_id, 'batch', {'batch': batch_id, 'done': done, 'total': total})
+
+
+@app.route('/api/events', methods=['GET'])
+@optional_login_required
+def event_stream():
+    """Server-sent events of the current user, only served by asgi.py.
+    
+    A stream would park a Gunicorn thread for as long as the browser keeps
+    it open, so under WSGI the client is told to long-poll /api/events/poll
+    instead.
+    """
+    return jsonify({
+        'error': 'Event stream only available under Uvicorn',
+        'poll': url_for('poll_events')
+    }), 501
+
+
+@app.route('/api/events/poll', methods=['GET'])
+@optional_login_required
+def poll_events():
+    """Events of the current user after ?after=<id>, as JSON.
+    
+    'image' when an image was edited (size and version of its thumbnail),
+    'batch' after each image of a batch. Waits at most
+    EVENTS_LONG_POLL_SECONDS for the first event, so a waiting client only
+    holds a thread briefly. Without 'after' it answers at once with the id
+    to continue after.
+    """
+    user_id = get_user_id()
+    if 'after' not in request.args:
+        return jsonify({'success': True, 'events': [], 'last_id': event_log.last_id()})
+    try:
+        last_id = max(0, int(request.args['after']))
+    except ValueError:
+        return jsonify({'error': 'Invalid after'}), 400
+    
+    try:
+        poll_seconds = app.config['EVENTS_POLL_SECONDS']
+        deadline = time.monotonic() + app.config['EVENTS_LONG_POLL_SECONDS']
+        events = event_log.since(user_id, last_id)
+        while not events and time.monotonic() < deadline:
+            time.sleep(poll_seconds)
+            events = event_log.since(user_id, last_id)
+        
+        return jsonify({
+            'success': True,
+            'events': [{'id': event_id, 'type': event_type, 'data': json.loads(data)}
+                       for event_id, event_type, data in events],
+            'last_id': events[-1][0] if events else last_id
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ==================== SIMILAR IMAGES ====================
+
+def image_hashes(user_id, metadata):
+    """(image_id, dhash) of all images of a user in upload order.
+    
+    Images uploaded before hashes were kept are hashed from their thumbnail
+    (and the metadata saved).
+    """
+    folder = get_user_upload_folder(user_id, create=False)
+    added = False
+    for image_info in metadata['images']:
+        if image_info.get('dhash'):
+            continue
+        thumb_path = os.path.join(folder, f"{image_info['id']}_thumb.png")
+        try:
+            with Image.open(thumb_path) as thumb:
+                image_info['dhash'] = similarity.dhash(thumb)
+            added = True
+        except OSError:
+            pass
+    if added:
+        save_user_metadata(user_id, metadata)
+    return [(i['id'], i['dhash']) for i in metadata['images'] if i.get('dhash')]
+
+
+def requested_max_distance():
+    """Hamming distance from the max_distance query parameter (0-64). Raises ValueError."""
+    value = request.args.get('max_distance', app.config['SIMILARITY_MAX_DISTANCE'])
+    max_distance = int(value)
+    if not 0 <= max_distance <= 64:
+        raise ValueError('max_distance must be between 0 and 64')
+    return max_distance
+
+
+@app.route('/api/images/<image_id>/similar', methods=['GET'])
+@optional_login_required
+def get_similar_images(image_id):
+    """Images of the current user that look like this one (by perceptual hash)"""
+    try:
+        try:
+            max_distance = requested_max_distance()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        user_id = get_user_id()
+        metadata = load_user_metadata(user_id)
+        entries = image_hashes(user_id, metadata)
+        image_hash = dict(entries).get(image_id)
+        if image_hash is None:
+            return jsonify({'error': 'Image not found'}), 404
+        
+        filenames = {i['id']: i['filename'] for i in metadata['images']}
+        tree = similarity.index_for(user_id, entries)
+        similar = [
+            {'id': other_id, 'filename': filenames.get(other_id), 'distance': distance}
+            for distance, other_id in similarity.find_similar(tree, image_hash, max_distance)
+            if other_id != image_id
+        ]
+        return jsonify({'success': True, 'image_id': image_id, 'max_distance': max_distance, 'similar': similar})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/images/groups', methods=['GET'])
+@optional_login_required
+def get_image_groups():
+    """Groups of similar images of the current user (near-duplicates, burst shots)"""
+    try:
+        try:
+            max_distance = requested_max_distance()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        user_id = get_user_id()
+        metadata = load_user_metadata(user_id)
+        entries = image_hashes(user_id, metadata)
+        tree = similarity.index_for(user_id, entries)
+        images = {i['id']: i for i in metadata['images']}
+        groups = [
+            [{'id': image_id, 'filename': images[image_id]['filename'],
+              'width': images[image_id].get('width'), 'height': images[image_id].get('height')}
+             for image_id in members]
+            for members in similarity.group_similar(entries, tree, max_distance)
+        ]
+        return jsonify({'success': True, 'max_distance': max_distance, 'groups': groups})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # ==================== BILDBEARBEITUNG API ====================
 
 @app.route('/api/process', methods=['POST'])
@@ -819,6 +2262,10 @@ def process_image():
         
         if not operation:
             return jsonify({'error': 'No operation specified'}), 400
+        try:
+            resolve_params(operation, params)
+        except PipelineError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Load image - either by ID or Base64
         if image_id:
@@ -830,47 +2277,43 @@ def process_image():
         else:
             return jsonify({'error': 'No image provided'}), 400
         
+        # Automatic operations of stored images use their cached statistics
+        applied = (operation, params)
+        if image_id:
+            applied = resolve_auto_for_image(get_user_id(), image_id, operation, params,
+                                             get_workspace_quota_mb(get_user_id()), img)
+        
         # Apply operation
-        img = apply_operation_to_image(img, operation, params)
+        img = apply_operation_to_image(img, *applied)
         
         # If image_id present, save image to server
+        image_info = None
         if image_id:
-            save_image_to_disk(get_user_id(), image_id, img, is_original=False)
-            save_thumbnail_to_disk(get_user_id(), image_id, img)
-            
-            # Update metadata
             metadata = load_user_metadata(get_user_id())
-            image_info = next((i for i in metadata['images'] if i['id'] == image_id), None)
+            image_info = store_processed_image(get_user_id(), image_id, img, metadata,
+                                               get_workspace_quota_mb(get_user_id()),
+                                               step=history.operation_step(*applied, label=operation))
             if image_info:
-                image_info['width'] = img.width
-                image_info['height'] = img.height
                 save_user_metadata(get_user_id(), metadata)
         
         response_data = {
             'success': True,
-            'image': image_to_base64(img),
+            **image_payload(get_user_id(), image_id, img, image_info),
             'width': img.width,
             'height': img.height
         }
+        if operation in AUTO_OPERATIONS and applied[0] != operation:
+            response_data['resolved'] = {'operation': applied[0], 'params': applied[1]}
         
         if operation == 'resize_max_size':
-            format_type = params.get('format', 'jpeg').upper()
-            quality = int(params.get('quality', 85))
-            
-            buffer = io.BytesIO()
-            if format_type == 'PNG':
-                img.save(buffer, format='PNG')
-            else:
-                if img.mode == 'RGBA':
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[3])
-                    img = background
-                img.save(buffer, format=format_type, quality=quality)
-            
-            response_data['file_size_kb'] = buffer.tell() / 1024
+            # Same encoder settings as the operation uses for its size check
+            encoded, _ = encode_image(img, *max_size_encoding(params))
+            response_data['file_size_kb'] = len(encoded) / 1024
         
         return jsonify(response_data)
         
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -890,27 +2333,29 @@ def process_batch():
         
         if not operation:
             return jsonify({'error': 'No operation specified'}), 400
+        try:
+            resolve_params(operation, params)
+        except PipelineError as e:
+            return jsonify({'error': str(e)}), 400
         
         results = []
         metadata = load_user_metadata(get_user_id())
+        quota_mb = get_workspace_quota_mb(get_user_id())
+        batch_id = new_batch_id(data)
+        quota_error = None
         
-        for image_id in image_ids:
+        for done, image_id in enumerate(image_ids, 1):
             try:
                 img = load_image_from_disk(get_user_id(), image_id)
                 if not img:
                     continue
                 
-                img = apply_operation_to_image(img, operation, params)
-                
-                # Save image
-                save_image_to_disk(get_user_id(), image_id, img, is_original=False)
-                save_thumbnail_to_disk(get_user_id(), image_id, img)
+                applied = resolve_auto_for_image(get_user_id(), image_id, operation, params, quota_mb, img)
+                img = apply_operation_to_image(img, *applied)
                 
-                # Update metadata
-                image_info = next((i for i in metadata['images'] if i['id'] == image_id), None)
-                if image_info:
-                    image_info['width'] = img.width
-                    image_info['height'] = img.height
+                # Save image and update metadata
+                store_processed_image(get_user_id(), image_id, img, metadata, quota_mb,
+                                      step=history.operation_step(*applied, label=operation))
                 
                 results.append({
                     'id': image_id,
@@ -918,16 +2363,69 @@ def process_batch():
                     'height': img.height
                 })
                 
+            except QuotaExceeded as e:
+                # The following images would not fit either
+                quota_error = str(e)
+                break
             except Exception as e:
                 print(f"Error with image {image_id}: {e}")
                 continue
+            finally:
+                publish_batch_progress(get_user_id(), batch_id, done, len(image_ids))
         
         # Save metadata
         save_user_metadata(get_user_id(), metadata)
         
+        response_data = {
+            'success': quota_error is None,
+            'batch_id': batch_id,
+            'processed': len(results),
+            'total': len(image_ids),
+            'results': results
+        }
+        if quota_error:
+            return jsonify({'error': quota_error, **response_data}), 413
+        return jsonify(response_data)
+        
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/auto/resolve', methods=['POST'])
+@optional_login_required
+def resolve_auto_operations():
+    """Resolves an automatic operation (e.g. auto_crop) for stored images into the
+    plain operation and parameters it would apply, from cached statistics only."""
+    try:
+        data = request.get_json()
+        image_ids = data.get('image_ids') or ([data['image_id']] if data.get('image_id') else [])
+        operation = data.get('operation')
+        
+        if not image_ids:
+            return jsonify({'error': 'No images provided'}), 400
+        if operation not in AUTO_OPERATIONS:
+            return jsonify({'error': f"Not an automatic operation: {operation}"}), 400
+        try:
+            params = resolve_params(operation, data.get('params'))
+        except PipelineError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        metadata = load_user_metadata(get_user_id())
+        known_ids = {img['id'] for img in metadata['images']}
+        quota_mb = get_workspace_quota_mb(get_user_id())
+        results = []
+        for image_id in image_ids:
+            image_stats = load_image_stats(get_user_id(), image_id, quota_mb) if image_id in known_ids else None
+            if image_stats is None:
+                continue
+            resolved_operation, resolved_params = resolve_auto_operation(operation, params, image_stats)
+            results.append({'id': image_id, 'operation': resolved_operation, 'params': resolved_params})
+        
         return jsonify({
             'success': True,
-            'processed': len(results),
+            'resolved': len(results),
             'total': len(image_ids),
             'results': results
         })
@@ -936,6 +2434,644 @@ def process_batch():
         return jsonify({'error': str(e)}), 500
 
 
+def run_steps_on_images(image_ids, steps, save=True, step=None, batch_id=None):
+    """Runs compiled steps on stored images of the current user.
+    
+    Yields (image_id, img) for each processed image. Each image is decoded,
+    and if save is set encoded, only once. step is recorded for undo/redo.
+    An automatic operation at the start is resolved from the cached
+    statistics of each image and recorded as resolved. With batch_id,
+    progress events are published. QuotaExceeded stops the run.
+    """
+    metadata = load_user_metadata(get_user_id())
+    quota_mb = get_workspace_quota_mb(get_user_id())
+    
+    try:
+        for done, image_id in enumerate(image_ids, 1):
+            try:
+                img = load_image_from_disk(get_user_id(), image_id)
+                if not img:
+                    continue
+                
+                image_steps, image_step = steps, step
+                if steps and steps[0].operation in AUTO_OPERATIONS:
+                    image_stats = load_image_stats(get_user_id(), image_id, quota_mb) or \
+                        compute_stats(pillow_image(img))
+                    image_steps = resolve_auto_steps(steps, image_stats)
+                    if step is not None:
+                        image_step = history.with_resolved(step, steps[0].operation, image_steps[0])
+                
+                img = run_pipeline(img, image_steps)
+                if save:
+                    store_processed_image(get_user_id(), image_id, img, metadata, quota_mb, step=image_step)
+                yield image_id, img
+                
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                print(f"Error with image {image_id}: {e}")
+                continue
+            finally:
+                if batch_id:
+                    publish_batch_progress(get_user_id(), batch_id, done, len(image_ids))
+    finally:
+        # Also when stopped by QuotaExceeded: the images stored so far are kept
+        if save:
+            save_user_metadata(get_user_id(), metadata)
+
+
+def build_zip(entries):
+    """Builds a ZIP archive from (filename, bytes) pairs"""
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for filename, content in entries:
+            zip_file.writestr(filename, content)
+    zip_buffer.seek(0)
+    return zip_buffer
+
+
+class _ChunkWriter(io.RawIOBase):
+    """Write-only stream collecting what ZipFile writes, for streaming it out"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries):
+    """Yields a ZIP archive of (filename, bytes) pairs while the entries are produced"""
+    writer = _ChunkWriter()
+    # Stored: the entries are encoded images, deflate would not gain anything
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for filename, content in entries:
+            zip_file.writestr(filename, content)
+            yield writer.pop()
+    yield writer.pop()
+
+
+@app.route('/api/pipeline', methods=['POST'])
+@optional_login_required
+def process_pipeline():
+    """
+    Apply an ordered list of operations in one request.
+    Works on image_id, image_ids or a base64 image. If format is given, the
+    result is returned as a download (ZIP for several images) instead of
+    being saved.
+    """
+    try:
+        data = request.get_json()
+        
+        try:
+            steps = compile_operations(data.get('operations'))
+        except PipelineError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return pipeline_response(data, steps, history.pipeline_step(data['operations']))
+        
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def pipeline_response(data, steps, step=None):
+    """Runs compiled steps as requested by a pipeline or preset request (step: for undo/redo)"""
+    image_id = data.get('image_id')
+    image_ids = data.get('image_ids') or ([image_id] if image_id else [])
+    image_data = data.get('image')
+    format_type = data.get('format')
+    try:
+        quality = requested_quality(data, 95)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not image_ids and not image_data:
+        return jsonify({'error': 'No image provided'}), 400
+    
+    if format_type:
+        try:
+            export_options = get_export_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    
+    # Base64 image: nothing is stored
+    if not image_ids:
+        img = run_pipeline(base64_to_image(image_data), steps)
+        if format_type:
+            filename = data.get('filename', 'image')
+            encoded, mimetype, seconds = encode_export(img, format_type, quality, export_options)
+            response = send_file(
+                io.BytesIO(encoded),
+                mimetype=mimetype,
+                as_attachment=True,
+                download_name=f"{os.path.splitext(filename)[0]}_edited.{format_type.lower()}"
+            )
+            return add_export_headers(response, export_options['profile'], len(encoded), seconds)
+        return jsonify({
+            'success': True,
+            'image': image_to_base64(img),
+            'width': img.width,
+            'height': img.height
+        })
+    
+    # Export straight to a download format
+    if format_type:
+        metadata = load_user_metadata(get_user_id())
+        filenames = {i['id']: i['filename'] for i in metadata['images']}
+        entries = []
+        encode_seconds = 0
+        for processed_id, img in run_steps_on_images(image_ids, steps, save=False):
+            name_without_ext = os.path.splitext(filenames.get(processed_id, processed_id))[0]
+            encoded, mimetype, seconds = encode_export(img, format_type, quality, export_options)
+            encode_seconds += seconds
+            entries.append((f"{name_without_ext}_edited.{format_type.lower()}", encoded, mimetype))
+        
+        if not entries:
+            return jsonify({'error': 'Image not found'}), 404
+        output_bytes = sum(len(encoded) for _, encoded, _ in entries)
+        if len(image_ids) == 1:
+            download_name, encoded, mimetype = entries[0]
+            response = send_file(io.BytesIO(encoded), mimetype=mimetype,
+                                 as_attachment=True, download_name=download_name)
+        else:
+            response = send_file(
+                build_zip((name, encoded) for name, encoded, _ in entries),
+                mimetype='application/zip',
+                as_attachment=True,
+                download_name='images_edited.zip'
+            )
+        return add_export_headers(response, export_options['profile'], output_bytes, encode_seconds)
+    
+    results = []
+    batch_id = new_batch_id(data) if len(image_ids) > 1 else None
+    for processed_id, img in run_steps_on_images(image_ids, steps, step=step, batch_id=batch_id):
+        results.append({'id': processed_id, 'width': img.width, 'height': img.height})
+    
+    if image_id:
+        if not results:
+            return jsonify({'error': 'Image not found'}), 404
+        # After the loop, when the new version is saved in the metadata
+        return jsonify({'success': True, **results[0], **image_payload(get_user_id(), image_id, img)})
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'processed': len(results),
+        'total': len(image_ids),
+        'results': results
+    })
+
+
+# ==================== PRESETS API ====================
+
+def get_preset_plan(preset):
+    """Returns the compiled steps of a preset (cached per worker until it changes)"""
+    key = (preset.id, preset.updated_at.isoformat() if preset.updated_at else None)
+    return compile_cached(key, preset.operations)
+
+
+def get_visible_preset(preset_id):
+    """Returns a preset the current user may use, or None"""
+    preset = db.session.get(Preset, preset_id)
+    if not preset:
+        return None
+    if preset.is_shared or (current_user.is_authenticated and
+                            (preset.user_id == current_user.id or current_user.is_admin)):
+        return preset
+    return None
+
+
+def get_editable_preset(preset_id):
+    """Returns a preset the current user may change, or None"""
+    preset = db.session.get(Preset, preset_id)
+    if preset and current_user.is_authenticated and \
+            (preset.user_id == current_user.id or current_user.is_admin):
+        return preset
+    return None
+
+
+@app.route('/api/presets', methods=['GET'])
+@optional_login_required
+def get_presets():
+    """List own and shared presets"""
+    query = Preset.query.filter(Preset.is_shared.is_(True))
+    if current_user.is_authenticated:
+        query = Preset.query.filter(db.or_(Preset.is_shared.is_(True), Preset.user_id == current_user.id))
+    
+    return jsonify({
+        'success': True,
+        'presets': [preset.to_dict() for preset in query.order_by(Preset.name).all()]
+    })
+
+
+@app.route('/api/presets', methods=['POST'])
+@login_required
+def create_preset():
+    """Create new preset"""
+    data = request.get_json()
+    name = data.get('name', '').strip()
+    operations = data.get('operations')
+    ingest_max_dimension = data.get('ingest_max_dimension')
+    
+    if not name:
+        return jsonify({'error': 'Name is required'}), 400
+    
+    if ingest_max_dimension not in (None, '') and (not str(ingest_max_dimension).isdigit()):
+        return jsonify({'error': 'Max. upload size must be a non-negative number'}), 400
+    
+    try:
+        compile_operations(operations)
+    except PipelineError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    preset = Preset(
+        user_id=current_user.id,
+        name=name,
+        is_shared=bool(data.get('is_shared')) and current_user.is_admin,
+        ingest_max_dimension=int(ingest_max_dimension) if ingest_max_dimension not in (None, '') else None
+    )
+    preset.operations = operations
+    
+    db.session.add(preset)
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'preset': preset.to_dict()
+    })
+
+
+@app.route('/api/presets/<int:preset_id>', methods=['PUT'])
+@login_required
+def update_preset(preset_id):
+    """Update preset"""
+    preset = get_editable_preset(preset_id)
+    if not preset:
+        return jsonify({'error': 'Preset not found'}), 404
+    
+    data = request.get_json()
+    
+    if 'name' in data:
+        if not data['name'].strip():
+            return jsonify({'error': 'Name is required'}), 400
+        preset.name = data['name'].strip()
+    
+    if 'operations' in data:
+        try:
+            compile_operations(data['operations'])
+        except PipelineError as e:
+            return jsonify({'error': str(e)}), 400
+        preset.operations = data['operations']
+    
+    if 'ingest_max_dimension' in data:
+        ingest_max_dimension = data['ingest_max_dimension']
+        if ingest_max_dimension in (None, ''):
+            preset.ingest_max_dimension = None
+        elif str(ingest_max_dimension).isdigit():
+            preset.ingest_max_dimension = int(ingest_max_dimension)
+        else:
+            return jsonify({'error': 'Max. upload size must be a non-negative number'}), 400
+    
+    if 'is_shared' in data and current_user.is_admin:
+        preset.is_shared = bool(data['is_shared'])
+    
+    db.session.commit()
+    
+    return jsonify({
+        'success': True,
+        'preset': preset.to_dict()
+    })
+
+
+@app.route('/api/presets/<int:preset_id>', methods=['DELETE'])
+@login_required
+def delete_preset(preset_id):
+    """Delete preset"""
+    preset = get_editable_preset(preset_id)
+    if not preset:
+        return jsonify({'error': 'Preset not found'}), 404
+    
+    db.session.delete(preset)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+
+@app.route('/api/presets/<int:preset_id>/apply', methods=['POST'])
+@optional_login_required
+def apply_preset(preset_id):
+    """Apply a preset to image_id, image_ids or a base64 image (like /api/pipeline)"""
+    try:
+        preset = get_visible_preset(preset_id)
+        if not preset:
+            return jsonify({'error': 'Preset not found'}), 404
+        
+        try:
+            steps = get_preset_plan(preset)
+        except PipelineError as e:
+            return jsonify({'error': f'Invalid preset: {e}'}), 400
+        
+        return pipeline_response(request.get_json() or {}, steps,
+                                 history.pipeline_step(preset.operations, label=preset.name))
+        
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ==================== EXPORTS API ====================
+
+@app.route('/api/formats', methods=['GET'])
+def get_formats():
+    """Export formats and profiles supported by this server"""
+    return jsonify({
+        'success': True,
+        'formats': [
+            {
+                'name': name,
+                'mimetype': EXPORT_FORMATS[name][1],
+                'background': name in SLOW_EXPORT_FORMATS
+            }
+            for name in get_available_export_formats()
+        ],
+        'profiles': list(EXPORT_PROFILES),
+        'default_profile': app.config['EXPORT_PROFILE']
+    })
+
+
+@app.route('/api/exports', methods=['POST'])
+@optional_login_required
+def create_export():
+    """
+    Start encoding stored images in the background.
+    Poll GET /api/exports/<job_id> and fetch the result from .../download.
+    Without image_ids all images of the user are exported.
+    """
+    try:
+        data = request.get_json() or {}
+        format_type = (data.get('format') or 'avif').lower()
+        try:
+            quality = requested_quality(data, 80)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        try:
+            export_options = get_export_options({**data, 'format': format_type})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        metadata = load_user_metadata(get_user_id())
+        image_ids = data.get('image_ids') or [i['id'] for i in metadata['images']]
+        filenames = {i['id']: i['filename'] for i in metadata['images']}
+        
+        items = []
+        for image_id in image_ids:
+            source = get_image_path(get_user_id(), image_id) if image_id in filenames else None
+            if source:
+                expiry_index.touch(get_user_id(), image_id)
+                items.append({'image_id': image_id, 'filename': filenames[image_id], 'source': source})
+        
+        if not items:
+            return jsonify({'error': 'Image not found'}), 404
+        
+        job = export_pool.start_job(get_user_export_folder(get_user_id()), items,
+                                    format_type, quality, export_options)
+        return jsonify({'success': True, 'job': job}), 202
+        
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def get_export_job(job_id):
+    """Loads an export job of the current user, or None"""
+    if not job_id.isalnum():
+        return None
+    return load_job(get_user_export_folder(get_user_id()), job_id)
+
+
+@app.route('/api/exports/<job_id>', methods=['GET'])
+@optional_login_required
+def get_export(job_id):
+    """Status of an export job"""
+    job = get_export_job(job_id)
+    if not job:
+        return jsonify({'error': 'Export not found'}), 404
+    return jsonify({'success': True, 'job': job})
+
+
+@app.route('/api/exports/<job_id>/download', methods=['GET'])
+@optional_login_required
+def download_export(job_id):
+    """Download the result of an export job (ZIP for several images)"""
+    try:
+        job = get_export_job(job_id)
+        if not job:
+            return jsonify({'error': 'Export not found'}), 404
+        if job['status'] == 'running':
+            return jsonify({'error': 'Export is still running', 'job': job}), 409
+        
+        export_dir = get_user_export_folder(get_user_id())
+        entries = []
+        for item in job['items']:
+            filepath = os.path.join(export_dir, item['file'])
+            if item['status'] == 'done' and os.path.exists(filepath):
+                name_without_ext = os.path.splitext(item['filename'])[0]
+                entries.append((f"{name_without_ext}_edited.{job['format']}", filepath))
+        
+        if not entries:
+            return jsonify({'error': 'Export failed or expired', 'job': job}), 410
+        
+        output_bytes = sum(os.path.getsize(filepath) for _, filepath in entries)
+        encode_seconds = sum(item.get('encode_ms', 0) for item in job['items']) / 1000
+        
+        if job['total'] == 1:
+            download_name, filepath = entries[0]
+            response = send_file(filepath, mimetype=EXPORT_FORMATS[job['format']][1],
+                                 as_attachment=True, download_name=download_name)
+        else:
+            zip_buffer = io.BytesIO()
+            # Encoded images do not compress any further
+            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+                for download_name, filepath in entries:
+                    zip_file.write(filepath, download_name)
+            zip_buffer.seek(0)
+            response = send_file(zip_buffer, mimetype='application/zip',
+                                 as_attachment=True, download_name='images_edited.zip')
+        return add_export_headers(response, job['profile'], output_bytes, encode_seconds)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def build_renditions(img, widths):
+    """Yields (width, image) from the largest to the smallest width.
+    
+    Each size is resized from the previous one instead of the full image, so
+    every step works on fewer pixels. Heights follow the original aspect
+    ratio; widths above the image width are left out (no upscaling).
+    """
+    original_width, original_height = img.size
+    current = img
+    for width in sorted({w for w in widths if w <= original_width} or {original_width}, reverse=True):
+        height = max(1, round(original_height * width / original_width))
+        if current.size != (width, height):
+            current = apply_operation_to_image(current, 'resize',
+                                               {'width': width, 'height': height, 'keep_aspect': False})
+        yield width, current
+
+
+def rendition_entries(sources, widths, formats, quality, export_options, held=False):
+    """Yields the ZIP entries of the renditions of each (name, load_image) source as
+    one list, so only one image's renditions are held at a time; the manifest last.
+    held: see encode_export."""
+    manifest = {
+        'quality': quality,
+        'profile': export_options['profile'],
+        'images': []
+    }
+    
+    for name, load in sources:
+        try:
+            img = load()
+            if img is None:
+                continue
+        except Exception as e:
+            print(f"Error with image {name}: {e}")
+            continue
+        
+        image_entry = {'name': name, 'width': img.width, 'height': img.height, 'renditions': []}
+        
+        # Encoding runs in the background while the next size is resized
+        futures = []
+        for width, rendition in build_renditions(img, widths):
+            for index, format_type in enumerate(formats):
+                filename = f"{name}-{width}w.{format_type}"
+                # save() stores its settings on the image, so parallel encodes need their own object
+                source = rendition if index == 0 else rendition.copy()
+                future = rendition_executor.submit(encode_export, source, format_type, quality, export_options, held)
+                futures.append((filename, width, rendition.height, format_type, future))
+        
+        entries = []
+        for filename, width, height, format_type, future in futures:
+            encoded, _, seconds = future.result()
+            image_entry['renditions'].append({
+                'file': filename,
+                'format': format_type,
+                'width': width,
+                'height': height,
+                'bytes': len(encoded),
+                'sha256': hashlib.sha256(encoded).hexdigest(),
+                'encode_ms': round(seconds * 1000, 1)
+            })
+            entries.append((filename, encoded))
+        
+        manifest['images'].append(image_entry)
+        yield entries
+    
+    yield [('manifest.json', json.dumps(manifest, indent=2).encode())]
+
+
+@app.route('/api/renditions', methods=['POST'])
+@optional_login_required
+def export_renditions():
+    """
+    Export images at several widths (e.g. for srcset) as a ZIP.
+    Works on image_id, image_ids or a base64 image. The ZIP contains
+    <name>-<width>w.<format> for every width and format plus manifest.json
+    (width, height, bytes and SHA-256 of every file).
+    """
+    try:
+        data = request.get_json() or {}
+        try:
+            quality = requested_quality(data, 85)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        formats = [f.lower() for f in (data.get('formats') or [data.get('format') or 'webp'])]
+        
+        try:
+            widths = sorted({int(w) for w in data.get('widths') or []}, reverse=True)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'widths must be a list of numbers'}), 400
+        if not widths or widths[-1] <= 0 or len(widths) > MAX_RENDITION_WIDTHS:
+            return jsonify({'error': f'Specify 1 to {MAX_RENDITION_WIDTHS} positive widths'}), 400
+        
+        try:
+            export_options = None
+            for format_type in formats:
+                export_options = get_export_options({**data, 'format': format_type})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        user_id = get_user_id()
+        image_id = data.get('image_id')
+        image_ids = data.get('image_ids') or ([image_id] if image_id else [])
+        image_data = data.get('image')
+        
+        if image_ids:
+            metadata = load_user_metadata(user_id)
+            filenames = {i['id']: i['filename'] for i in metadata['images']}
+            sources = [
+                (os.path.splitext(filenames[i])[0], lambda i=i: load_image_from_disk(user_id, i))
+                for i in image_ids if i in filenames
+            ]
+            if not sources:
+                return jsonify({'error': 'Image not found'}), 404
+        elif image_data:
+            name = os.path.splitext(data.get('filename', 'image'))[0]
+            sources = [(name, lambda: base64_to_image(image_data))]
+        else:
+            return jsonify({'error': 'No image provided'}), 400
+        
+        # Room on the export pool for the slow encodes of one image (they run
+        # together) is reserved for the whole response, and the first image is
+        # encoded before it starts: once the status is sent, an error could
+        # only cut the ZIP short. The other images follow one at a time.
+        release = export_pool.hold(len(widths) * sum(f in SLOW_EXPORT_FORMATS for f in formats))
+        try:
+            images = rendition_entries(sources, widths, formats, quality, export_options, held=True)
+            first = next(images)
+        except BaseException:
+            release()
+            raise
+        
+        def entries():
+            try:
+                yield from first
+                for image_entries in images:
+                    yield from image_entries
+            finally:
+                release()
+        
+        return Response(
+            stream_zip(entries()),
+            mimetype='application/zip',
+            headers={'Content-Disposition': 'attachment; filename=renditions.zip'}
+        )
+        
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/api/create_thumbnail', methods=['POST'])
 @optional_login_required
 def create_thumbnail():
@@ -951,7 +3087,7 @@ def create_thumbnail():
         original_width = img.width
         original_height = img.height
         
-        thumb = img.copy()
+        thumb = pillow_image(img).copy()
         thumb.thumbnail((150, 150), Image.Resampling.LANCZOS)
         
         return jsonify({
@@ -974,43 +3110,36 @@ def download_image():
         image_data = data.get('image')
         filename = data.get('filename', 'image')
         format_type = data.get('format', 'png').lower()
-        quality = int(data.get('quality', 95))
+        try:
+            quality = requested_quality(data, 95)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if not image_data:
             return jsonify({'error': 'No image provided'}), 400
         
+        try:
+            export_options = get_export_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         img = base64_to_image(image_data)
         
         name_without_ext = os.path.splitext(filename)[0]
         new_filename = f"{name_without_ext}_edited.{format_type}"
         
-        img_bytes = io.BytesIO()
-        
-        if format_type in ('jpeg', 'jpg'):
-            if img.mode == 'RGBA':
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3])
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            img.save(img_bytes, format='JPEG', quality=quality)
-            mimetype = 'image/jpeg'
-        elif format_type == 'webp':
-            img.save(img_bytes, format='WEBP', quality=quality)
-            mimetype = 'image/webp'
-        else:
-            img.save(img_bytes, format='PNG')
-            mimetype = 'image/png'
-        
-        img_bytes.seek(0)
+        encoded, mimetype, seconds = encode_export(img, format_type, quality, export_options)
         
-        return send_file(
-            img_bytes,
+        response = send_file(
+            io.BytesIO(encoded),
             mimetype=mimetype,
             as_attachment=True,
             download_name=new_filename
         )
+        return add_export_headers(response, export_options['profile'], len(encoded), seconds)
         
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1023,11 +3152,21 @@ def download_zip():
         data = request.get_json()
         images = data.get('images', [])
         format_type = data.get('format', 'png').lower()
-        quality = int(data.get('quality', 95))
+        try:
+            quality = requested_quality(data, 95)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if not images:
             return jsonify({'error': 'No images provided'}), 400
         
+        try:
+            export_options = get_export_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        output_bytes = 0
+        encode_seconds = 0
         zip_buffer = io.BytesIO()
         
         with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
@@ -1044,37 +3183,29 @@ def download_zip():
                     name_without_ext = os.path.splitext(filename)[0]
                     new_filename = f"{name_without_ext}_edited.{format_type}"
                     
-                    img_bytes = io.BytesIO()
-                    
-                    if format_type in ('jpeg', 'jpg'):
-                        if img.mode == 'RGBA':
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            background.paste(img, mask=img.split()[3])
-                            img = background
-                        elif img.mode != 'RGB':
-                            img = img.convert('RGB')
-                        img.save(img_bytes, format='JPEG', quality=quality)
-                    elif format_type == 'webp':
-                        img.save(img_bytes, format='WEBP', quality=quality)
-                    else:
-                        img.save(img_bytes, format='PNG')
-                    
-                    img_bytes.seek(0)
-                    zip_file.writestr(new_filename, img_bytes.getvalue())
+                    encoded, _, seconds = encode_export(img, format_type, quality, export_options)
+                    output_bytes += len(encoded)
+                    encode_seconds += seconds
+                    zip_file.writestr(new_filename, encoded)
                     
+                except ExportBusy:
+                    raise
                 except Exception as e:
                     print(f"Error with image {img_item.get('filename')}: {e}")
                     continue
         
         zip_buffer.seek(0)
         
-        return send_file(
+        response = send_file(
             zip_buffer,
             mimetype='application/zip',
             as_attachment=True,
             download_name='images_edited.zip'
         )
+        return add_export_headers(response, export_options['profile'], output_bytes, encode_seconds)
         
+    except ExportBusy as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -0,0 +1,425 @@
+"""
+Bildwerkzeug - ASGI entry point
+
+Serves the app on an event loop: uvicorn asgi:app. Thumbnails, tiles, the
+image list, upload chunks and the event stream are answered here directly,
+with file access and tile generation offloaded to threads. All other requests run in the
+Flask app on a bounded thread pool, but the request body is read before and
+the response is sent after the app runs, so slow clients uploading or
+downloading large files only cost a connection, not a thread.
+"""
+
+import asyncio
+import contextvars
+import io
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from flask import json
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie, parse_etags, quote_etag
+
+import resumable
+from app import (
+    app as flask_app, expiry_index, get_user_upload_folder, load_user_metadata, get_tile_file, get_workspace_quota_mb,
+    upload_payload, upload_headers, init_worker, QuotaExceeded, listing_etag, listing_page, event_log, shard_ring, shard_for_user,
+    lock_workspace, session_protection_passed,
+    EVENT_STREAM_HEADERS, EVENTS_HEARTBEAT_SECONDS, LISTING_CACHE_CONTROL, TILE_CACHE_CONTROL
+)
+from events import HEARTBEAT, format_event, start_event_id
+from imaging import EXPORT_FORMATS
+from models import user_cache
+from sharding import WorkspaceMoving
+
+
+# Runs Flask requests (and with them the image processing)
+app_executor = ThreadPoolExecutor(max_workers=flask_app.config['ASGI_THREADS'], thread_name_prefix='flask')
+
+# Responses of the Flask app are sent in pieces of about this size
+SEND_CHUNK_SIZE = 256 * 1024
+
+# Request bodies up to this size are kept in memory, larger ones in a temporary file
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    """Raised when a request body exceeds MAX_CONTENT_LENGTH"""
+
+
+# ==================== HELPERS ====================
+
+def get_headers(scope):
+    """Request headers as a dict with lowercase names"""
+    headers = {}
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return headers
+
+
+async def read_body(receive, limit):
+    """Reads the request body into a spooled temporary file"""
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            raise ConnectionError('Client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if limit is not None and size > limit:
+            body.close()
+            raise BodyTooLarge()
+        body.write(chunk)
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+async def send_response(send, status, body=b'', content_type='application/json', headers=None):
+    """Sends a complete response"""
+    header_list = [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+    for name, value in (headers or {}).items():
+        header_list.append((name.lower().encode(), str(value).encode('latin1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': header_list})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200, headers=None):
+    await send_response(send, status, json.dumps(data).encode(), headers=headers)
+
+
+async def send_file(send, headers, path, mimetype, cache_control='no-cache'):
+    """Sends a small file, answering If-None-Match with 304"""
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except OSError:
+        return False
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    response_headers = {'Cache-Control': cache_control, 'ETag': etag}
+    if headers.get('if-none-match') == etag:
+        await send({'type': 'http.response.start', 'status': 304,
+                    'headers': [(name.lower().encode(), value.encode()) for name, value in response_headers.items()]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return True
+
+    def read():
+        with open(path, 'rb') as f:
+            return f.read()
+    try:
+        data = await asyncio.to_thread(read)
+    except OSError:
+        return False
+    await send_response(send, 200, data, mimetype, response_headers)
+    return True
+
+
+def _user_exists(user_id):
+    with flask_app.app_context():
+        return user_cache.load(user_id) is not None
+
+
+def _workspace_quota_mb(user_id):
+    with flask_app.app_context():
+        return get_workspace_quota_mb(user_id)
+
+
+async def session_user_id(scope, headers):
+    """The user ID Flask would use for this request, or None if only Flask can tell.
+
+    Reads the signed Flask session cookie: the logged-in user if the session
+    passes Flask-Login's session protection, or the anonymous session when
+    login is optional.
+    """
+    cookie = parse_cookie(headers.get('cookie', '')).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        session = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+
+    if session.get('_user_id'):
+        try:
+            user_id = int(session['_user_id'])
+        except ValueError:
+            return None
+        # Same identifier check as Flask-Login, on a request context without a body
+        with flask_app.request_context(build_environ(scope, headers, io.BytesIO())):
+            if not session_protection_passed(session):
+                return None
+        if user_cache.get(user_id) is not None:
+            return user_id
+        return user_id if await asyncio.to_thread(_user_exists, user_id) else None
+    if not flask_app.config['LOGIN_REQUIRED'] and session.get('anonymous_id'):
+        return f"anon_{session['anonymous_id']}"
+    return None
+
+
+# ==================== FAST PATH ====================
+
+async def list_images(receive, send, headers, query, user_id):
+    """GET /api/images (see app.get_images)"""
+    metadata = await asyncio.to_thread(load_user_metadata, user_id)
+    await asyncio.to_thread(expiry_index.touch_user, user_id)
+    response_headers = {'Cache-Control': LISTING_CACHE_CONTROL, 'ETag': quote_etag(listing_etag(metadata))}
+    if parse_etags(headers.get('if-none-match')).contains(listing_etag(metadata)):
+        return await send_response(send, 304, headers=response_headers)
+    try:
+        limit = int(query['limit']) if query.get('limit') else None
+    except ValueError:
+        limit = None
+    try:
+        payload = listing_page(metadata, limit, query.get('cursor'))
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+    await send_json(send, payload, headers=response_headers)
+
+
+async def image_thumbnail(receive, send, headers, query, user_id, image_id):
+    """GET /api/images/<image_id>/thumbnail"""
+    folder = get_user_upload_folder(user_id, create=False)
+    if await send_file(send, headers, os.path.join(folder, f'{image_id}_thumb.png'), 'image/png'):
+        await asyncio.to_thread(expiry_index.touch, user_id, image_id)
+    else:
+        await send_json(send, {'error': 'Thumbnail not found'}, 404)
+
+
+async def image_tile(receive, send, headers, query, user_id, image_id, version, level, col, row, tile_format):
+    """GET /api/images/<image_id>/tiles/<version>/<level>/<col>_<row>.<format>"""
+    if tile_format not in ('jpeg', 'png'):
+        return await send_json(send, {'error': 'Tile not found'}, 404)
+    # Cutting a level is CPU work, it shares the pool with the Flask requests
+    loop = asyncio.get_running_loop()
+    quota_mb = await asyncio.to_thread(_workspace_quota_mb, user_id)
+    try:
+        tile_path = await loop.run_in_executor(
+            app_executor, get_tile_file, user_id, image_id, int(version), int(level), int(col), int(row), tile_format,
+            quota_mb
+        )
+    except QuotaExceeded as e:
+        return await send_json(send, {'error': str(e)}, 413)
+    if not tile_path or not await send_file(send, headers, tile_path, EXPORT_FORMATS[tile_format][1],
+                                            TILE_CACHE_CONTROL):
+        await send_json(send, {'error': 'Tile not found'}, 404)
+
+
+async def upload_chunk(receive, send, headers, query, user_id, upload_id):
+    """PATCH /api/uploads/<upload_id> (see app.patch_upload)"""
+    try:
+        offset = int(headers['upload-offset'])
+    except (KeyError, ValueError):
+        return await send_json(send, {'error': 'Upload-Offset header required'}, 400)
+
+    folder = get_user_upload_folder(user_id, create=False)
+    try:
+        checksum = resumable.parse_checksum(headers.get('upload-checksum'))
+        body = await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH'])
+        try:
+            await asyncio.to_thread(resumable.append_chunk, folder, upload_id, offset, body, checksum)
+        finally:
+            body.close()
+        state = await asyncio.to_thread(resumable.load_upload, folder, upload_id)
+    except resumable.UploadError as e:
+        return await send_json(send, {'error': str(e)}, e.status)
+    except BodyTooLarge:
+        return await send_json(send, {'error': 'Chunk too large'}, 413)
+
+    await send_json(send, upload_payload(state), headers=upload_headers(state))
+
+
+async def event_stream(receive, send, headers, query, user_id):
+    """GET /api/events: the events of app.poll_events as a stream that stays open until the client disconnects"""
+    last_event_id = headers.get('last-event-id', query.get('last_event_id'))
+    last_id = await asyncio.to_thread(start_event_id, event_log, last_event_id)
+    poll_seconds = flask_app.config['EVENTS_POLL_SECONDS']
+    response_headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+    response_headers += [(name.lower().encode(), value.encode()) for name, value in EVENT_STREAM_HEADERS.items()]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': b'retry: 1000\n\n', 'more_body': True})
+
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    loop = asyncio.get_running_loop()
+    idle_since = loop.time()
+    try:
+        while not disconnected.done():
+            events = await asyncio.to_thread(event_log.since, user_id, last_id)
+            chunk = ''.join(format_event(*event) for event in events)
+            if events:
+                last_id = events[-1][0]
+            elif loop.time() - idle_since > EVENTS_HEARTBEAT_SECONDS:
+                chunk = HEARTBEAT
+            if chunk:
+                idle_since = loop.time()
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+            await asyncio.wait([disconnected], timeout=poll_seconds)
+    finally:
+        disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+# (method, path pattern, handler); handlers get receive, send, headers, query arguments, user_id and the path parameters
+FAST_ROUTES = [
+    ('GET', re.compile(r'/api/images'), list_images),
+    ('GET', re.compile(r'/api/images/(?P<image_id>[\w-]+)/thumbnail'), image_thumbnail),
+    ('GET', re.compile(r'/api/images/(?P<image_id>[\w-]+)/tiles/(?P<version>\d+)/(?P<level>\d+)/'
+                       r'(?P<col>\d+)_(?P<row>\d+)\.(?P<tile_format>\w+)'), image_tile),
+    ('PATCH', re.compile(r'/api/uploads/(?P<upload_id>\w+)'), upload_chunk),
+    ('GET', re.compile(r'/api/events'), event_stream),
+]
+
+
+# ==================== FLASK BRIDGE ====================
+
+def build_environ(scope, headers, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The whole body has been read, also for chunked requests
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers.items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        environ[key] = value
+    return environ
+
+
+def _next_chunk(iterator):
+    """Collects about SEND_CHUNK_SIZE bytes of a response. Returns (data, more)."""
+    chunks = []
+    size = 0
+    for chunk in iterator:
+        if chunk:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= SEND_CHUNK_SIZE:
+                return b''.join(chunks), True
+    return b''.join(chunks), False
+
+
+async def call_flask(scope, receive, send, headers):
+    """Runs a request through the Flask app on the thread pool"""
+    # Workspaces moved between nodes can be larger than an upload (the signature is checked by Flask)
+    limit = None if scope['path'].startswith('/internal/') else flask_app.config['MAX_CONTENT_LENGTH']
+    try:
+        body = await read_body(receive, limit)
+    except BodyTooLarge:
+        return await send_json(send, {'error': 'Request too large'}, 413)
+
+    loop = asyncio.get_running_loop()
+    # One context per request: generators of stream_with_context may resume on other threads
+    context = contextvars.Context()
+    response_start = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                     for name, value in response_headers]
+
+    def run(func, *args):
+        return loop.run_in_executor(app_executor, context.run, func, *args)
+
+    with body:
+        iterable = await run(flask_app, build_environ(scope, headers, body), start_response)
+        try:
+            iterator = iter(iterable)
+            data, more = await run(_next_chunk, iterator)
+            await send({'type': 'http.response.start', **response_start})
+            while more:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                data, more = await run(_next_chunk, iterator)
+            await send({'type': 'http.response.body', 'body': data})
+        finally:
+            if hasattr(iterable, 'close'):
+                await run(iterable.close)
+
+
+# ==================== APPLICATION ====================
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            init_worker()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            app_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application: fast path for the I/O-bound endpoints, Flask for the rest"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    headers = get_headers(scope)
+    try:
+        for method, pattern, handler in FAST_ROUTES:
+            if scope['method'] != method:
+                continue
+            match = pattern.fullmatch(scope['path'])
+            if not match:
+                continue
+            # Requests the fast path cannot authenticate (no or expired session) get Flask's answer
+            user_id = await session_user_id(scope, headers)
+            if user_id is None:
+                break
+            # Users of another node get Flask's answer (421 or a redirect)
+            if shard_ring is not None and \
+                    await asyncio.to_thread(shard_for_user, user_id) != flask_app.config['SHARD_SELF']:
+                break
+            # Writes hold the workspace lock; while it is being moved Flask answers 503
+            try:
+                lock_file = None if method == 'GET' else await asyncio.to_thread(lock_workspace, user_id)
+            except WorkspaceMoving:
+                break
+            query = dict(parse_qsl(scope['query_string'].decode('latin1')))
+            try:
+                return await handler(receive, send, headers, query, user_id, **match.groupdict())
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+        
+        await call_flask(scope, receive, send, headers)
+    except ConnectionError:
+        # Client went away while sending the body, nobody to answer
+        pass
+
+
+app = application
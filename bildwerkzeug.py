@@ -0,0 +1,592 @@
+"""
+Bildwerkzeug - Command line interface
+
+Bulk processing without the web layer:
+
+    python -m bildwerkzeug process INPUT_DIR OUTPUT_DIR --op resize:width=1920,height=1080 --format webp
+    python -m bildwerkzeug process INPUT_DIR OUTPUT_DIR --preset 3 --watch
+    python -m bildwerkzeug bench photo.jpg --formats webp,avif,jxl
+    python -m bildwerkzeug bench-depth scan16.tif
+    python -m bildwerkzeug rebalance --nodes a=http://10.0.0.1:5000,b=http://10.0.0.2:5000 --self a
+    python -m bildwerkzeug loadtest http://127.0.0.1:5000 --users 8 --serve "gunicorn -c gunicorn.conf.py app:app"
+
+Already processed images are skipped using a manifest in the output folder
+(modification time and size first, content hash if those changed).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from imaging import (
+    open_image, pillow_image, apply_operation_to_image, encode_image_timed, available_export_formats,
+    EXPORT_FORMATS, EXPORT_PROFILES
+)
+from pipeline import compile_operations, run_pipeline, PipelineError
+
+
+INPUT_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff'}
+MANIFEST_NAME = '.bildwerkzeug-manifest.json'
+
+
+# ==================== OPERATIONS ====================
+
+def parse_op(text):
+    """Parses 'name:key=value,key=value' into {operation, params}"""
+    name, _, param_text = text.partition(':')
+    params = {}
+    for pair in filter(None, param_text.split(',')):
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f'Invalid parameter {pair!r} (expected key=value)')
+        params[key.strip()] = value.strip()
+    return {'operation': name.strip(), 'params': params}
+
+
+def load_preset_operations(preset_id):
+    """Loads the operations of a preset from the database configured in config.py"""
+    from flask import Flask
+    from config import get_config
+    from models import db, Preset
+
+    app = Flask(__name__)
+    app.config.from_object(get_config())
+    db.init_app(app)
+    with app.app_context():
+        preset = db.session.get(Preset, preset_id)
+        if not preset:
+            raise SystemExit(f'Preset {preset_id} not found')
+        return preset.operations
+
+
+# ==================== MANIFEST ====================
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def plan_fingerprint(operations, format_type, quality, profile):
+    """Identifies the processing settings, so changed settings reprocess everything"""
+    text = json.dumps([operations, format_type, quality, profile], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def iter_input_files(input_dir, settle_seconds=0):
+    """Yields (relative path, stat) of all images below input_dir, lazily"""
+    now = time.time()
+    stack = [input_dir]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in INPUT_EXTENSIONS:
+                    stat = entry.stat()
+                    # Files that are still being written are picked up next time
+                    if settle_seconds and now - stat.st_mtime < settle_seconds:
+                        continue
+                    yield os.path.relpath(entry.path, input_dir), stat
+
+
+def output_path_for(output_dir, relpath, format_type):
+    return os.path.join(output_dir, os.path.splitext(relpath)[0] + '.' + format_type)
+
+
+# ==================== WORKER ====================
+
+def process_file(task):
+    """Processes one file (runs in a pool worker). Returns a result dict."""
+    input_path, output_path, steps, format_type, quality, profile, known_hash = task
+    started = time.perf_counter()
+    try:
+        with open(input_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        if digest == known_hash and os.path.exists(output_path):
+            return {'status': 'unchanged', 'sha256': digest, 'in_bytes': len(data), 'out_bytes': 0,
+                    'encode_seconds': 0}
+
+        img = run_pipeline(open_image(data), steps)
+        encoded, _, encode_seconds = encode_image_timed(img, format_type, quality, profile)
+
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_path, output_path)
+
+        return {
+            'status': 'processed',
+            'sha256': digest,
+            'in_bytes': len(data),
+            'out_bytes': len(encoded),
+            'encode_seconds': encode_seconds,
+            'seconds': time.perf_counter() - started
+        }
+    except Exception as e:
+        return {'status': 'error', 'error': str(e), 'in_bytes': 0, 'out_bytes': 0, 'encode_seconds': 0}
+
+
+def _run_task(args):
+    relpath, stat, task = args
+    return relpath, stat, process_file(task)
+
+
+# ==================== PROCESS COMMAND ====================
+
+def process_directory(pool, args, steps, fingerprint, manifest):
+    """Processes all new or changed images once. Returns counters."""
+    counts = {'processed': 0, 'unchanged': 0, 'skipped': 0, 'error': 0, 'in_bytes': 0, 'out_bytes': 0,
+              'encode_seconds': 0}
+
+    def tasks():
+        for relpath, stat in iter_input_files(args.input, settle_seconds=args.settle if args.watch else 0):
+            entry = manifest.get(relpath)
+            output_path = output_path_for(args.output, relpath, args.format)
+            if not args.force and entry and entry.get('plan') == fingerprint:
+                if entry.get('mtime') == stat.st_mtime and entry.get('size') == stat.st_size \
+                        and os.path.exists(output_path):
+                    counts['skipped'] += 1
+                    continue
+                known_hash = entry.get('sha256')
+            else:
+                known_hash = None
+            task = (os.path.join(args.input, relpath), output_path, steps, args.format, args.quality,
+                    args.profile, known_hash)
+            yield relpath, stat, task
+
+    done = 0
+    for relpath, stat, result in pool.imap_unordered(_run_task, tasks(), chunksize=1):
+        status = result['status']
+        counts[status] += 1
+        counts['in_bytes'] += result['in_bytes']
+        counts['out_bytes'] += result['out_bytes']
+        counts['encode_seconds'] += result['encode_seconds']
+
+        if status == 'error':
+            print(f"Error with {relpath}: {result['error']}", file=sys.stderr)
+        else:
+            manifest[relpath] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'sha256': result['sha256'],
+                'plan': fingerprint
+            }
+
+        done += 1
+        if done % 100 == 0:
+            save_manifest(args.output, manifest)
+            print(f"  {done} files...")
+
+    return counts
+
+
+def report(counts, seconds):
+    """Prints throughput of a processing run"""
+    handled = counts['processed'] + counts['unchanged']
+    megabytes = counts['in_bytes'] / (1024 * 1024)
+    print(
+        f"Processed {counts['processed']}, unchanged {counts['unchanged']}, "
+        f"skipped {counts['skipped']}, errors {counts['error']} in {seconds:.1f}s"
+    )
+    if handled and seconds > 0:
+        print(
+            f"Throughput: {handled / seconds:.1f} images/s, {megabytes / seconds:.1f} MB/s in, "
+            f"{counts['out_bytes'] / (1024 * 1024):.1f} MB written"
+        )
+    if counts['processed']:
+        print(f"Encoding: {counts['encode_seconds'] * 1000 / counts['processed']:.1f} ms/image (worker time)")
+
+
+def cmd_process(args):
+    operations = []
+    if args.preset is not None:
+        operations += load_preset_operations(args.preset)
+    if args.ops_file:
+        with open(args.ops_file, 'r') as f:
+            operations += json.load(f)
+    operations += args.op or []
+
+    try:
+        steps = compile_operations(operations) if operations else []
+    except PipelineError as e:
+        raise SystemExit(f'Invalid operations: {e}')
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = load_manifest(args.output)
+    fingerprint = plan_fingerprint(operations, args.format, args.quality, args.profile)
+
+    with Pool(args.workers) as pool:
+        while True:
+            started = time.perf_counter()
+            counts = process_directory(pool, args, steps, fingerprint, manifest)
+            save_manifest(args.output, manifest)
+
+            if not args.watch:
+                report(counts, time.perf_counter() - started)
+                return 1 if counts['error'] else 0
+
+            if counts['processed'] or counts['error']:
+                report(counts, time.perf_counter() - started)
+            time.sleep(args.interval)
+
+
+# ==================== BENCH COMMAND ====================
+
+def cmd_bench(args):
+    """Encodes sample images in several formats and compares size and time with WebP"""
+    available = available_export_formats()
+    formats = []
+    for format_type in args.formats.split(','):
+        format_type = format_type.strip().lower()
+        if format_type not in available:
+            print(f"Skipping {format_type}: not available (installed: {', '.join(available)})")
+        elif format_type not in formats:
+            formats.append(format_type)
+    if not formats:
+        raise SystemExit('No format to benchmark')
+
+    paths = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            paths += [os.path.join(path, relpath) for relpath, _ in iter_input_files(path)]
+        else:
+            paths.append(path)
+
+    totals = {format_type: {'bytes': 0, 'seconds': 0.0} for format_type in formats}
+    for path in sorted(paths):
+        img = open_image(path)
+        img.load()
+        for format_type in formats:
+            best = None
+            for _ in range(args.repeat):
+                encoded, _, seconds = encode_image_timed(img, format_type, args.quality, args.profile)
+                best = seconds if best is None else min(best, seconds)
+            totals[format_type]['bytes'] += len(encoded)
+            totals[format_type]['seconds'] += best
+            if args.verbose:
+                print(f"{os.path.basename(path)}: {format_type} {len(encoded) / 1024:.1f} KB in {best * 1000:.0f} ms")
+
+    baseline = totals.get('webp')
+    results = []
+    for format_type in formats:
+        total = totals[format_type]
+        results.append({
+            'format': format_type,
+            'bytes': total['bytes'],
+            'encode_ms': round(total['seconds'] * 1000, 1),
+            'bytes_vs_webp': round(total['bytes'] / baseline['bytes'], 3) if baseline and baseline['bytes'] else None,
+            'time_vs_webp': round(total['seconds'] / baseline['seconds'], 2) if baseline and baseline['seconds'] else None
+        })
+
+    if args.json:
+        print(json.dumps({'images': len(paths), 'quality': args.quality, 'profile': args.profile,
+                          'results': results}, indent=2))
+        return 0
+
+    print(f"{len(paths)} images, quality {args.quality}, profile {args.profile}")
+    print(f"{'format':<8}{'KB':>12}{'ms':>10}{'size/webp':>12}{'time/webp':>12}")
+    for result in results:
+        ratio = f"{result['bytes_vs_webp']:.3f}" if result['bytes_vs_webp'] is not None else '-'
+        slower = f"{result['time_vs_webp']:.2f}x" if result['time_vs_webp'] is not None else '-'
+        print(f"{result['format']:<8}{result['bytes'] / 1024:>12.1f}{result['encode_ms']:>10.0f}{ratio:>12}{slower:>12}")
+    return 0
+
+
+# ==================== BENCH-DEPTH COMMAND ====================
+
+# Operations timed on the 8-bit and the high bit depth path
+DEPTH_BENCH_OPERATIONS = [
+    ('resize_percent', {'percent': 50}),
+    ('rotate', {'angle': 90}),
+    ('rotate', {'angle': 15}),
+    ('crop', {'left': 100, 'top': 100, 'right': 1100, 'bottom': 900}),
+    ('brightness', {'factor': 1.2}),
+    ('contrast', {'factor': 1.3}),
+    ('saturation', {'factor': 0.8}),
+    ('grayscale', {}),
+    ('blur', {'radius': 4}),
+    ('sharpen', {'factor': 2}),
+]
+
+
+def synthetic_high_bit(width, height):
+    """16-bit RGB test image: smooth gradients with noise"""
+    import numpy as np
+    from precision import HighBitImage
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    array = np.stack([x / width, y / height, (x + y) / (width + height)])
+    array += np.random.default_rng(0).normal(0, 0.01, array.shape).astype(np.float32)
+    return HighBitImage(np.clip(array, 0, 1).astype(np.float32))
+
+
+def time_operation(img, operation, params, repeat):
+    """Fastest of repeat runs of one operation, in seconds"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        apply_operation_to_image(img.copy(), operation, params)
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def cmd_bench_depth(args):
+    """Times the operations on the 8-bit and the high bit depth path of the same images"""
+    from precision import HighBitImage, numpy_available
+    if not numpy_available():
+        raise SystemExit('NumPy is required for the high bit depth path')
+
+    if args.inputs:
+        images = []
+        for path in args.inputs:
+            img = open_image(path)
+            # 8-bit sources are benchmarked as float images of their pixels
+            images.append((os.path.basename(path), img if isinstance(img, HighBitImage) else
+                           HighBitImage.from_pillow(pillow_image(img))))
+    else:
+        width, height = (int(value) for value in args.size.lower().split('x'))
+        images = [(f'synthetic {width}x{height}', synthetic_high_bit(width, height))]
+
+    results = []
+    for name, high_bit in images:
+        eight_bit = pillow_image(high_bit)
+        for operation, params in DEPTH_BENCH_OPERATIONS:
+            eight_bit_seconds = time_operation(eight_bit, operation, params, args.repeat)
+            high_bit_seconds = time_operation(high_bit, operation, params, args.repeat)
+            results.append({
+                'image': name,
+                'operation': operation,
+                'params': params,
+                'ms_8bit': round(eight_bit_seconds * 1000, 1),
+                'ms_high_bit': round(high_bit_seconds * 1000, 1),
+                'ratio': round(high_bit_seconds / eight_bit_seconds, 2) if eight_bit_seconds else None
+            })
+
+    total_8bit = sum(result['ms_8bit'] for result in results)
+    total_high_bit = sum(result['ms_high_bit'] for result in results)
+    ratio = round(total_high_bit / total_8bit, 2) if total_8bit else None
+
+    if args.json:
+        print(json.dumps({'images': len(images), 'repeat': args.repeat, 'results': results,
+                          'total_ms_8bit': round(total_8bit, 1), 'total_ms_high_bit': round(total_high_bit, 1),
+                          'ratio': ratio}, indent=2))
+        return 0
+
+    print(f"{len(images)} images, fastest of {args.repeat} runs")
+    print(f"{'operation':<18}{'8-bit ms':>10}{'high ms':>10}{'ratio':>8}")
+    for result in results:
+        slower = f"{result['ratio']:.2f}x" if result['ratio'] is not None else '-'
+        print(f"{result['operation']:<18}{result['ms_8bit']:>10.0f}{result['ms_high_bit']:>10.0f}{slower:>8}")
+    print(f"{'total':<18}{total_8bit:>10.0f}{total_high_bit:>10.0f}{ratio if ratio is not None else '-':>7}x")
+    return 0
+
+
+# ==================== REBALANCE COMMAND ====================
+
+def cmd_rebalance(args):
+    """Moves the workspaces the hash ring now assigns to other nodes there"""
+    import shutil
+    import sharding
+    from config import get_config
+    from expiry import ExpiryIndex
+
+    config = get_config()
+    nodes = sharding.parse_nodes(args.nodes if args.nodes is not None else config.SHARD_NODES)
+    self_name = args.self_name or config.SHARD_SELF
+    secret = config.SHARD_SECRET
+    if not nodes:
+        raise SystemExit('No nodes given (--nodes or SHARD_NODES)')
+    if self_name not in nodes:
+        raise SystemExit(f'{self_name!r} is not one of the nodes (--self or SHARD_SELF)')
+    if not secret and not args.dry_run:
+        raise SystemExit('SHARD_SECRET is not set')
+    ring = sharding.HashRing(nodes)
+    log = (lambda message: None) if args.json else print
+    expiry_index = ExpiryIndex(os.path.join(args.uploads, '.expiry.db'))
+
+    results = []
+    folder_names = sorted(os.listdir(args.uploads)) if os.path.isdir(args.uploads) else []
+    for folder_name in folder_names:
+        folder = os.path.join(args.uploads, folder_name)
+        if folder_name.startswith('user_') and folder_name.endswith('.moved') and not args.dry_run:
+            # Left by an interrupted run after the other node had confirmed the import
+            shutil.rmtree(folder, ignore_errors=True)
+            continue
+        if not folder_name.startswith('user_') or '.' in folder_name or not os.path.isdir(folder):
+            continue
+        user_id = folder_name[len('user_'):]
+        node = ring.node_for(user_id)
+        if node == self_name:
+            # Writes stay refused after an interrupted move until the marker is gone
+            marker = os.path.join(folder, sharding.MOVING_MARKER)
+            if os.path.exists(marker) and not args.dry_run:
+                os.remove(marker)
+            continue
+        result = {'user': user_id, 'node': node}
+        results.append(result)
+        if args.dry_run:
+            log(f"{user_id} -> {node} (dry run)")
+            continue
+
+        # This node keeps serving reads while the workspace is sent, but holds
+        # back writes. Requests only go to the other node once it confirmed the
+        # import: the folder is moved aside, so this node routes them there.
+        moved = f'{folder}.moved'
+        try:
+            with sharding.holding_writes(folder):
+                answer = sharding.push_workspace(nodes[node], secret, user_id, folder)
+                os.rename(folder, moved)
+        except sharding.ShardError as e:
+            result['error'] = str(e)
+            log(f"{user_id} -> {node} failed: {e}")
+            continue
+        shutil.rmtree(moved)
+        expiry_index.forget_user(user_id)
+        result['images'] = answer.get('images', 0)
+        log(f"{user_id} -> {node}: {result['images']} images")
+
+    failed = sum(1 for result in results if 'error' in result)
+    if args.json:
+        print(json.dumps({'moved': len(results) - failed, 'failed': failed, 'workspaces': results}, indent=2))
+    else:
+        print(f"{len(results) - failed} workspaces moved, {failed} failed")
+    return 1 if failed else 0
+
+
+# ==================== LOADTEST COMMAND ====================
+
+def cmd_loadtest(args):
+    """Runs simulated editor sessions against a server and reports latencies and memory"""
+    import loadtest
+
+    server = loadtest.start_server(args.serve) if args.serve else None
+    try:
+        report = loadtest.run(
+            args.url, users=args.users, sessions=args.sessions, images=args.images,
+            sizes=loadtest.parse_sizes(args.sizes), edits=args.edits, seed=args.seed,
+            username=args.username, password=args.password, download_format=args.format,
+            quality=args.quality, server_pid=server.pid if server else args.pid
+        )
+    except loadtest.LoadTestError as e:
+        raise SystemExit(str(e))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    if args.serve:
+        report['options']['serve'] = args.serve
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2) if args.json else loadtest.format_report(report))
+    return 1 if report['sessions']['failed'] else 0
+
+
+# ==================== MAIN ====================
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='bildwerkzeug', description='Bildwerkzeug command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    process = commands.add_parser('process', help='Process all images of a folder')
+    process.add_argument('input', help='Input folder (searched recursively)')
+    process.add_argument('output', help='Output folder')
+    process.add_argument('--op', action='append', type=parse_op, metavar='NAME[:KEY=VALUE,...]',
+                         help='Operation to apply, can be repeated (e.g. resize:width=1920,height=1080)')
+    process.add_argument('--ops-file', help='JSON file with a list of {operation, params}')
+    process.add_argument('--preset', type=int, help='ID of a saved preset (applied before --op)')
+    process.add_argument('--format', default='png', choices=sorted(EXPORT_FORMATS), help='Output format')
+    process.add_argument('--quality', type=int, default=95, help='Quality for JPEG/WebP')
+    process.add_argument('--profile', default='balanced', choices=list(EXPORT_PROFILES),
+                         help='Encoder speed/size tradeoff')
+    process.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    process.add_argument('--force', action='store_true', help='Reprocess images listed in the manifest')
+    process.add_argument('--watch', action='store_true', help='Keep running and process new files')
+    process.add_argument('--interval', type=float, default=5, help='Seconds between scans in watch mode')
+    process.add_argument('--settle', type=float, default=2,
+                         help='Watch mode: ignore files modified less than this many seconds ago')
+    process.set_defaults(func=cmd_process)
+
+    bench = commands.add_parser('bench', help='Compare output size and encode time of export formats')
+    bench.add_argument('inputs', nargs='+', help='Images or folders to encode')
+    bench.add_argument('--formats', default='webp,avif,jxl', help='Comma-separated formats (compared with webp)')
+    bench.add_argument('--quality', type=int, default=80, help='Quality for lossy formats')
+    bench.add_argument('--profile', default='balanced', choices=list(EXPORT_PROFILES),
+                       help='Encoder speed/size tradeoff')
+    bench.add_argument('--repeat', type=int, default=1, help='Encode each image this often and keep the fastest run')
+    bench.add_argument('--json', action='store_true', help='Print the results as JSON')
+    bench.add_argument('--verbose', action='store_true', help='Print every single encode')
+    bench.set_defaults(func=cmd_bench)
+
+    bench_depth = commands.add_parser('bench-depth', help='Compare operation times of the 8-bit and the 16-bit/float path')
+    bench_depth.add_argument('inputs', nargs='*', help='Images to process (default: a synthetic 16-bit image)')
+    bench_depth.add_argument('--size', default='4000x3000', help='Size of the synthetic image (WIDTHxHEIGHT)')
+    bench_depth.add_argument('--repeat', type=int, default=3, help='Run each operation this often and keep the fastest run')
+    bench_depth.add_argument('--json', action='store_true', help='Print the results as JSON')
+    bench_depth.set_defaults(func=cmd_bench_depth)
+
+    rebalance = commands.add_parser('rebalance', help='Move workspaces to the nodes the hash ring assigns them to')
+    rebalance.add_argument('--uploads', default='uploads', help='Upload folder of this node')
+    rebalance.add_argument('--nodes', help='All nodes as name=url,... (default: SHARD_NODES)')
+    rebalance.add_argument('--self', dest='self_name', help='Name of this node (default: SHARD_SELF)')
+    rebalance.add_argument('--dry-run', action='store_true', help='Only list the workspaces that would move')
+    rebalance.add_argument('--json', action='store_true', help='Print the results as JSON')
+    rebalance.set_defaults(func=cmd_rebalance)
+
+    load = commands.add_parser('loadtest', help='Simulate editor sessions against a server and report latencies')
+    load.add_argument('url', nargs='?', default='http://127.0.0.1:5000', help='Server to test')
+    load.add_argument('--users', type=int, default=4, help='Concurrent virtual users')
+    load.add_argument('--sessions', type=int, default=3, help='Sessions per user, one after the other')
+    load.add_argument('--images', type=int, default=3, help='Images uploaded per session')
+    load.add_argument('--sizes', default='1920x1080', help='Image sizes, used in turn (WIDTHxHEIGHT,...)')
+    load.add_argument('--edits', type=int, default=10, help='Slider edits per session')
+    load.add_argument('--seed', type=int, default=1, help='Seed of images and edits (same seed, same requests)')
+    load.add_argument('--username', default=os.environ.get('ADMIN_USERNAME', 'admin'),
+                      help='Admin creating the test accounts if login is required')
+    load.add_argument('--password', default=os.environ.get('ADMIN_PASSWORD', 'admin'), help='Password of the admin')
+    load.add_argument('--format', default='jpeg', choices=sorted(EXPORT_FORMATS), help='Format of the ZIP download')
+    load.add_argument('--quality', type=int, default=85, help='Quality of the ZIP download')
+    load.add_argument('--pid', type=int, help='Server process whose memory (with its workers) is reported')
+    load.add_argument('--serve', help='Start this server command for the test and stop it afterwards '
+                                      '(e.g. "gunicorn -w 2 --threads 4 app:app")')
+    load.add_argument('--output', help='Also write the JSON report to this file')
+    load.add_argument('--json', action='store_true', help='Print the report as JSON')
+    load.set_defaults(func=cmd_loadtest)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,24 @@ Environment variables can be set in .env file or directly.
 
 import os
 from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
 
 # Load .env file if present
 load_dotenv()
 
 
+def pool_options(database_url):
+    """Connection pool options, except for in-memory SQLite (a single static connection without a pool)"""
+    url = make_url(database_url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+
+
 class Config:
     """Base configuration"""
     
@@ -23,9 +36,78 @@ class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///bildwerkzeug.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = pool_options(SQLALCHEMY_DATABASE_URI)
+    # SQLite: WAL lets requests read while another worker writes
+    SQLITE_WAL = os.environ.get('SQLITE_WAL', 'true').lower() in ('true', '1', 'yes')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    # Seconds a worker reuses a loaded user instead of querying it per request (0 = off)
+    USER_CACHE_SECONDS = float(os.environ.get('USER_CACHE_SECONDS', 30))
     
     # Upload
     MAX_CONTENT_LENGTH = int(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024
+    # Resumable uploads (/api/uploads): total size, suggested chunk size (below MAX_UPLOAD_MB)
+    # and hours after which an upload without new chunks is removed
+    MAX_RESUMABLE_UPLOAD_MB = int(os.environ.get('MAX_RESUMABLE_UPLOAD_MB', 1024))
+    UPLOAD_CHUNK_MB = int(os.environ.get('UPLOAD_CHUNK_MB', 8))
+    PARTIAL_UPLOAD_HOURS = float(os.environ.get('PARTIAL_UPLOAD_HOURS', 24))
+    # Longest side uploads are decoded to in px (0 = full size). The uploaded file is kept
+    # for resets. Can be overridden per user (admin panel), per preset or per upload.
+    INGEST_MAX_DIMENSION = int(os.environ.get('INGEST_MAX_DIMENSION', 0))
+    
+    # Undo/redo: steps kept per image (0 = off), a full snapshot every n steps
+    # (the others are replayed from it) and disk space per image in MB
+    HISTORY_MAX_STEPS = int(os.environ.get('HISTORY_MAX_STEPS', 50))
+    HISTORY_KEYFRAME_INTERVAL = int(os.environ.get('HISTORY_KEYFRAME_INTERVAL', 5))
+    HISTORY_MAX_MB = int(os.environ.get('HISTORY_MAX_MB', 50))
+    # Similar images: hashes (64 bit) differing in at most this many bits
+    SIMILARITY_MAX_DISTANCE = int(os.environ.get('SIMILARITY_MAX_DISTANCE', 10))
+    
+    # Temporary image storage
+    TEMP_IMAGE_LIFETIME_HOURS = float(os.environ.get('TEMP_IMAGE_LIFETIME_HOURS', 24))
+    MAX_IMAGE_TTL_HOURS = float(os.environ.get('MAX_IMAGE_TTL_HOURS', 168))  # Upper bound for per-image TTLs
+    CLEANUP_INTERVAL_SECONDS = int(os.environ.get('CLEANUP_INTERVAL_SECONDS', 300))
+    CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', 50))  # Images deleted per chunk
+    CLEANUP_BATCH_PAUSE = float(os.environ.get('CLEANUP_BATCH_PAUSE', 0.5))  # Seconds between chunks
+    # Disk usage (MB) above which the oldest images are evicted, 0 = disabled
+    UPLOAD_HIGH_WATER_MB = int(os.environ.get('UPLOAD_HIGH_WATER_MB', 0))
+    # Eviction stops below this usage (defaults to 90% of the high-water mark)
+    UPLOAD_LOW_WATER_MB = int(os.environ.get('UPLOAD_LOW_WATER_MB', 0))
+    
+    # Storage quotas in MB (0 = unlimited). Per-user overrides are set in the admin panel.
+    USER_QUOTA_MB = int(os.environ.get('USER_QUOTA_MB', 0))
+    GLOBAL_QUOTA_MB = int(os.environ.get('GLOBAL_QUOTA_MB', 0))
+    # What happens when a user is over quota: 'reject' the upload or 'evict' their oldest images
+    QUOTA_POLICY = os.environ.get('QUOTA_POLICY', 'reject').lower()
+    
+    # Default encoder profile for downloads: 'fast', 'balanced' or 'smallest'
+    EXPORT_PROFILE = os.environ.get('EXPORT_PROFILE', 'balanced').lower()
+    # Processes per web worker for slow encoders (AVIF, JPEG XL) and queued encodes allowed
+    EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))
+    EXPORT_MAX_PENDING = int(os.environ.get('EXPORT_MAX_PENDING', 32))
+    EXPORT_CACHE_HOURS = float(os.environ.get('EXPORT_CACHE_HOURS', 24))  # Cached exports and job status
+    # From this many pixels on, the editor shows images as zoomable tiles instead of one Base64 PNG
+    TILED_VIEW_MIN_PIXELS = int(os.environ.get('TILED_VIEW_MIN_PIXELS', 16_000_000))
+    # Threads per web worker encoding the sizes of a rendition (srcset) export
+    RENDITION_THREADS = int(os.environ.get('RENDITION_THREADS', os.cpu_count() or 2))
+    # Threads per web worker processing the frames of animations (0 = CPU count)
+    FRAME_WORKERS = int(os.environ.get('FRAME_WORKERS', 0))
+    # Threads per ASGI worker (uvicorn asgi:app) running Flask requests and image processing
+    ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+    # Events (/api/events, /api/events/poll): seconds between checks for new events, seconds a
+    # long-poll waits for one under Gunicorn, seconds events are kept
+    EVENTS_POLL_SECONDS = float(os.environ.get('EVENTS_POLL_SECONDS', 0.5))
+    EVENTS_LONG_POLL_SECONDS = float(os.environ.get('EVENTS_LONG_POLL_SECONDS', 2))
+    EVENTS_RETENTION_SECONDS = int(os.environ.get('EVENTS_RETENTION_SECONDS', 300))
+    
+    # Workspaces spread over several nodes (see sharding.py): all nodes as 'name=url,...',
+    # the name of this node and the secret the nodes sign workspace transfers with
+    SHARD_NODES = os.environ.get('SHARD_NODES', '')
+    SHARD_SELF = os.environ.get('SHARD_SELF', '')
+    SHARD_SECRET = os.environ.get('SHARD_SECRET', '')
+    # Redirect requests for users of another node there instead of answering 421
+    # (needs a session cookie all nodes receive, see SESSION_COOKIE_DOMAIN)
+    SHARD_REDIRECT = os.environ.get('SHARD_REDIRECT', 'false').lower() in ('true', '1', 'yes')
+    SESSION_COOKIE_DOMAIN = os.environ.get('SESSION_COOKIE_DOMAIN') or None
     
     # Admin user (created on first start if not present)
     ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
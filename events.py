@@ -0,0 +1,99 @@
+"""
+Bildwerkzeug - Events pushed to the browser
+
+Workers publish events (an edited image, the progress of a batch) into a
+small SQLite table next to the expiry index. The /api/events stream (or
+the /api/events/poll long-poll) of every worker polls it for the events of
+its user, so the browser hears about work done in any process without a
+message broker. Events are kept for a few minutes, long enough for a
+reconnecting client to catch up from its last event id.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Comment line sent on idle streams, so proxies do not close them
+HEARTBEAT = ': keep-alive\n\n'
+
+
+class EventLog:
+    """SQLite log of events per user, shared by all workers of a host"""
+
+    # Minimum seconds between two deletions of old events per process
+    PRUNE_INTERVAL = 30
+
+    def __init__(self, path, retention_seconds=300):
+        self.path = path
+        self.retention = retention_seconds
+        self._local = threading.local()
+        self._schema_ready = False
+        self._last_prune = 0
+
+    def _connect(self):
+        """Returns a connection for the current thread (and process)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if not self._schema_ready:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, id);
+                CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at);
+            ''')
+            self._schema_ready = True
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def publish(self, user_id, event_type, data):
+        """Adds an event for a user. Returns its id."""
+        now = time.time()
+        conn = self._connect()
+        event_id = conn.execute(
+            'INSERT INTO events (user_id, type, data, created_at) VALUES (?, ?, ?, ?)',
+            (str(user_id), event_type, json.dumps(data), now)
+        ).lastrowid
+        if now - self._last_prune > self.PRUNE_INTERVAL:
+            self._last_prune = now
+            conn.execute('DELETE FROM events WHERE created_at < ?', (now - self.retention,))
+        return event_id
+
+    def since(self, user_id, after_id, limit=100):
+        """Up to limit events of a user after after_id, as (id, type, data as JSON) in order"""
+        return self._connect().execute(
+            'SELECT id, type, data FROM events WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?',
+            (str(user_id), after_id, limit)
+        ).fetchall()
+
+    def last_id(self):
+        """Id of the newest event of any user (0 if there is none)"""
+        return self._connect().execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+
+def format_event(event_id, event_type, data):
+    """An event in text/event-stream format (data is JSON text)"""
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+
+def start_event_id(event_log, last_event_id):
+    """Id a stream starts after: the Last-Event-ID of a reconnecting client, else the newest event"""
+    try:
+        return max(0, int(last_event_id))
+    except (TypeError, ValueError):
+        return event_log.last_id()
@@ -0,0 +1,177 @@
+"""
+Bildwerkzeug - Expiry index for temporary images
+
+Keeps track of when each stored image was last accessed and how many bytes
+it occupies, so the cleanup never has to walk the whole upload folder.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: every process cleans up on its own
+    fcntl = None
+
+
+class ExpiryIndex:
+    """SQLite index of stored images, keyed by expiry and last access time"""
+
+    # Minimum seconds between two access updates for the same key
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, default_ttl_hours=24):
+        self.path = path
+        self.default_ttl = default_ttl_hours * 3600
+        self._local = threading.local()
+        self._recent = {}
+        self._schema_ready = False
+
+    def _connect(self):
+        """Returns a connection for the current thread (and process)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if not self._schema_ready:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS images (
+                    user_id TEXT NOT NULL,
+                    image_id TEXT NOT NULL,
+                    last_access REAL NOT NULL,
+                    ttl REAL,
+                    expires_at REAL NOT NULL,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, image_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_images_expires ON images (expires_at);
+                CREATE INDEX IF NOT EXISTS idx_images_access ON images (last_access);
+            ''')
+            self._schema_ready = True
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _throttled(self, key, now):
+        """True if key was touched by this process within TOUCH_INTERVAL"""
+        last = self._recent.get(key)
+        if last is not None and now - last < self.TOUCH_INTERVAL:
+            return True
+        if len(self._recent) > 10000:
+            self._recent.clear()
+        self._recent[key] = now
+        return False
+
+    def touch(self, user_id, image_id, ttl_hours=None, force=False):
+        """Marks an image as accessed (creates the entry if needed)"""
+        now = time.time()
+        if not force and ttl_hours is None and self._throttled((str(user_id), image_id), now):
+            return
+        ttl = ttl_hours * 3600 if ttl_hours else None
+        self._connect().execute('''
+            INSERT INTO images (user_id, image_id, last_access, ttl, expires_at)
+            VALUES (?, ?, ?, ?, ? + COALESCE(?, ?))
+            ON CONFLICT (user_id, image_id) DO UPDATE SET
+                last_access = excluded.last_access,
+                ttl = COALESCE(excluded.ttl, images.ttl),
+                expires_at = excluded.last_access + COALESCE(excluded.ttl, images.ttl, ?)
+        ''', (str(user_id), image_id, now, ttl, now, ttl, self.default_ttl, self.default_ttl))
+
+    def touch_user(self, user_id):
+        """Marks all images of a user as accessed"""
+        now = time.time()
+        if self._throttled((str(user_id), None), now):
+            return
+        self._connect().execute('''
+            UPDATE images SET last_access = ?, expires_at = ? + COALESCE(ttl, ?)
+            WHERE user_id = ?
+        ''', (now, now, self.default_ttl, str(user_id)))
+
+    def add_bytes(self, user_id, image_id, delta):
+        """Adjusts the stored size of an image by delta bytes"""
+        if not delta:
+            return
+        self.touch(user_id, image_id)
+        self._connect().execute(
+            'UPDATE images SET bytes = MAX(0, bytes + ?) WHERE user_id = ? AND image_id = ?',
+            (delta, str(user_id), image_id)
+        )
+
+    def forget(self, user_id, image_id):
+        """Removes an image from the index"""
+        self._recent.pop((str(user_id), image_id), None)
+        self._connect().execute(
+            'DELETE FROM images WHERE user_id = ? AND image_id = ?', (str(user_id), image_id)
+        )
+
+    def forget_user(self, user_id):
+        """Removes all images of a user from the index"""
+        self._connect().execute('DELETE FROM images WHERE user_id = ?', (str(user_id),))
+
+    def expired(self, now, limit):
+        """Returns up to limit (user_id, image_id) pairs whose TTL has passed"""
+        return self._connect().execute(
+            'SELECT user_id, image_id FROM images WHERE expires_at < ? ORDER BY expires_at LIMIT ?',
+            (now, limit)
+        ).fetchall()
+
+    def oldest(self, limit, user_id=None):
+        """Returns up to limit (user_id, image_id) pairs, least recently used first"""
+        if user_id is not None:
+            return self._connect().execute(
+                'SELECT user_id, image_id FROM images WHERE user_id = ? ORDER BY last_access LIMIT ?',
+                (str(user_id), limit)
+            ).fetchall()
+        return self._connect().execute(
+            'SELECT user_id, image_id FROM images ORDER BY last_access LIMIT ?', (limit,)
+        ).fetchall()
+
+    def total_bytes(self):
+        """Total bytes of all indexed images"""
+        return self._connect().execute('SELECT COALESCE(SUM(bytes), 0) FROM images').fetchone()[0]
+
+    def user_bytes(self, user_id):
+        """Total bytes of all images of a user"""
+        return self._connect().execute(
+            'SELECT COALESCE(SUM(bytes), 0) FROM images WHERE user_id = ?', (str(user_id),)
+        ).fetchone()[0]
+
+    def usage_by_user(self):
+        """Returns {user_id: bytes} for all users with stored images"""
+        return dict(self._connect().execute(
+            'SELECT user_id, SUM(bytes) FROM images GROUP BY user_id'
+        ).fetchall())
+
+
+class CleanupLock:
+    """Non-blocking file lock used to elect a single cleaner across workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        """Tries to become the cleaner. Returns True if this process holds the lock."""
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            return True
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # Keep the file open for the lifetime of the process
+        self._file = lock_file
+        return True
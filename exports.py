@@ -0,0 +1,247 @@
+"""
+Bildwerkzeug - Background exports
+
+Slow encoders (AVIF, JPEG XL) run on a small, bounded process pool instead of
+in the request threads. Export jobs keep a status file in the user's export
+folder, so every web worker can report on them, and each encoded image is
+kept in an export cache keyed by its source file and the encoder settings.
+"""
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from imaging import open_image, encode_image_timed
+
+
+EXPORT_FOLDER = 'exports'
+
+
+class ExportBusy(RuntimeError):
+    """Raised when the export pool has no room for more work"""
+
+
+# ==================== EXPORT CACHE ====================
+
+def cache_path(export_dir, image_id, source_path, format_type, quality, options):
+    """Returns the cache file for an image encoded with the given settings.
+
+    The key covers the source file's modification time and size, so edits
+    produce a new entry.
+    """
+    stat = os.stat(source_path)
+    text = json.dumps(
+        [os.path.basename(source_path), stat.st_mtime_ns, stat.st_size, format_type, quality, options],
+        sort_keys=True
+    )
+    key = hashlib.sha256(text.encode()).hexdigest()[:16]
+    return os.path.join(export_dir, f'{image_id}_{key}.{format_type}')
+
+
+def clear_cached_exports(export_dir, image_id):
+    """Deletes all cached exports of an image"""
+    for filepath in glob.glob(os.path.join(glob.escape(export_dir), f'{glob.escape(image_id)}_*')):
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+
+
+def prune_exports(upload_folder, max_age_seconds):
+    """Deletes cached exports and job files older than max_age_seconds. Returns the count."""
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for export_dir in glob.glob(os.path.join(glob.escape(upload_folder), 'user_*', EXPORT_FOLDER)):
+        with os.scandir(export_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def encode_file(source_path, output_path, format_type, quality, options):
+    """Encodes a stored image into the export cache (runs in a pool process)"""
+    img = open_image(source_path)
+    encoded, _, seconds = encode_image_timed(img, format_type, quality, **options)
+
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(encoded)
+    os.replace(tmp_path, output_path)
+    return len(encoded), seconds
+
+
+# ==================== JOBS ====================
+
+def job_status_path(export_dir, job_id):
+    return os.path.join(export_dir, f'job_{job_id}.json')
+
+
+def load_job(export_dir, job_id):
+    """Returns the status of an export job, or None"""
+    try:
+        with open(job_status_path(export_dir, job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_job(export_dir, job):
+    path = job_status_path(export_dir, job['id'])
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+
+
+class ExportPool:
+    """Bounded process pool for slow encodes.
+
+    At most max_pending encodes are queued or running per web worker; more
+    raise ExportBusy. The pool is created on first use in each process.
+    """
+
+    def __init__(self, workers=2, max_pending=32):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            # spawn: forking a threaded web worker is not safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+            self._pid = os.getpid()
+        return self._executor
+
+    def _reserve(self, count):
+        with self._lock:
+            if self._pending + count > self.max_pending:
+                raise ExportBusy('Too many exports in progress, please try again later')
+            self._pending += count
+
+    def _release(self, _future=None, count=1):
+        with self._lock:
+            self._pending -= count
+
+    def hold(self, count):
+        """Reserves room for count encodes that are submitted later with held=True,
+        e.g. while a response streams. Raises ExportBusy right away if there is
+        none. Returns a function that gives the room back.
+        """
+        self._reserve(count)
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self._release(count=count)
+        return release
+
+    def submit(self, func, *args, held=False):
+        """Runs func(*args) on the pool. Returns a future. held: room was reserved with hold."""
+        if not held:
+            self._reserve(1)
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            if not held:
+                self._release()
+            raise
+        if not held:
+            future.add_done_callback(self._release)
+        return future
+
+    def run(self, func, *args, held=False):
+        """Runs func(*args) on the pool and waits for the result"""
+        return self.submit(func, *args, held=held).result()
+
+    def start_job(self, export_dir, items, format_type, quality, options):
+        """Starts encoding stored images in the background. Returns the job status.
+
+        items are dicts with image_id, filename and source (path of the stored
+        image). Images already in the export cache are not encoded again.
+        """
+        os.makedirs(export_dir, exist_ok=True)
+        job = {
+            'id': str(uuid.uuid4())[:8],
+            'status': 'running',
+            'format': format_type,
+            'quality': quality,
+            'profile': options.get('profile'),
+            'created_at': time.time(),
+            'total': len(items),
+            'done': 0,
+            'failed': 0,
+            'items': []
+        }
+
+        pending = []
+        for item in items:
+            output_path = cache_path(export_dir, item['image_id'], item['source'], format_type, quality, options)
+            entry = {
+                'image_id': item['image_id'],
+                'filename': item['filename'],
+                'file': os.path.basename(output_path),
+                'status': 'queued'
+            }
+            if os.path.exists(output_path):
+                entry.update(status='done', bytes=os.path.getsize(output_path), cached=True)
+                job['done'] += 1
+            else:
+                pending.append((entry, item['source'], output_path))
+            job['items'].append(entry)
+
+        self._reserve(len(pending))
+        # Reentrant: callbacks of futures that finish immediately run in this thread
+        job_lock = threading.RLock()
+
+        def complete(entry, **result):
+            with job_lock:
+                entry.update(result)
+                job['done' if result['status'] == 'done' else 'failed'] += 1
+                if job['done'] + job['failed'] == job['total']:
+                    job['status'] = 'done' if job['done'] else 'error'
+                _save_job(export_dir, job)
+
+        def finished(entry, future):
+            self._release()
+            try:
+                output_bytes, seconds = future.result()
+                complete(entry, status='done', bytes=output_bytes, encode_ms=round(seconds * 1000, 1))
+            except Exception as e:
+                complete(entry, status='error', error=str(e))
+
+        with job_lock:
+            if not pending:
+                job['status'] = 'done'
+            _save_job(export_dir, job)
+
+            for index, (entry, source, output_path) in enumerate(pending):
+                try:
+                    future = self._get_executor().submit(
+                        encode_file, source, output_path, format_type, quality, options
+                    )
+                except Exception as e:
+                    # Give back what was reserved for this and the remaining entries
+                    for failed_entry, _, _ in pending[index:]:
+                        self._release()
+                        complete(failed_entry, status='error', error=str(e))
+                    break
+                future.add_done_callback(lambda f, entry=entry: finished(entry, f))
+
+        return job
@@ -0,0 +1,308 @@
+"""
+Bildwerkzeug - Animated and multi-frame images
+
+Animated GIF, WebP and PNG files and multi-page TIFFs are edited frame by
+frame. An Animation keeps the encoded source and the operations applied to
+it; the operations run when it is encoded, frame by frame on a thread pool
+(Pillow releases the GIL while processing), with only a window of frames
+decoded ahead of the encoder. Frame durations, disposal and the loop count
+are kept.
+"""
+
+import io
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+
+# Formats that can store more than one frame
+ANIMATED_FORMATS = ('PNG', 'GIF', 'WEBP', 'AVIF', 'TIFF')
+
+# Frame duration (ms) for sources without one, e.g. TIFF pages
+DEFAULT_DURATION = 100
+
+_workers = os.cpu_count() or 2
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def set_frame_workers(workers):
+    """Sets the number of threads frames are processed on (before the first animation is encoded)"""
+    global _workers
+    _workers = max(1, workers or os.cpu_count() or 2)
+
+
+def _frame_executor():
+    # Created on first use, so every (forked) worker process gets its own threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix='frames')
+        return _executor
+
+
+def is_animated(img):
+    """True for opened images with more than one frame"""
+    return getattr(img, 'is_animated', False) and getattr(img, 'n_frames', 1) > 1
+
+
+def _gif_frame_headers(data):
+    """(duration, disposal) of every frame of a GIF, from its graphic control extensions"""
+    flags = data[10]
+    pos = 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+    headers = []
+    control = (0, 0)
+    while pos < len(data) and data[pos] != 0x3B:
+        if data[pos] == 0x21:
+            if data[pos + 1] == 0xF9:
+                packed, delay = struct.unpack_from('<BH', data, pos + 3)
+                control = (delay * 10, (packed >> 2) & 7)
+            pos += 2
+        elif data[pos] == 0x2C:
+            headers.append(control)
+            control = (0, 0)
+            flags = data[pos + 9]
+            pos += 10 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0) + 1
+        else:
+            return None
+        # Data sub-blocks up to the empty one
+        while pos < len(data) and data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+    return headers
+
+
+def _webp_frame_headers(data):
+    """(duration, disposal) of every frame of an animated WebP, from its ANMF chunks"""
+    headers = []
+    pos = 12
+    while pos + 8 <= len(data):
+        fourcc, size = data[pos:pos + 4], struct.unpack_from('<I', data, pos + 4)[0]
+        if fourcc == b'ANMF':
+            duration = int.from_bytes(data[pos + 20:pos + 23], 'little')
+            headers.append((duration, data[pos + 23] & 1))
+        pos += 8 + size + (size & 1)
+    return headers
+
+
+def _png_frame_headers(data):
+    """(duration, disposal) of every frame of an APNG, from its fcTL chunks"""
+    headers = []
+    pos = 8
+    while pos + 8 <= len(data):
+        size, chunk_type = struct.unpack_from('>I4s', data, pos)
+        if chunk_type == b'fcTL':
+            numerator, denominator, disposal = struct.unpack_from('>HHB', data, pos + 28)
+            headers.append((round(numerator * 1000 / (denominator or 100)), disposal))
+        pos += 12 + size
+    return headers
+
+
+def _header_reader(data):
+    """(reads the frame headers, disposal value meaning "clear to the background") for the format of data"""
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return _gif_frame_headers, 2
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return _webp_frame_headers, 1
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return _png_frame_headers, 1
+    return None, None
+
+# Disposal values of the writers that take one (the frames are saved whole, so a
+# frame either leaves the canvas as it is or clears it to the background)
+_DISPOSAL = {'GIF': (1, 2), 'PNG': (0, 1)}
+
+
+def _frame_mode(img):
+    """Mode all frames are converted to, so they can be written into one file"""
+    if img.mode in ('RGB', 'L', 'P') and 'transparency' not in img.info:
+        return 'RGB'
+    return 'RGBA'
+
+
+class Animation:
+    """An image with several frames, edited frame by frame.
+
+    Offers what the editing code uses from Pillow images (size, info, copy,
+    convert, save), so it can take the place of one. map() records an
+    operation; it runs on every frame when the frames are read.
+    """
+
+    def __init__(self, source, transforms=(), info=None):
+        # The encoded bytes, so saving over the source file does not change the frames
+        if not isinstance(source, (bytes, bytearray)):
+            with open(source, 'rb') as f:
+                source = f.read()
+        self.source = source
+        self.transforms = list(transforms)
+        self._first = None
+        self._headers = None
+
+        if info is None:
+            with Image.open(io.BytesIO(source)) as img:
+                info = {key: img.info[key] for key in ('icc_profile', 'exif', 'loop') if key in img.info}
+                info['frames'] = img.n_frames
+                # The frames are turned upright when decoded
+                if info.get('exif'):
+                    exif = img.getexif()
+                    if exif.get(0x0112, 1) != 1:
+                        del exif[0x0112]
+                        info['exif'] = exif.tobytes()
+        self.info = info
+
+    @property
+    def n_frames(self):
+        return self.info['frames']
+
+    @property
+    def is_animated(self):
+        return True
+
+    @property
+    def size(self):
+        return self.first_frame().size
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def mode(self):
+        return self.first_frame().mode
+
+    def load(self):
+        self.first_frame()
+
+    def map(self, func, *args):
+        """Returns the animation with func(frame, *args) applied to every frame.
+
+        func must be a module-level function (animations are pickled for the export pool).
+        """
+        return Animation(self.source, self.transforms + [(func, args)], dict(self.info))
+
+    def convert(self, mode):
+        return self.map(Image.Image.convert, mode)
+
+    def copy(self):
+        animation = Animation(self.source, self.transforms, dict(self.info))
+        animation._first = self._first
+        return animation
+
+    def rebase(self, source):
+        """Continues from source (the saved frames), so the operations do not run again"""
+        first = self._first
+        self.__init__(source, info={**self.info})
+        self._first = first
+
+    def _apply(self, frame):
+        for func, args in self.transforms:
+            frame = func(frame, *args)
+        return frame
+
+    def _decoded_frames(self):
+        """Yields the source frames one at a time, with EXIF orientation applied"""
+        with Image.open(io.BytesIO(self.source)) as img:
+            mode = _frame_mode(img)
+            for index in range(img.n_frames):
+                img.seek(index)
+                frame = img.convert(mode) if img.mode != mode else img.copy()
+                ImageOps.exif_transpose(frame, in_place=True)
+                frame.info['duration'] = img.info.get('duration') or DEFAULT_DURATION
+                yield frame
+
+    def first_frame(self):
+        """The first frame with all operations applied (kept for size and mode)"""
+        if self._first is None:
+            decoded = self._decoded_frames()
+            try:
+                self._first = self._apply(next(decoded))
+            finally:
+                decoded.close()
+        return self._first
+
+    def frame_headers(self):
+        """(duration in ms, clears to the background) of every frame.
+
+        Read from the frame headers of GIF, WebP and APNG files without
+        decoding; other formats (and files the headers do not match) are
+        stepped through with Pillow.
+        """
+        if self._headers is None:
+            reader, background = _header_reader(self.source)
+            headers = None
+            if reader is not None:
+                try:
+                    headers = [(duration, disposal == background) for duration, disposal in reader(self.source)]
+                except (IndexError, struct.error):
+                    headers = None
+            if not headers or len(headers) != self.n_frames:
+                with Image.open(io.BytesIO(self.source)) as img:
+                    headers = []
+                    for index in range(img.n_frames):
+                        img.seek(index)
+                        headers.append((img.info.get('duration'), False))
+            self._headers = [(duration or DEFAULT_DURATION, background) for duration, background in headers]
+        return self._headers
+
+    def frames(self):
+        """Yields the frames with all operations applied, in order.
+
+        Frames run in parallel; at most twice as many as there are threads
+        are decoded but not yet taken.
+        """
+        executor = _frame_executor()
+        window = 2 * _workers
+        pending = deque()
+        for frame in self._decoded_frames():
+            pending.append((executor.submit(self._apply, frame), frame.info['duration']))
+            if len(pending) >= window:
+                yield _finished(*pending.popleft())
+        while pending:
+            yield _finished(*pending.popleft())
+
+    def save(self, fp, format=None, **params):
+        """Saves all frames with their durations, disposal and loop count (like Image.save with save_all)"""
+        if not format and isinstance(fp, (str, os.PathLike)):
+            format = Image.registered_extensions().get(os.path.splitext(fp)[1].lower())
+        format = (format or '').upper()
+        headers = self.frame_headers()
+        params.setdefault('duration', [round(duration) for duration, _ in headers])
+        if format in _DISPOSAL:
+            params.setdefault('disposal', [_DISPOSAL[format][background] for _, background in headers])
+        if 'loop' in self.info:
+            params.setdefault('loop', self.info['loop'])
+        elif format != 'GIF':
+            # No loop count in a GIF: plays once
+            params.setdefault('loop', 1)
+
+        # With the durations known, the frames go to the writer as they are
+        # edited. Pillow's PNG writer goes over them twice (for their modes
+        # first), so it gets a list; the WebP, AVIF and TIFF writers make their
+        # own list from the iterator.
+        frames = self.frames()
+        try:
+            first = next(frames)
+            append_images = list(frames) if format == 'PNG' else frames
+            first.save(fp, format or None, save_all=True, append_images=append_images, **params)
+        finally:
+            frames.close()
+
+    def __getstate__(self):
+        return {'source': self.source, 'transforms': self.transforms, 'info': self.info}
+
+    def __setstate__(self, state):
+        self.__init__(state['source'], state['transforms'], state['info'])
+
+
+def _finished(future, duration):
+    frame = future.result()
+    frame.info['duration'] = duration
+    return frame
@@ -0,0 +1,24 @@
+"""
+Bildwerkzeug - Gunicorn configuration (gunicorn -c gunicorn.conf.py app:app)
+
+The app is preloaded in the master: libraries are imported and the database
+is initialized once, and every worker starts as a forked copy. Database
+connections and the cleanup thread are set up per worker after the fork.
+Each worker logs its time to the first request.
+"""
+
+import os
+import time
+
+# Start of the server, for the time-to-first-request log of the workers
+os.environ.setdefault('BILDWERKZEUG_STARTED_AT', str(time.time()))
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = os.environ.get('PRELOAD_APP', 'true').lower() in ('true', '1', 'yes')
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    init_worker()
@@ -0,0 +1,263 @@
+"""
+Bildwerkzeug - Edit history for undo and redo
+
+Every edit of a stored image adds a step. A step made by operations only
+keeps the operations and is replayed when needed; every few steps, and for
+edits whose pixels came from elsewhere (the browser), the result is kept as
+a keyframe PNG. Restoring a step replays at most the steps since the nearest
+keyframe before it. When a history exceeds its step or byte budget, the
+oldest steps up to a keyframe are dropped and that keyframe becomes the base.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from imaging import open_image, apply_operation_to_image, metadata_of
+from pipeline import compile_operations, run_pipeline
+
+
+HISTORY_FILE = 'history.json'
+
+# Step kinds: one operation (apply_operation_to_image), a pipeline of
+# operations (run_pipeline), pixels from elsewhere (keyframe only), or a
+# reset to the original
+OPERATION = 'operation'
+PIPELINE = 'pipeline'
+PIXELS = 'pixels'
+ORIGINAL = 'original'
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+class HistoryError(Exception):
+    """Raised when there is no step to move to"""
+
+
+def lock_for(history_dir):
+    """Lock for changes to one history within this process"""
+    with _locks_lock:
+        if len(_locks) > 1000:
+            _locks.clear()
+        return _locks.setdefault(history_dir, threading.RLock())
+
+
+def operation_step(operation, params, label=None):
+    return {'kind': OPERATION, 'label': label or operation, 'operations': [{'operation': operation, 'params': params}]}
+
+
+def with_resolved(step, operation, resolved):
+    """Copy of a step with its first operation named operation replaced by the resolved (operation, params),
+    so that replaying it does not derive the parameters of an automatic operation again"""
+    operations = list(step['operations'])
+    for index, entry in enumerate(operations):
+        if entry['operation'] == operation:
+            operations[index] = {'operation': resolved[0], 'params': resolved[1]}
+            break
+    return {**step, 'operations': operations}
+
+
+def pipeline_step(operations, label=None):
+    return {'kind': PIPELINE, 'label': label or ', '.join(op['operation'] for op in operations),
+            'operations': operations}
+
+
+def pixels_step(label='edit'):
+    return {'kind': PIXELS, 'label': label}
+
+
+def original_step():
+    return {'kind': ORIGINAL, 'label': 'reset'}
+
+
+def load(history_dir):
+    """Returns the history (base keyframe, steps, position), empty if there is none"""
+    try:
+        with open(os.path.join(history_dir, HISTORY_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'base': None, 'steps': [], 'position': 0}
+
+
+def _save(history_dir, history):
+    path = os.path.join(history_dir, HISTORY_FILE)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f)
+    os.replace(tmp_path, path)
+
+
+def summary(history):
+    """History for the client"""
+    return {
+        'position': history['position'],
+        'steps': [step['label'] for step in history['steps']],
+        'can_undo': history['position'] > 0,
+        'can_redo': history['position'] < len(history['steps'])
+    }
+
+
+def _write_keyframe(history_dir, name, img):
+    path = os.path.join(history_dir, name)
+    img.save(path, 'PNG', compress_level=1, **metadata_of(img))
+    return os.path.getsize(path)
+
+
+def _remove_file(history_dir, name):
+    """Deletes a keyframe. Returns the bytes freed."""
+    path = os.path.join(history_dir, name)
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+
+def set_base(history_dir, source_path):
+    """Starts a history from an already edited image (copied as base keyframe). Returns the bytes written."""
+    with lock_for(history_dir):
+        history = load(history_dir)
+        if history['steps'] or history['base']:
+            return 0
+        os.makedirs(history_dir, exist_ok=True)
+        shutil.copyfile(source_path, os.path.join(history_dir, 'base.png'))
+        history['base'] = 'base.png'
+        _save(history_dir, history)
+        return os.path.getsize(os.path.join(history_dir, 'base.png'))
+
+
+def prepare(history_dir, img, step, max_steps, keyframe_interval):
+    """Completes step (with img as its result) for record and writes its keyframe, if it gets one.
+
+    The history itself does not change: the step's 'bytes' (0 without a
+    keyframe) can be checked against a quota first, and discard drops the
+    keyframe again if the step is not recorded.
+    """
+    with lock_for(history_dir):
+        os.makedirs(history_dir, exist_ok=True)
+        history = load(history_dir)
+        since_keyframe = 0
+        for previous in reversed(history['steps'][:history['position']]):
+            if previous.get('keyframe') or previous['kind'] == ORIGINAL:
+                break
+            since_keyframe += 1
+
+        # At least one keyframe within max_steps, so trimming always finds a cut
+        keyframe_interval = min(keyframe_interval, max_steps)
+        step = {**step, 'width': img.width, 'height': img.height, 'created_at': time.time(), 'keyframe': None,
+                'bytes': 0}
+        if step['kind'] == PIXELS or (step['kind'] != ORIGINAL and since_keyframe + 1 >= keyframe_interval):
+            step['keyframe'] = f'step_{time.time_ns():x}.png'
+            step['bytes'] = _write_keyframe(history_dir, step['keyframe'], img)
+        return step
+
+
+def discard(history_dir, step):
+    """Deletes the keyframe of a prepared step that is not recorded"""
+    if step['keyframe']:
+        _remove_file(history_dir, step['keyframe'])
+
+
+def record(history_dir, step, max_steps, max_bytes):
+    """Adds a prepared step after the current position. Returns the byte change (its keyframe included).
+
+    Steps that could be redone are discarded.
+    """
+    with lock_for(history_dir):
+        history = load(history_dir)
+        delta = step['bytes']
+
+        # A new edit after undo replaces the steps that could have been redone
+        for dropped in history['steps'][history['position']:]:
+            if dropped.get('keyframe'):
+                delta -= _remove_file(history_dir, dropped['keyframe'])
+        steps = history['steps'][:history['position']] + [step]
+        history['steps'] = steps
+        history['position'] = len(steps)
+
+        delta -= _trim(history_dir, history, max_steps, max_bytes)
+        _save(history_dir, history)
+        return delta
+
+
+def _trim(history_dir, history, max_steps, max_bytes):
+    """Drops the oldest steps up to a keyframe (or reset) while over budget. Returns the bytes freed."""
+    freed = 0
+    while True:
+        steps = history['steps']
+        total = sum(step.get('bytes', 0) for step in steps)
+        if len(steps) <= max_steps and total <= max_bytes:
+            return freed
+
+        # The first keyframe becomes the new base (a reset: the original); never
+        # drop the current step
+        index = next((i for i, step in enumerate(steps) if step.get('keyframe') or step['kind'] == ORIGINAL), None)
+        if index is None or index >= history['position']:
+            return freed
+        if history['base']:
+            freed += _remove_file(history_dir, history['base'])
+        for dropped in steps[:index]:
+            if dropped.get('keyframe'):
+                freed += _remove_file(history_dir, dropped['keyframe'])
+        history['base'] = steps[index]['keyframe']
+        history['steps'] = steps[index + 1:]
+        history['position'] -= index + 1
+
+
+def _replay(img, step):
+    if step['kind'] == OPERATION:
+        for operation in step['operations']:
+            img = apply_operation_to_image(img, operation['operation'], operation['params'])
+        return img
+    return run_pipeline(img, compile_operations(step['operations']))
+
+
+def restore(history_dir, history, position, load_original):
+    """Rebuilds the image at position from the nearest keyframe (or the original) before it"""
+    steps = history['steps']
+    start = position
+    while start > 0 and not steps[start - 1].get('keyframe') and steps[start - 1]['kind'] != ORIGINAL:
+        start -= 1
+
+    if start > 0 and steps[start - 1].get('keyframe'):
+        img = open_image(os.path.join(history_dir, steps[start - 1]['keyframe']))
+    elif start == 0 and history['base']:
+        img = open_image(os.path.join(history_dir, history['base']))
+    else:
+        img = load_original()
+
+    for step in steps[start:position]:
+        img = _replay(img, step)
+    return img
+
+
+def move(history_dir, offset, load_original):
+    """Moves offset steps back (negative) or forward. Returns (image, history)."""
+    with lock_for(history_dir):
+        history = load(history_dir)
+        position = history['position'] + offset
+        if position < 0 or position > len(history['steps']):
+            raise HistoryError('Nothing to undo' if offset < 0 else 'Nothing to redo')
+
+        img = restore(history_dir, history, position, load_original)
+        history['position'] = position
+        _save(history_dir, history)
+        return img, history
+
+
+def remove(history_dir):
+    """Deletes a history. Returns the bytes freed."""
+    if not os.path.isdir(history_dir):
+        return 0
+    freed = 0
+    for name in os.listdir(history_dir):
+        try:
+            freed += os.path.getsize(os.path.join(history_dir, name))
+        except OSError:
+            pass
+    shutil.rmtree(history_dir, ignore_errors=True)
+    return freed
@@ -0,0 +1,579 @@
+"""
+Bildwerkzeug - Image helpers
+
+Decoding, encoding and the image operations. Kept free of Flask so they can
+be used by the web app as well as from the command line.
+"""
+
+from PIL import Image, ImageFilter, ImageEnhance, ImageOps, features
+import io
+import base64
+import importlib
+import math
+import time
+
+from frames import Animation, ANIMATED_FORMATS, is_animated
+from precision import HighBitImage, HIGH_BIT_FORMATS, high_bit_depth, open_high_bit
+from stats import AUTO_OPERATIONS, MAX_WHITE_BALANCE_GAIN, compute_stats, resolve_auto_operation
+
+
+# Download formats: name -> (Pillow format, mimetype)
+EXPORT_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+    'jxl': ('JXL', 'image/jxl'),
+    'gif': ('GIF', 'image/gif'),
+    'tiff': ('TIFF', 'image/tiff'),
+}
+
+# Plugins providing optional formats on Pillow builds without them
+ENCODER_PLUGINS = {
+    'avif': 'pillow_avif',
+    'jxl': 'pillow_jxl',
+}
+
+# Pillow's own plugin per format. Imported on demand instead of all plugins at once (Image.init).
+PILLOW_PLUGINS = {
+    'PNG': 'PIL.PngImagePlugin',
+    'JPEG': 'PIL.JpegImagePlugin',
+    'WEBP': 'PIL.WebPImagePlugin',
+    'AVIF': 'PIL.AvifImagePlugin',
+    'GIF': 'PIL.GifImagePlugin',
+    'TIFF': 'PIL.TiffImagePlugin',
+}
+
+# Formats whose encoders are too slow for a request thread
+SLOW_EXPORT_FORMATS = ('avif', 'jxl')
+
+# Encoder settings per export profile, from fastest to smallest output.
+# 'fast' matches plain save() calls (baseline JPEG, PNG level 1 instead of 6).
+EXPORT_PROFILES = {
+    'fast': {
+        'JPEG': {},
+        'WEBP': {'method': 0},
+        'PNG': {'compress_level': 1},
+        'AVIF': {'speed': 8},
+        'JXL': {'effort': 3},
+        'TIFF': {'compression': 'raw'},
+    },
+    'balanced': {
+        'JPEG': {'optimize': True, 'progressive': True},
+        'WEBP': {'method': 4},
+        'PNG': {'compress_level': 6},
+        'AVIF': {'speed': 6},
+        'JXL': {'effort': 7},
+        'GIF': {'optimize': True},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+    },
+    'smallest': {
+        'JPEG': {'optimize': True, 'progressive': True, 'subsampling': '4:2:0', 'qtables': 'robidoux'},
+        'WEBP': {'method': 6},
+        'PNG': {'optimize': True},
+        'AVIF': {'speed': 3},
+        'JXL': {'effort': 9},
+        'GIF': {'optimize': True},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+    },
+}
+
+# Quantization table used by mozjpeg and libjpeg-turbo's cjpeg -quant-table 3
+# (N. Robidoux). Smaller files than the standard table at the same quality.
+ROBIDOUX_QTABLE = [
+    16, 16, 16, 18, 25, 37, 56, 85,
+    16, 17, 20, 27, 34, 40, 53, 75,
+    16, 20, 24, 31, 43, 62, 91, 135,
+    18, 27, 31, 40, 53, 74, 106, 156,
+    25, 34, 43, 53, 69, 94, 131, 189,
+    37, 40, 62, 74, 94, 124, 169, 238,
+    56, 53, 91, 106, 131, 169, 226, 311,
+    85, 75, 135, 156, 189, 238, 311, 418,
+]
+
+JPEG_SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')
+
+# Metadata carried from the upload through edits into exports
+METADATA_KEYS = ('icc_profile', 'exif')
+
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# JPEG stores EXIF in a single APP1 segment
+MAX_JPEG_EXIF_BYTES = 65533
+
+# Highest white point of levels: above 255 a channel gets darker, as the
+# automatic white balance does with its strongest gain
+LEVELS_MAX_WHITE = 255 * MAX_WHITE_BALANCE_GAIN
+
+
+def decode_base64(base64_string):
+    """Returns the raw bytes of a (data URL) Base64 string"""
+    if ',' in base64_string:
+        base64_string = base64_string.split(',')[1]
+    return base64.b64decode(base64_string)
+
+
+def _as_file(source):
+    """Bytes as a file object, paths as they are"""
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+
+def probe_image(source):
+    """Reads format, size and metadata from the image header without decoding pixels.
+    
+    source is bytes or a path. width/height are the displayed size, i.e. after
+    applying the EXIF orientation.
+    """
+    img = Image.open(_as_file(source))
+    
+    # getexif() would decode PNGs that have no EXIF in the header, so only ask if there is some
+    orientation = img.getexif().get(0x0112, 1) if img.info.get('exif') else 1
+    width, height = img.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    
+    return {
+        'format': img.format,
+        'mode': img.mode,
+        'width': width,
+        'height': height,
+        'orientation': orientation,
+        'frames': img.n_frames if is_animated(img) else 1,
+        'bit_depth': high_bit_depth(img) or 8,
+        'icc_profile': bool(img.info.get('icc_profile')),
+        'exif': bool(img.info.get('exif'))
+    }
+
+
+def prepare_image(img):
+    """Applies the EXIF orientation and converts palette images (decodes the image)"""
+    ImageOps.exif_transpose(img, in_place=True)
+    if img.mode == 'P':
+        converted = img.convert('RGBA')
+        converted.info.update(metadata_of(img))
+        img = converted
+    return img
+
+
+def open_image(source):
+    """Opens an image from a path or bytes, ready for editing.
+    
+    Returns an Animation if it has several frames and a HighBitImage if it
+    has more than 8 bits per channel (and NumPy is installed).
+    """
+    img = Image.open(_as_file(source))
+    if is_animated(img):
+        img.close()
+        return Animation(source)
+    if high_bit_depth(img):
+        high_bit = open_high_bit(source)
+        if high_bit is not None:
+            img.close()
+            return high_bit
+    return prepare_image(img)
+
+
+def pillow_image(img):
+    """A single 8-bit Pillow image: the first frame of an animation, a high bit depth image quantized"""
+    if isinstance(img, Animation):
+        return img.first_frame()
+    if isinstance(img, HighBitImage):
+        return img.to_pillow()
+    return img
+
+
+def open_preview(source, size):
+    """Opens an image (path or bytes) for a preview of at most size, decoding JPEGs at reduced scale"""
+    img = Image.open(_as_file(source))
+    # Square box, because the orientation may still swap width and height
+    box = (max(size), max(size))
+    img.draft(img.mode, box)
+    return prepare_image(img)
+
+
+def open_reduced(source, max_dimension):
+    """Opens an image (path or bytes) scaled down to at most max_dimension on its longer side.
+    
+    JPEGs are decoded at reduced scale and shrunk further with reduce() before
+    the final resampling, so their full-resolution pixels are never held.
+    Smaller images are returned at their size.
+    """
+    img = Image.open(_as_file(source))
+    # Square box, because the orientation may still swap width and height
+    box = (max_dimension, max_dimension)
+    if is_animated(img):
+        img.close()
+        return Animation(source).map(_reduce_frame, box)
+    if high_bit_depth(img):
+        high_bit = open_high_bit(source)
+        if high_bit is not None:
+            img.close()
+            return apply_operation_to_image(high_bit, 'resize', {'width': max_dimension, 'height': max_dimension})
+    img.draft(img.mode, box)
+    img.thumbnail(box, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return prepare_image(img)
+
+
+def _reduce_frame(frame, box):
+    frame.thumbnail(box, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return frame
+
+
+def base64_to_image(base64_string):
+    """Converts Base64 string to PIL Image"""
+    return open_image(decode_base64(base64_string))
+
+
+def metadata_of(img):
+    """ICC profile and EXIF of an image as save() keyword arguments"""
+    return {key: img.info[key] for key in METADATA_KEYS if img.info.get(key)}
+
+
+def image_to_base64(img, format='PNG'):
+    """Converts a PIL Image to Base64 string"""
+    buffered = io.BytesIO()
+    
+    if format.upper() == 'JPEG':
+        save_kwargs = jpeg_metadata(img)
+        img = flatten_to_rgb(pillow_image(img))
+        img.save(buffered, format='JPEG', quality=95, **save_kwargs)
+        mime = 'image/jpeg'
+    else:
+        img.save(buffered, format='PNG', **metadata_of(img))
+        mime = 'image/png'
+    
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:{mime};base64,{img_str}"
+
+
+def flatten_to_rgb(img):
+    """Converts an image to RGB, putting transparent areas on white"""
+    if img.mode == 'RGBA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+
+def jpeg_metadata(img):
+    """Like metadata_of, but leaves out EXIF that does not fit into a JPEG"""
+    metadata = metadata_of(img)
+    if len(metadata.get('exif', b'')) > MAX_JPEG_EXIF_BYTES:
+        del metadata['exif']
+    return metadata
+
+
+def load_encoder(format_type):
+    """Makes sure Pillow can save format_type, importing only the plugins it needs"""
+    pil_format = EXPORT_FORMATS[format_type][0]
+    for module in (PILLOW_PLUGINS.get(pil_format), ENCODER_PLUGINS.get(format_type)):
+        if pil_format in Image.SAVE:
+            break
+        if module:
+            try:
+                importlib.import_module(module)
+            except ImportError:
+                pass
+    return pil_format in Image.SAVE
+
+
+def available_export_formats():
+    """Export formats that can be encoded with the installed Pillow and plugins"""
+    return [name for name in EXPORT_FORMATS if load_encoder(name)]
+
+
+def has_libjpeg_turbo():
+    """True if Pillow is built against libjpeg-turbo (fast progressive encoding)"""
+    return bool(features.check_feature('libjpeg_turbo'))
+
+
+def parse_flag(value):
+    """A boolean request value: true, 1 and yes (any case) are true, everything else false"""
+    return value if isinstance(value, bool) else str(value).lower() in ('true', '1', 'yes')
+
+
+def encoder_options(pil_format, profile='balanced', lossless=None, subsampling=None):
+    """Returns the save() keyword arguments of an export profile"""
+    if profile not in EXPORT_PROFILES:
+        raise ValueError(f'Unknown export profile: {profile}')
+    options = dict(EXPORT_PROFILES[profile].get(pil_format, {}))
+    
+    if pil_format == 'JPEG':
+        # Progressive Huffman coding is slow without libjpeg-turbo's SIMD code
+        if profile == 'balanced' and not has_libjpeg_turbo():
+            options.pop('progressive', None)
+        if options.get('qtables') == 'robidoux':
+            options['qtables'] = [ROBIDOUX_QTABLE, ROBIDOUX_QTABLE]
+        if subsampling:
+            options['subsampling'] = subsampling
+    elif pil_format in ('WEBP', 'JXL') and lossless is not None:
+        options['lossless'] = parse_flag(lossless)
+    return options
+
+
+def encode_image(img, format_type='png', quality=95, profile='balanced', lossless=None, subsampling=None):
+    """Encodes an image for download (with ICC profile and EXIF). Returns (bytes, mimetype)."""
+    format_type = format_type.lower()
+    pil_format, mimetype = EXPORT_FORMATS.get(format_type, EXPORT_FORMATS['png'])
+    if pil_format not in ('PNG', 'JPEG', 'WEBP') and not load_encoder(format_type):
+        raise ValueError(f'{format_type} export is not available on this server')
+    options = encoder_options(pil_format, profile, lossless, subsampling)
+    img_bytes = io.BytesIO()
+    # Frames and bit depth are kept where the format can store them
+    if (isinstance(img, Animation) and pil_format not in ANIMATED_FORMATS) or \
+            (isinstance(img, HighBitImage) and pil_format not in HIGH_BIT_FORMATS):
+        img = pillow_image(img)
+    
+    if pil_format == 'JPEG':
+        rgb = flatten_to_rgb(img)
+        try:
+            rgb.save(img_bytes, format='JPEG', quality=quality, **options, **jpeg_metadata(img))
+        except OSError:
+            # Optimized/progressive JPEGs are written from one buffer sized for typical
+            # photos; nearly incompressible images overflow it, so write them baseline
+            options.pop('optimize', None)
+            options.pop('progressive', None)
+            img_bytes = io.BytesIO()
+            rgb.save(img_bytes, format='JPEG', quality=quality, **options, **jpeg_metadata(img))
+    elif pil_format != 'PNG':
+        metadata = metadata_of(img)
+        if img.mode not in ('L', 'RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        # GIF and TIFF have no quality setting
+        if pil_format not in ('GIF', 'TIFF'):
+            options['quality'] = quality
+        img.save(img_bytes, format=pil_format, **options, **metadata)
+    else:
+        img.save(img_bytes, format='PNG', **options, **metadata_of(img))
+    
+    return img_bytes.getvalue(), mimetype
+
+
+def encode_image_timed(img, format_type='png', quality=95, profile='balanced', lossless=None, subsampling=None):
+    """Like encode_image, but also returns the encode time. Returns (bytes, mimetype, seconds)."""
+    started = time.perf_counter()
+    encoded, mimetype = encode_image(img, format_type, quality, profile, lossless, subsampling)
+    return encoded, mimetype, time.perf_counter() - started
+
+
+def max_size_encoding(params):
+    """encode_image arguments after the image for a resize_max_size operation: the file it checks
+    is encoded like the download (format, quality, profile, lossless, subsampling)"""
+    return (params.get('format') or 'jpeg', int(params.get('quality', 85)),
+            params.get('profile') or 'balanced', params.get('lossless'), params.get('subsampling'))
+
+
+def thumbnail_size(size, box):
+    """The size Image.thumbnail(box) gives an image of size (aspect ratio kept, never enlarged)"""
+    width, height = size
+    x, y = math.floor(box[0]), math.floor(box[1])
+    if x >= width and y >= height:
+        return size
+    
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+    
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def channel_values(value):
+    """Levels parameter: one value for all colour channels, or a list of three (red, green, blue)"""
+    values = list(value) if isinstance(value, (list, tuple)) else [value]
+    if len(values) not in (1, 3):
+        raise ValueError('Expected one value or three (red, green, blue)')
+    values = [float(v) for v in values]
+    return values * 3 if len(values) == 1 else values
+
+
+def levels_params(params):
+    """black and white of a levels operation as three values each (ValueError unless 0 <= black < white <= LEVELS_MAX_WHITE)"""
+    black = channel_values(params.get('black', 0))
+    white = channel_values(params.get('white', 255))
+    if not all(0 <= low < high <= LEVELS_MAX_WHITE for low, high in zip(black, white)):
+        raise ValueError(f'Levels need 0 <= black < white <= {LEVELS_MAX_WHITE:g}')
+    return black, white
+
+
+def apply_levels(img, black, white):
+    """Maps black..white (0-255 scale, per colour channel) to the full range; alpha stays as is"""
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    if img.mode in ('L', 'LA'):
+        # One channel: the mean of the three
+        black, white = [sum(black) / 3], [sum(white) / 3]
+    table = []
+    for index, band in enumerate(img.getbands()):
+        if band == 'A':
+            table += range(256)
+        else:
+            low, high = black[index], white[index]
+            scale = 255 / (high - low)
+            table += [min(255, max(0, round((value - low) * scale))) for value in range(256)]
+    return img.point(table)
+
+
+def _apply_to_high_bit(img, operation, params):
+    """apply_operation_to_image for a HighBitImage: same parameters, float precision"""
+    if operation == 'resize':
+        width = int(params.get('width', img.width))
+        height = int(params.get('height', img.height))
+        if params.get('keep_aspect', True):
+            size = thumbnail_size(img.size, (width, height))
+            return img.resize(size) if size != img.size else img
+        return img.resize((width, height))
+    
+    if operation == 'resize_percent':
+        percent = float(params.get('percent', 100))
+        return img.resize((max(1, int(img.width * percent / 100)), max(1, int(img.height * percent / 100))))
+    
+    if operation == 'resize_max_size':
+        # The limit is about the 8-bit file, so the size is found on the quantized image
+        size = apply_operation_to_image(img.to_pillow(), operation, params).size
+        return img.resize(size) if size != img.size else img
+    
+    if operation == 'rotate':
+        return img.rotate(-int(params.get('angle', 90)))
+    if operation == 'flip_horizontal':
+        return img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if operation == 'flip_vertical':
+        return img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    if operation == 'grayscale':
+        return img.grayscale()
+    if operation == 'blur':
+        return img.gaussian_blur(float(params.get('radius', 2)))
+    if operation == 'sharpen':
+        return img.sharpen(float(params.get('factor', 2)))
+    if operation == 'brightness':
+        return img.brightness(float(params.get('factor', 1.0)))
+    if operation == 'contrast':
+        return img.contrast(float(params.get('factor', 1.0)))
+    if operation == 'saturation':
+        return img.saturation(float(params.get('factor', 1.0)))
+    if operation == 'crop':
+        return img.crop((
+            int(params.get('left', 0)),
+            int(params.get('top', 0)),
+            int(params.get('right', img.width)),
+            int(params.get('bottom', img.height))
+        ))
+    if operation == 'levels':
+        return img.levels(*levels_params(params))
+    return img
+
+
+def apply_operation_to_image(img, operation, params):
+    """Applies an operation to an image (ICC profile and EXIF are kept).
+    
+    Animations get it on every frame, high bit depth images in float precision.
+    Automatic operations are resolved from statistics of the image itself
+    (stored images are resolved beforehand from their cached statistics).
+    """
+    if operation in AUTO_OPERATIONS:
+        operation, params = resolve_auto_operation(operation, params, compute_stats(pillow_image(img)))
+    if isinstance(img, HighBitImage):
+        return _apply_to_high_bit(img, operation, params)
+    if isinstance(img, Animation):
+        if operation == 'resize_max_size':
+            # One size for all frames, found on the first
+            width, height = apply_operation_to_image(img.first_frame().copy(), operation, params).size
+            operation, params = 'resize', {'width': width, 'height': height, 'keep_aspect': False}
+        return img.map(apply_operation_to_image, operation, params)
+    
+    metadata = metadata_of(img)
+    
+    if operation == 'resize':
+        width = int(params.get('width', img.width))
+        height = int(params.get('height', img.height))
+        keep_aspect = params.get('keep_aspect', True)
+        
+        if keep_aspect:
+            img.thumbnail((width, height), Image.Resampling.LANCZOS)
+        else:
+            img = img.resize((width, height), Image.Resampling.LANCZOS)
+    
+    elif operation == 'resize_percent':
+        percent = float(params.get('percent', 100))
+        new_width = max(1, int(img.width * percent / 100))
+        new_height = max(1, int(img.height * percent / 100))
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    
+    elif operation == 'resize_max_size':
+        max_size_mb = float(params.get('max_size_mb', 1.0))
+        encoding = max_size_encoding(params)
+        max_bytes = int(max_size_mb * 1024 * 1024)
+        
+        if encoding[0].lower() in ('jpeg', 'jpg') and img.mode == 'RGBA':
+            img = flatten_to_rgb(img)
+        
+        scale = 1.0
+        while scale > 0.1:
+            test_img = img.copy()
+            if scale < 1.0:
+                new_size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+                test_img = img.resize(new_size, Image.Resampling.LANCZOS)
+            
+            if len(encode_image(test_img, *encoding)[0]) <= max_bytes:
+                img = test_img
+                break
+            
+            scale -= 0.05
+            
+    elif operation == 'rotate':
+        angle = int(params.get('angle', 90))
+        img = img.rotate(-angle, expand=True)
+        
+    elif operation == 'flip_horizontal':
+        img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        
+    elif operation == 'flip_vertical':
+        img = img.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        
+    elif operation == 'grayscale':
+        img = img.convert('L').convert('RGB')
+        
+    elif operation == 'blur':
+        radius = float(params.get('radius', 2))
+        img = img.filter(ImageFilter.GaussianBlur(radius=radius))
+        
+    elif operation == 'sharpen':
+        factor = float(params.get('factor', 2))
+        enhancer = ImageEnhance.Sharpness(img)
+        img = enhancer.enhance(factor)
+        
+    elif operation == 'brightness':
+        factor = float(params.get('factor', 1.0))
+        enhancer = ImageEnhance.Brightness(img)
+        img = enhancer.enhance(factor)
+        
+    elif operation == 'contrast':
+        factor = float(params.get('factor', 1.0))
+        enhancer = ImageEnhance.Contrast(img)
+        img = enhancer.enhance(factor)
+        
+    elif operation == 'saturation':
+        factor = float(params.get('factor', 1.0))
+        enhancer = ImageEnhance.Color(img)
+        img = enhancer.enhance(factor)
+        
+    elif operation == 'crop':
+        left = int(params.get('left', 0))
+        top = int(params.get('top', 0))
+        right = int(params.get('right', img.width))
+        bottom = int(params.get('bottom', img.height))
+        img = img.crop((left, top, right, bottom))
+    
+    elif operation == 'levels':
+        img = apply_levels(img, *levels_params(params))
+    
+    for key, value in metadata.items():
+        img.info.setdefault(key, value)
+    return img
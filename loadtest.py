@@ -0,0 +1,426 @@
+"""
+Bildwerkzeug - Load test with simulated editor sessions
+
+Every virtual user runs sessions like the browser does: log in, upload
+images, move sliders (/api/process), edit all images at once
+(/api/process_batch), load the images and download them as ZIP, then
+clear the workspace. Images and slider values come from a seeded random
+generator, so two runs with the same options send the same requests and
+only the server configuration differs between them.
+
+The report has the throughput, latency percentiles per endpoint and the
+memory (RSS) of the server processes. Only the standard library is used
+for HTTP; Pillow generates the test images.
+"""
+
+import base64
+import http.cookiejar
+import io
+import json
+import math
+import os
+import random
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+# Slider operations and the range of their factor, as the editor sends them
+SLIDER_OPERATIONS = (('brightness', 0.5, 1.5), ('contrast', 0.5, 1.5), ('saturation', 0.0, 2.0))
+
+# Batch operations a session picks from
+BATCH_OPERATIONS = (
+    ('resize_percent', {'percent': 50}),
+    ('rotate', {'angle': 90}),
+    ('sharpen', {'factor': 2.0}),
+    ('grayscale', {}),
+)
+
+# Seconds between two memory samples
+MEMORY_SAMPLE_INTERVAL = 0.5
+
+# Accounts of the virtual users when login is required (created by the admin, kept for later runs)
+ACCOUNT_PREFIX = 'loadtest-'
+ACCOUNT_PASSWORD = 'loadtest'
+
+
+class LoadTestError(Exception):
+    """The server could not be reached or a session could not start"""
+
+
+# ==================== TEST IMAGES ====================
+
+def make_image(width, height, seed):
+    """A photo-like JPEG (data URL): gradients, shapes and noise, same for the same seed"""
+    rng = random.Random(seed)
+    img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    tint = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    img = Image.blend(img, tint, 0.5)
+    draw = ImageDraw.Draw(img)
+    for _ in range(24):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randrange(max(2, min(width, height) // 4))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                     fill=tuple(rng.randrange(256) for _ in range(3)))
+    img = img.filter(ImageFilter.GaussianBlur(2))
+    noise = Image.frombytes('L', (width, height), rng.randbytes(width * height)).convert('RGB')
+    img = Image.blend(img, noise, 0.15)
+
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def parse_sizes(text):
+    """[(width, height)] from 'WIDTHxHEIGHT,...'"""
+    sizes = []
+    for part in filter(None, (entry.strip() for entry in text.split(','))):
+        width, _, height = part.lower().partition('x')
+        sizes.append((int(width), int(height)))
+    if not sizes:
+        raise ValueError('No image size given')
+    return sizes
+
+
+# ==================== STATISTICS ====================
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Recorder:
+    """Collects the duration and outcome of every request, per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+
+    def add(self, endpoint, seconds, ok, sent=0, received=0):
+        with self._lock:
+            entry = self.requests.setdefault(endpoint, {'times': [], 'errors': 0, 'sent': 0, 'received': 0})
+            entry['times'].append(seconds)
+            entry['errors'] += 0 if ok else 1
+            entry['sent'] += sent
+            entry['received'] += received
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, entry in sorted(self.requests.items()):
+            times = sorted(entry['times'])
+            endpoints[endpoint] = {
+                'requests': len(times),
+                'errors': entry['errors'],
+                'per_second': round(len(times) / elapsed, 2) if elapsed else None,
+                'mean_ms': round(sum(times) / len(times) * 1000, 1),
+                'p50_ms': round(percentile(times, 0.50) * 1000, 1),
+                'p95_ms': round(percentile(times, 0.95) * 1000, 1),
+                'p99_ms': round(percentile(times, 0.99) * 1000, 1),
+                'max_ms': round(times[-1] * 1000, 1),
+                'sent_mb': round(entry['sent'] / 1024 / 1024, 2),
+                'received_mb': round(entry['received'] / 1024 / 1024, 2)
+            }
+        return endpoints
+
+
+# ==================== MEMORY ====================
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _process_tree(pid):
+    """pid and all its descendants (Linux /proc)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the parent follows the closing parenthesis
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+class MemorySampler:
+    """Samples the RSS of a server process and its workers in the background"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = {}
+        self.last = {}
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.pid and os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(MEMORY_SAMPLE_INTERVAL)
+
+    def sample(self):
+        sizes = {pid: rss for pid in _process_tree(self.pid) if (rss := _rss_kb(pid)) is not None}
+        self.last = sizes
+        for pid, rss in sizes.items():
+            self.peak[pid] = max(self.peak.get(pid, 0), rss)
+        self.peak_total = max(self.peak_total, sum(sizes.values()))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+            self.sample()
+
+    def summary(self):
+        if not self.peak:
+            return None
+        return {
+            'processes': len(self.peak),
+            'peak_total_mb': round(self.peak_total / 1024, 1),
+            'final_total_mb': round(sum(self.last.values()) / 1024, 1),
+            'peak_per_process_mb': {str(pid): round(rss / 1024, 1) for pid, rss in sorted(self.peak.items())}
+        }
+
+
+# ==================== SESSIONS ====================
+
+class Client:
+    """HTTP client of one virtual user (keeps its cookies)"""
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, endpoint=None, json_body=None, form=None):
+        """Sends a request and records it under endpoint. Returns (status, body bytes)."""
+        headers = {}
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except (urllib.error.URLError, OSError):
+            status, body = None, b''
+        self.recorder.add(endpoint or f'{method} {path}', time.perf_counter() - started,
+                          status is not None and status < 400, len(data or b''), len(body))
+        return status, body
+
+    def json(self, method, path, endpoint=None, **kwargs):
+        status, body = self.request(method, path, endpoint, **kwargs)
+        try:
+            return status, json.loads(body) if body else {}
+        except ValueError:
+            return status, {}
+
+
+def log_in(client, username, password):
+    """Opens the editor, logging in if the server asks for it. Returns True if the editor was reached."""
+    status, body = client.request('GET', '/', 'GET /')
+    if status is not None and b'name="password"' in body:
+        status, body = client.request('POST', '/login', 'POST /login',
+                                      form={'username': username, 'password': password})
+    return status == 200 and b'name="password"' not in body
+
+
+def prepare_accounts(base_url, users, admin_username, admin_password, timeout):
+    """Account (username, password) per virtual user, so their workspaces are separate.
+
+    Without required login every session is anonymous anyway. Otherwise
+    the admin creates the accounts that do not exist yet.
+    """
+    admin = Client(base_url, Recorder(), timeout)
+    status, body = admin.request('GET', '/')
+    if b'name="password"' not in body:
+        return [(None, None)] * users
+    if not log_in(admin, admin_username, admin_password):
+        raise LoadTestError(f'Could not log in as {admin_username}')
+    accounts = []
+    for index in range(users):
+        username = f'{ACCOUNT_PREFIX}{index}'
+        status, data = admin.json('POST', '/api/admin/users', json_body={
+            'username': username, 'email': f'{username}@localhost', 'password': ACCOUNT_PASSWORD
+        })
+        if status != 200 and 'taken' not in data.get('error', ''):
+            raise LoadTestError(f'Could not create {username}: {data.get("error", status)}')
+        accounts.append((username, ACCOUNT_PASSWORD))
+    return accounts
+
+
+def run_session(client, account, images, rng, options):
+    """One editor session. Returns True if it got through to the download."""
+    if not log_in(client, *account):
+        return False
+
+    image_ids = []
+    for index, image in enumerate(images):
+        status, data = client.json('POST', '/api/images', 'POST /api/images',
+                                   json_body={'image': image, 'filename': f'loadtest_{index}.jpg'})
+        if status == 200 and data.get('image'):
+            image_ids.append(data['image']['id'])
+    if not image_ids:
+        return False
+
+    # Slider edits on the current image, like dragging and releasing a slider
+    for _ in range(options['edits']):
+        operation, low, high = rng.choice(SLIDER_OPERATIONS)
+        client.json('POST', '/api/process', 'POST /api/process', json_body={
+            'image_id': rng.choice(image_ids),
+            'operation': operation,
+            'params': {'factor': round(rng.uniform(low, high), 2)}
+        })
+
+    operation, params = rng.choice(BATCH_OPERATIONS)
+    client.json('POST', '/api/process_batch', 'POST /api/process_batch',
+                json_body={'image_ids': image_ids, 'operation': operation, 'params': params})
+
+    # The browser loads every image before sending them for the ZIP
+    downloads = []
+    for index, image_id in enumerate(image_ids):
+        status, data = client.json('GET', f'/api/images/{image_id}', 'GET /api/images/<id>')
+        if status == 200 and data.get('image'):
+            downloads.append({'filename': f'loadtest_{index}.jpg', 'image': data['image']})
+    status, _ = client.request('POST', '/api/download_zip', 'POST /api/download_zip', json_body={
+        'images': downloads, 'format': options['format'], 'quality': options['quality']
+    })
+
+    client.request('DELETE', '/api/images/clear', 'DELETE /api/images/clear')
+    return status == 200
+
+
+def wait_for_server(base_url, timeout):
+    """Waits until the server answers /api/formats"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(base_url.rstrip('/') + '/api/formats', timeout=5):
+                return
+        except urllib.error.HTTPError:
+            return
+        except (urllib.error.URLError, OSError):
+            if time.monotonic() > deadline:
+                raise LoadTestError(f'No answer from {base_url}')
+            time.sleep(0.25)
+
+
+def run(base_url, users=4, sessions=3, images=3, sizes=((1920, 1080),), edits=10, seed=1,
+        username='admin', password='admin', download_format='jpeg', quality=85,
+        server_pid=None, timeout=300):
+    """Runs sessions per user on users threads against base_url. Returns the report (dict).
+
+    username and password are the admin's, who creates the accounts of the
+    virtual users if the server requires login. server_pid: process whose
+    memory (with its workers) is reported.
+    """
+    # Every user uploads the same images; generated before the clock starts
+    image_sizes = [sizes[index % len(sizes)] for index in range(images)]
+    test_images = [make_image(width, height, seed * 1000 + index) for index, (width, height) in enumerate(image_sizes)]
+    options = {'edits': edits, 'format': download_format, 'quality': quality}
+
+    wait_for_server(base_url, timeout=30)
+    accounts = prepare_accounts(base_url, users, username, password, timeout)
+    recorder = Recorder()
+    memory = MemorySampler(server_pid).start()
+    completed = []
+
+    def user(index):
+        # Own generator per user: the same requests whatever the thread timing
+        rng = random.Random(seed * 1000003 + index)
+        for _ in range(sessions):
+            client = Client(base_url, recorder, timeout)
+            completed.append(run_session(client, accounts[index], test_images, rng, options))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(index,), name=f'user-{index}') for index in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    memory.stop()
+
+    endpoints = recorder.summary(elapsed)
+    total_requests = sum(entry['requests'] for entry in endpoints.values())
+    return {
+        'options': {
+            'url': base_url, 'users': users, 'sessions_per_user': sessions, 'images': images,
+            'sizes': [f'{width}x{height}' for width, height in image_sizes], 'edits': edits,
+            'format': download_format, 'quality': quality, 'seed': seed
+        },
+        'seconds': round(elapsed, 2),
+        'sessions': {'completed': sum(completed), 'failed': len(completed) - sum(completed),
+                     'per_minute': round(sum(completed) / elapsed * 60, 2) if elapsed else None},
+        'requests': {'total': total_requests,
+                     'errors': sum(entry['errors'] for entry in endpoints.values()),
+                     'per_second': round(total_requests / elapsed, 2) if elapsed else None},
+        'endpoints': endpoints,
+        'memory': memory.summary()
+    }
+
+
+def start_server(command):
+    """Starts a server command line (e.g. a Gunicorn configuration to compare). Returns the process."""
+    # Its log goes to stderr, so stdout only has the report
+    return subprocess.Popen(shlex.split(command), stdout=sys.stderr)
+
+
+def format_report(report):
+    """The report as a table"""
+    options = report['options']
+    lines = [
+        f"{options['users']} users x {options['sessions_per_user']} sessions, {options['images']} images "
+        f"({', '.join(sorted(set(options['sizes'])))}), {options['edits']} edits, seed {options['seed']}",
+        f"{report['seconds']} s, {report['sessions']['completed']} sessions completed "
+        f"({report['sessions']['failed']} failed), {report['requests']['per_second']} requests/s",
+        '',
+        f"{'endpoint':<30}{'count':>7}{'err':>5}{'req/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    ]
+    for endpoint, entry in report['endpoints'].items():
+        lines.append(f"{endpoint:<30}{entry['requests']:>7}{entry['errors']:>5}{entry['per_second']:>8}"
+                     f"{entry['p50_ms']:>9.0f}{entry['p95_ms']:>9.0f}{entry['p99_ms']:>9.0f}{entry['max_ms']:>9.0f}")
+    memory = report['memory']
+    if memory:
+        lines += ['', f"Server memory: {memory['peak_total_mb']} MB peak, {memory['final_total_mb']} MB at the end "
+                      f"({memory['processes']} processes)"]
+    return '\n'.join(lines)
@@ -4,8 +4,15 @@ Bildwerkzeug - Database models
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+import json
+import os
+import threading
+import time
 
 db = SQLAlchemy()
 
@@ -23,6 +30,10 @@ class User(UserMixin, db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    quota_mb = db.Column(db.Integer)  # Storage quota (None = default from config, 0 = unlimited)
+    ingest_max_dimension = db.Column(db.Integer)  # Longest side on upload in px (None = default, 0 = full size)
+    
+    presets = db.relationship('Preset', backref='user', cascade='all, delete-orphan')
     
     def set_password(self, password):
         """Hash and store password"""
@@ -44,14 +55,160 @@ class User(UserMixin, db.Model):
             'is_admin': self.is_admin,
             'is_active': self.is_active,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'last_login': self.last_login.isoformat() if self.last_login else None
+            'last_login': self.last_login.isoformat() if self.last_login else None,
+            'quota_mb': self.quota_mb,
+            'ingest_max_dimension': self.ingest_max_dimension
+        }
+
+
+class Preset(db.Model):
+    """Saved list of operations (recipe) that can be applied to many images"""
+    
+    __tablename__ = 'presets'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    name = db.Column(db.String(80), nullable=False)
+    operations_json = db.Column(db.Text, nullable=False, default='[]')
+    is_shared = db.Column(db.Boolean, default=False)  # Visible to all users
+    ingest_max_dimension = db.Column(db.Integer)  # Longest side for uploads with this preset (None = user's setting)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    @property
+    def operations(self):
+        """List of {operation, params} dicts"""
+        return json.loads(self.operations_json or '[]')
+    
+    @operations.setter
+    def operations(self, operations):
+        self.operations_json = json.dumps(operations)
+    
+    def __repr__(self):
+        return f'<Preset {self.name}>'
+    
+    def to_dict(self):
+        """Preset as dictionary"""
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'name': self.name,
+            'operations': self.operations,
+            'is_shared': self.is_shared,
+            'ingest_max_dimension': self.ingest_max_dimension,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
 
+class UserCache:
+    """Short-lived per-process cache of users for the login check of every request.
+    
+    A change to a user is announced through the modification time of a stamp
+    file, so every worker drops its cache when any of them edits or deletes
+    a user.
+    """
+    
+    def __init__(self):
+        self.ttl = 0
+        self.stamp_path = None
+        self._users = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+    
+    def init_app(self, app, stamp_path):
+        self.ttl = app.config['USER_CACHE_SECONDS']
+        self.stamp_path = stamp_path
+    
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+    
+    def get(self, user_id):
+        """Column values of a cached user, or None"""
+        if not self.ttl:
+            return None
+        stamp = self._read_stamp()
+        with self._lock:
+            if stamp != self._stamp:
+                self._users.clear()
+                self._stamp = stamp
+            entry = self._users.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+    
+    def put(self, user):
+        if not self.ttl:
+            return
+        values = {column.name: getattr(user, column.name) for column in User.__table__.columns}
+        with self._lock:
+            self._users[user.id] = (time.monotonic() + self.ttl, values)
+    
+    def load(self, user_id):
+        """Returns the user in the current session, from the cache without a query if possible"""
+        values = self.get(user_id)
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self.put(user)
+            return user
+        
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    
+    def invalidate(self):
+        """Drops the cached users in all workers"""
+        with self._lock:
+            self._users.clear()
+        if self.stamp_path:
+            os.makedirs(os.path.dirname(self.stamp_path) or '.', exist_ok=True)
+            with open(self.stamp_path, 'a'):
+                pass
+            os.utime(self.stamp_path)
+
+
+user_cache = UserCache()
+
+
+def configure_sqlite(app):
+    """Sets WAL mode and the busy timeout on every new SQLite connection"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    
+    @event.listens_for(db.engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if app.config['SQLITE_WAL']:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.close()
+
+
+def add_missing_columns():
+    """Adds columns that were introduced after a table was created (SQLite has no migrations here)"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    db.session.commit()
+
+
 def init_db(app):
     """Initialize database and create admin user"""
     with app.app_context():
+        configure_sqlite(app)
         db.create_all()
+        add_missing_columns()
         
         # Check if admin exists
         admin = User.query.filter_by(username=app.config['ADMIN_USERNAME']).first()
@@ -66,7 +223,12 @@ def init_db(app):
             )
             admin.set_password(app.config['ADMIN_PASSWORD'])
             db.session.add(admin)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Created by another worker starting at the same time (no gunicorn --preload)
+                db.session.rollback()
+                return
             print(f"✅ Admin user '{app.config['ADMIN_USERNAME']}' created")
         else:
             print(f"ℹ️  Admin user '{app.config['ADMIN_USERNAME']}' already exists")
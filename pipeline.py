@@ -0,0 +1,314 @@
+"""
+Bildwerkzeug - Multi-operation pipelines
+
+An ordered list of {operation, params} is validated and compiled once into
+steps, which then run over a single decoded image. Neighbouring operations
+are fused where possible:
+
+- brightness runs become one lookup table (exactly the same result)
+- rotations by multiples of 90° and flips become one transpose (exact)
+- percent resizes become one resize (one resampling instead of several)
+- operations without effect (factor 1.0, 0° rotation, 100%) are dropped
+"""
+
+from collections import namedtuple
+
+from PIL import Image, ImageEnhance
+
+from frames import Animation
+from imaging import (
+    apply_operation_to_image, channel_values, levels_params, parse_flag, EXPORT_FORMATS, EXPORT_PROFILES, JPEG_SUBSAMPLING
+)
+from precision import HighBitImage
+from stats import AUTO_OPERATIONS, AUTO_PARAM_TYPES, resolve_auto_operation
+
+
+MAX_PIPELINE_OPERATIONS = 50
+MAX_CACHED_PLANS = 256
+
+
+class PipelineError(ValueError):
+    """Raised for invalid pipeline definitions"""
+
+
+# Parameter types per operation. Missing parameters keep the defaults of
+# apply_operation_to_image (some of them depend on the image size).
+PARAM_TYPES = {
+    'resize': {'width': int, 'height': int, 'keep_aspect': bool},
+    'resize_percent': {'percent': float},
+    'resize_max_size': {'max_size_mb': float, 'format': str, 'quality': int,
+                        'profile': str, 'lossless': bool, 'subsampling': str},
+    'rotate': {'angle': int},
+    'flip_horizontal': {},
+    'flip_vertical': {},
+    'grayscale': {},
+    'blur': {'radius': float},
+    'sharpen': {'factor': float},
+    'brightness': {'factor': float},
+    'contrast': {'factor': float},
+    'saturation': {'factor': float},
+    'crop': {'left': int, 'top': int, 'right': int, 'bottom': int},
+    'levels': {'black': channel_values, 'white': channel_values},
+    **AUTO_PARAM_TYPES,
+}
+
+# Parameter values that make an operation a no-op
+NO_OP_VALUES = {
+    'brightness': ('factor', 1.0),
+    'contrast': ('factor', 1.0),
+    'saturation': ('factor', 1.0),
+    'sharpen': ('factor', 1.0),
+    'blur': ('radius', 0.0),
+    'resize_percent': ('percent', 100.0),
+}
+
+# Internal operations produced by fusion
+POINT = 'point'          # params: {'lut': [256 values], 'factor': f} applied to colour bands
+TRANSPOSE = 'transpose'  # params: {'method': Image.Transpose}
+
+Step = namedtuple('Step', ['operation', 'params'])
+
+
+def resolve_params(operation, params):
+    """Validates the parameters of an operation and converts them to their types"""
+    if operation not in PARAM_TYPES:
+        raise PipelineError(f'Unknown operation: {operation}')
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        raise PipelineError(f'Parameters of {operation} must be an object')
+
+    resolved = {}
+    for name, param_type in PARAM_TYPES[operation].items():
+        if name not in params or params[name] is None:
+            continue
+        value = params[name]
+        try:
+            if param_type is bool:
+                resolved[name] = parse_flag(value)
+            else:
+                resolved[name] = param_type(value)
+        except (TypeError, ValueError):
+            raise PipelineError(f'Invalid value for {operation}.{name}: {value!r}')
+
+    if operation == 'crop':
+        if resolved.get('left', 0) < 0 or resolved.get('top', 0) < 0:
+            raise PipelineError('Crop coordinates must not be negative')
+    if operation == 'levels':
+        try:
+            levels_params(resolved)
+        except ValueError as e:
+            raise PipelineError(str(e))
+    if operation == 'resize_max_size':
+        if (resolved.get('format') or 'jpeg').lower() not in EXPORT_FORMATS:
+            raise PipelineError(f"Unsupported format for {operation}: {resolved['format']}")
+        if (resolved.get('profile') or 'balanced') not in EXPORT_PROFILES:
+            raise PipelineError(f"Unknown profile for {operation}: {resolved['profile']}")
+        if resolved.get('subsampling') and resolved['subsampling'] not in JPEG_SUBSAMPLING:
+            raise PipelineError(f"Invalid subsampling for {operation}: {resolved['subsampling']}")
+    if operation in ('resize', 'resize_percent', 'resize_max_size'):
+        if any(resolved.get(name, 1) <= 0 for name in ('width', 'height', 'percent', 'max_size_mb')):
+            raise PipelineError(f'Invalid size for {operation}')
+    return resolved
+
+
+def parse_operations(operations):
+    """Turns a list of {operation, params} dicts into validated steps (no fusion)"""
+    if not isinstance(operations, list) or not operations:
+        raise PipelineError('No operations specified')
+    if len(operations) > MAX_PIPELINE_OPERATIONS:
+        raise PipelineError(f'At most {MAX_PIPELINE_OPERATIONS} operations are allowed')
+
+    steps = []
+    for entry in operations:
+        if not isinstance(entry, dict) or not entry.get('operation'):
+            raise PipelineError('Every entry needs an operation')
+        operation = entry['operation']
+        steps.append(Step(operation, resolve_params(operation, entry.get('params'))))
+    return steps
+
+
+# ==================== FUSION ====================
+
+_RAMP = Image.frombytes('L', (256, 1), bytes(range(256)))
+
+
+def _brightness_lut(factor):
+    """Lookup table of ImageEnhance.Brightness, taken from its result on a ramp of all 256 values"""
+    return list(ImageEnhance.Brightness(_RAMP).enhance(factor).tobytes())
+
+
+def _transpose_methods(step):
+    """Returns the transposes equivalent to a step, or None if it is not one"""
+    if step.operation == 'flip_horizontal':
+        return [Image.Transpose.FLIP_LEFT_RIGHT]
+    if step.operation == 'flip_vertical':
+        return [Image.Transpose.FLIP_TOP_BOTTOM]
+    if step.operation == TRANSPOSE:
+        return [step.params['method']] if step.params['method'] is not None else []
+    if step.operation == 'rotate':
+        angle = step.params.get('angle', 90) % 360
+        if angle % 90:
+            return None
+        # rotate() turns clockwise, Transpose.ROTATE_* counter-clockwise
+        return {
+            0: [],
+            90: [Image.Transpose.ROTATE_270],
+            180: [Image.Transpose.ROTATE_180],
+            270: [Image.Transpose.ROTATE_90],
+        }[angle]
+    return None
+
+
+_PROBE = Image.frombytes('L', (3, 2), bytes(range(6)))
+_PROBE_RESULTS = {}
+
+
+def _probe_key(img):
+    return img.size, img.tobytes()
+
+
+def _combine_transposes(methods):
+    """Combines several transposes into one (None if they cancel out).
+
+    Every combination of 90° rotations and flips equals one of the seven
+    transposes, found by applying them to a small asymmetric probe image.
+    """
+    if not _PROBE_RESULTS:
+        for method in Image.Transpose:
+            _PROBE_RESULTS[_probe_key(_PROBE.transpose(method))] = method
+
+    probe = _PROBE
+    for method in methods:
+        probe = probe.transpose(method)
+    return _PROBE_RESULTS.get(_probe_key(probe))
+
+
+def _is_no_op(step):
+    if step.operation not in NO_OP_VALUES:
+        return False
+    name, value = NO_OP_VALUES[step.operation]
+    return name in step.params and step.params[name] == value
+
+
+def fuse_steps(steps):
+    """Merges neighbouring steps that can be run as one"""
+    fused = []
+    for step in steps:
+        if _is_no_op(step):
+            continue
+
+        previous = fused[-1] if fused else None
+
+        if step.operation == 'brightness':
+            factor = step.params.get('factor', 1.0)
+            lut = _brightness_lut(factor)
+            if previous and previous.operation == POINT:
+                lut = [lut[value] for value in previous.params['lut']]
+                fused[-1] = Step(POINT, {'lut': lut, 'factor': previous.params['factor'] * factor})
+            else:
+                fused.append(Step(POINT, {'lut': lut, 'factor': factor}))
+            continue
+
+        methods = _transpose_methods(step)
+        if methods is not None:
+            previous_methods = _transpose_methods(previous) if previous else None
+            if previous_methods is not None:
+                fused.pop()
+                methods = previous_methods + methods
+            method = _combine_transposes(methods) if methods else None
+            if method is not None:
+                fused.append(Step(TRANSPOSE, {'method': method}))
+            continue
+
+        if step.operation == 'resize_percent' and previous and previous.operation == 'resize_percent':
+            percent = previous.params.get('percent', 100.0) * step.params.get('percent', 100.0) / 100
+            fused[-1] = Step('resize_percent', {'percent': percent})
+            continue
+
+        fused.append(step)
+    return fused
+
+
+def resolve_auto_steps(steps, stats):
+    """Resolves an automatic operation at the start of steps from the statistics of the input image.
+    
+    Later ones depend on what runs before them and are resolved when they run.
+    """
+    if steps and steps[0].operation in AUTO_OPERATIONS:
+        return [Step(*resolve_auto_operation(steps[0].operation, steps[0].params, stats))] + steps[1:]
+    return steps
+
+
+def compile_operations(operations):
+    """Validates operations and compiles them into fused steps"""
+    return fuse_steps(parse_operations(operations))
+
+
+_plan_cache = {}
+
+
+def compile_cached(key, operations):
+    """Like compile_operations, but caches the plan in this process under key.
+    
+    key must change whenever operations change (e.g. id and update time).
+    """
+    steps = _plan_cache.get(key)
+    if steps is None:
+        steps = compile_operations(operations)
+        if len(_plan_cache) >= MAX_CACHED_PLANS:
+            _plan_cache.clear()
+        _plan_cache[key] = steps
+    return steps
+
+
+# ==================== EXECUTION ====================
+
+def _apply_point(img, lut):
+    """Applies a lookup table to the colour bands of an image (alpha stays as is)"""
+    if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    identity = list(range(256))
+    table = []
+    for band in img.getbands():
+        table += identity if band == 'A' else lut
+    return img.point(table)
+
+
+def run_step(img, step):
+    """Runs a single compiled step"""
+    if step.operation == POINT:
+        if isinstance(img, HighBitImage):
+            # Without the 8-bit table's truncation between the fused factors
+            return img.brightness(step.params['factor'])
+        return _apply_point(img, step.params['lut'])
+    if step.operation == TRANSPOSE:
+        return img.transpose(step.params['method'])
+    return apply_operation_to_image(img, step.operation, step.params)
+
+
+def run_pipeline(img, steps):
+    """Runs compiled steps over an image (over every frame of an animation)"""
+    if isinstance(img, Animation):
+        return _map_pipeline(img, steps)
+    for step in steps:
+        img = run_step(img, step)
+    return img
+
+
+def _map_pipeline(animation, steps):
+    """Runs the steps over every frame in one pass.
+    
+    resize_max_size and the automatic operations are resolved once, on the
+    first frame, so all frames get the same size and parameters.
+    """
+    group = []
+    for step in steps:
+        if step.operation == 'resize_max_size' or step.operation in AUTO_OPERATIONS:
+            if group:
+                animation = animation.map(run_pipeline, group)
+                group = []
+            animation = apply_operation_to_image(animation, step.operation, step.params)
+        else:
+            group.append(step)
+    return animation.map(run_pipeline, group) if group else animation
@@ -0,0 +1,587 @@
+"""
+Bildwerkzeug - High bit depth images
+
+16-bit PNGs and TIFFs and float TIFFs are edited as float32 NumPy arrays
+(0.0 - 1.0) instead of 8-bit Pillow images, so repeated edits keep their
+precision. They are stored as 16-bit PNG and only quantized to 8 bits when
+exported to a format that cannot hold 16 bits. NumPy is imported on first
+use; without it these images are edited with 8 bits as before.
+"""
+
+import io
+import math
+import os
+import struct
+import zlib
+
+from PIL import Image
+
+
+# Formats written with 16 bits per channel
+HIGH_BIT_FORMATS = ('PNG', 'TIFF')
+
+# Same weights as Pillow's convert('L')
+LUMA = (0.299, 0.587, 0.114)
+
+# Pillow's exif_transpose: EXIF orientation -> transpose
+ORIENTATION_TRANSPOSES = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Rows and columns blurred at a time by gaussian_blur, sized for the CPU cache
+BLUR_STRIP_ROWS = 8
+BLUR_STRIP_COLUMNS = 64
+
+_numpy = None
+
+
+def numpy_available():
+    """Imports NumPy on first use. Returns False (once with a warning) if it is missing."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            print("⚠️  NumPy is not installed: 16-bit and float images are edited with 8 bits")
+            _numpy = False
+    return _numpy is not False
+
+
+def _rawmode(img):
+    """Raw mode of the pixel data of an opened (not yet loaded) image"""
+    if not img.tile:
+        return None
+    args = img.tile[0].args
+    return args if isinstance(args, str) else args[0]
+
+
+def high_bit_depth(img):
+    """Bits per channel of an opened image if it has more than 8 (16 or 32), else None"""
+    if img.mode == 'F':
+        return 32
+    if img.mode.startswith('I'):
+        return 16
+    rawmode = _rawmode(img) or ''
+    if img.mode in ('RGB', 'RGBA') and rawmode[-4:] in (';16B', ';16L', ';16N'):
+        return 16
+    return None
+
+
+def open_high_bit(source):
+    """Opens source (path or bytes) as HighBitImage, or returns None if it has 8 bits per channel"""
+    with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as img:
+        depth = high_bit_depth(img)
+        if depth is None or not numpy_available():
+            return None
+        return _open_high_bit(img, depth, source)
+
+
+def _open_high_bit(img, depth, source):
+    """Reads the pixels of an opened high bit depth image into a HighBitImage"""
+    np = _numpy
+    try:
+        if img.mode == 'F':
+            array = np.asarray(img, dtype=np.float32)
+        elif img.mode.startswith('I'):
+            array = np.asarray(img, dtype=np.float32) / 65535
+        else:
+            # Pillow keeps only the high bytes of 16-bit colour
+            if not isinstance(source, (bytes, bytearray)):
+                with open(source, 'rb') as f:
+                    source = f.read()
+            colour = read_png16(source) if img.format == 'PNG' else read_tiff16(img, source)
+            array = colour / np.float32(65535)
+    except (ValueError, OSError, zlib.error) as e:
+        print(f"⚠️  Could not decode with {depth} bits, using 8 bits: {e}")
+        return None
+
+    info = {key: img.info[key] for key in ('icc_profile', 'exif') if img.info.get(key)}
+    result = HighBitImage.from_interleaved(array, info, depth)
+
+    orientation = img.getexif().get(0x0112, 1) if info.get('exif') else 1
+    if orientation in ORIENTATION_TRANSPOSES:
+        exif = img.getexif()
+        del exif[0x0112]
+        result = result.transpose(ORIENTATION_TRANSPOSES[orientation])
+        result.info['exif'] = exif.tobytes()
+    return result
+
+
+class HighBitImage:
+    """An image with float32 channels (grayscale, RGB or RGBA), edited with NumPy.
+
+    The array holds one plane per channel (channels, height, width), so every
+    channel can be handed to Pillow's float ('F') operations without copying.
+    Operations are methods (see imaging._apply_to_high_bit) and return a new
+    image. Where the data is stored, listed or exported, the image passes for
+    a Pillow image through size, mode, info and save(); formats without 16
+    bits get to_pillow().
+    """
+
+    def __init__(self, array, info=None, bits=16):
+        self.array = array
+        self.info = dict(info or {})
+        self.bits = bits
+
+    @classmethod
+    def from_interleaved(cls, array, info=None, bits=16):
+        """From an array of shape (height, width) or (height, width, channels), as NumPy gets from Pillow"""
+        np = _numpy
+        if array.ndim == 2:
+            return cls(array[None], info, bits)
+        return cls(np.ascontiguousarray(array.transpose(2, 0, 1)), info, bits)
+
+    @classmethod
+    def from_pillow(cls, img):
+        """Float copy of an 8-bit Pillow image (NumPy must be available)"""
+        np = _numpy
+        if img.mode not in ('L', 'RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        return cls.from_interleaved(np.asarray(img, dtype=np.float32) / 255, img.info, 8)
+
+    @property
+    def size(self):
+        return self.array.shape[2], self.array.shape[1]
+
+    @property
+    def width(self):
+        return self.array.shape[2]
+
+    @property
+    def height(self):
+        return self.array.shape[1]
+
+    @property
+    def mode(self):
+        return {1: 'L', 3: 'RGB', 4: 'RGBA'}[self.array.shape[0]]
+
+    def getbands(self):
+        return tuple(self.mode)
+
+    def load(self):
+        pass
+
+    def copy(self):
+        # Operations never change an array in place, so copies can share it
+        return HighBitImage(self.array, self.info, self.bits)
+
+    def _with(self, array):
+        return HighBitImage(array, self.info, self.bits)
+
+    def _colour(self):
+        """The colour planes (without alpha)"""
+        return self.array[:3]
+
+    def _map_colour(self, func):
+        """A new image with func(colour planes) as colour and the alpha plane kept"""
+        np = _numpy
+        colour = func(self._colour())
+        if self.array.shape[0] == 4:
+            return self._with(np.concatenate([colour, self.array[3:]]))
+        return self._with(colour)
+
+    # ==================== CONVERSION ====================
+
+    def quantize(self, bits=8):
+        """Channels as unsigned integers with the given bits, rounded and clipped.
+
+        Returns an interleaved array (height, width, channels).
+        """
+        np = _numpy
+        scale = np.float32((1 << bits) - 1)
+        planes = np.clip(self.array, 0.0, 1.0) * scale
+        planes += np.float32(0.5)
+        return np.ascontiguousarray(planes.astype(np.uint8 if bits == 8 else np.uint16).transpose(1, 2, 0))
+
+    def to_pillow(self):
+        """8-bit Pillow image (L, RGB or RGBA)"""
+        np = _numpy
+        planes = np.clip(self.array, 0.0, 1.0) * np.float32(255)
+        planes += np.float32(0.5)
+        bands = [Image.fromarray(plane, 'L') for plane in planes.astype(np.uint8)]
+        img = bands[0] if len(bands) == 1 else Image.merge(self.mode, bands)
+        img.info.update(self.info)
+        return img
+
+    def convert(self, mode):
+        return self.to_pillow().convert(mode)
+
+    def save(self, fp, format=None, **params):
+        """Writes 16-bit PNG or TIFF; other formats are written from the 8-bit image"""
+        if format is None and isinstance(fp, str):
+            format = Image.registered_extensions().get(os.path.splitext(fp)[1].lower())
+        format = (format or 'PNG').upper()
+        if format not in HIGH_BIT_FORMATS:
+            return self.to_pillow().save(fp, format, **params)
+
+        data = self.quantize(16)
+        if data.shape[2] == 1:
+            # Pillow writes 16-bit grayscale itself
+            img = Image.fromarray(data[:, :, 0])
+            if format == 'PNG':
+                keep = {key: params[key] for key in ('compress_level', 'icc_profile', 'exif') if key in params}
+            else:
+                keep = {key: params[key] for key in ('compression', 'icc_profile') if key in params}
+            return img.save(fp, format, **keep)
+
+        if format == 'PNG':
+            data = write_png16(data, params.get('compress_level', 6), params.get('icc_profile'), params.get('exif'))
+        else:
+            data = write_tiff16(data, params.get('compression'), params.get('icc_profile'))
+        if isinstance(fp, str):
+            with open(fp, 'wb') as f:
+                f.write(data)
+        else:
+            fp.write(data)
+
+    # ==================== OPERATIONS ====================
+
+    def _per_plane(self, planes, func):
+        """Runs func on every plane as a Pillow float image"""
+        np = _numpy
+        result = None
+        for index, plane in enumerate(planes):
+            done = func(Image.fromarray(plane, 'F'))
+            if result is None:
+                result = np.empty((len(planes), done.height, done.width), dtype=np.float32)
+            result[index] = np.frombuffer(done.tobytes(), dtype=np.float32).reshape(done.height, done.width)
+        return result
+
+    def resize(self, size, resample=Image.Resampling.LANCZOS):
+        """Resizes every plane (colour weighted by alpha, like Pillow does for RGBA)"""
+        np = _numpy
+        size = tuple(size)
+        planes = self.array
+        if planes.shape[0] == 4:
+            planes = np.concatenate([planes[:3] * planes[3], planes[3:]])
+        result = self._per_plane(planes, lambda plane: plane.resize(size, resample))
+        if result.shape[0] == 4:
+            alpha = result[3]
+            np.divide(result[:3], alpha, out=result[:3], where=alpha > 0)
+        return self._with(result)
+
+    def transpose(self, method):
+        np = _numpy
+        a = self.array
+        result = {
+            Image.Transpose.FLIP_LEFT_RIGHT: lambda: a[:, :, ::-1],
+            Image.Transpose.FLIP_TOP_BOTTOM: lambda: a[:, ::-1],
+            Image.Transpose.ROTATE_90: lambda: np.rot90(a, 1, axes=(1, 2)),
+            Image.Transpose.ROTATE_180: lambda: a[:, ::-1, ::-1],
+            Image.Transpose.ROTATE_270: lambda: np.rot90(a, 3, axes=(1, 2)),
+            Image.Transpose.TRANSPOSE: lambda: a.transpose(0, 2, 1),
+            Image.Transpose.TRANSVERSE: lambda: a[:, ::-1, ::-1].transpose(0, 2, 1),
+        }[method]()
+        return self._with(np.ascontiguousarray(result))
+
+    def rotate(self, angle):
+        """Rotates counter-clockwise by angle degrees and enlarges the canvas (like Pillow's expand)"""
+        if angle % 90 == 0:
+            method = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180,
+                      270: Image.Transpose.ROTATE_270}.get(angle % 360)
+            return self.transpose(method) if method else self.copy()
+        return self._with(self._per_plane(self.array, lambda plane: plane.rotate(angle, expand=True)))
+
+    def crop(self, box):
+        """Crops like Pillow: areas outside the image are filled with 0"""
+        left, top, right, bottom = box
+        if left >= 0 and top >= 0 and right <= self.width and bottom <= self.height:
+            return self._with(self.array[:, top:bottom, left:right])
+        return self._with(self._per_plane(self.array, lambda plane: plane.crop(tuple(box))))
+
+    def _luma(self):
+        """Luminance plane (height, width)"""
+        colour = self._colour()
+        if colour.shape[0] == 1:
+            return colour[0].copy()
+        luma = colour[0] * _numpy.float32(LUMA[0])
+        luma += colour[1] * _numpy.float32(LUMA[1])
+        luma += colour[2] * _numpy.float32(LUMA[2])
+        return luma
+
+    def grayscale(self):
+        """Luminance in RGB (alpha is dropped, like convert('L').convert('RGB'))"""
+        return self._with(_numpy.repeat(self._luma()[None], 3, axis=0))
+
+    def _blend(self, degenerate, factor):
+        """Like ImageEnhance: degenerate + (image - degenerate) * factor, on the colour planes"""
+        np = _numpy
+
+        def blend(colour):
+            result = colour - degenerate
+            result *= np.float32(factor)
+            result += degenerate
+            return result
+        return self._map_colour(blend)
+
+    def levels(self, black, white):
+        """Maps black..white (0-255 scale, per colour channel) to 0.0 - 1.0"""
+        np = _numpy
+        if self.array.shape[0] == 1:
+            black, white = [sum(black) / 3], [sum(white) / 3]
+        low = np.array(black[:self._colour().shape[0]], dtype=np.float32)[:, None, None] / 255
+        high = np.array(white[:self._colour().shape[0]], dtype=np.float32)[:, None, None] / 255
+        return self._map_colour(lambda colour: (colour - low) / (high - low))
+
+    def brightness(self, factor):
+        return self._map_colour(lambda colour: colour * _numpy.float32(factor))
+
+    def contrast(self, factor):
+        return self._blend(_numpy.float32(self._luma().mean()), factor)
+
+    def saturation(self, factor):
+        return self._blend(self._luma(), factor)
+
+    def sharpen(self, factor):
+        """Blend with Pillow's SMOOTH filter (border pixels are not filtered), like ImageEnhance.Sharpness"""
+        np = _numpy
+        colour = self._colour()
+        smooth = colour.copy()
+        inner = smooth[:, 1:-1, 1:-1]
+        inner *= np.float32(5)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy != 1 or dx != 1:
+                    inner += colour[:, dy:dy + colour.shape[1] - 2, dx:dx + colour.shape[2] - 2]
+        inner /= np.float32(13)
+        return self._blend(smooth, factor)
+
+    def gaussian_blur(self, radius):
+        """Three box blurs per direction, as Pillow approximates a Gaussian.
+
+        Runs on strips of a few rows (then columns), so the three passes over
+        a strip stay in the CPU cache instead of going through memory each time.
+        """
+        np = _numpy
+        box_radius = _box_blur_radius(radius, 3)
+        if box_radius <= 0:
+            return self.copy()
+        result = np.empty_like(self.array)
+        for axis, source, strip in ((2, self.array, BLUR_STRIP_ROWS), (1, result, BLUR_STRIP_COLUMNS)):
+            # Strips run across the other image axis (rows for the horizontal passes)
+            across = 3 - axis
+            for start in range(0, source.shape[across], strip):
+                block = _along(source, across, start, strip)
+                for _ in range(3):
+                    block = _box_blur(block, box_radius, axis)
+                _along(result, across, start, strip)[...] = block
+        return self._with(result)
+
+
+def _box_blur_radius(radius, passes):
+    """Pillow's _gaussian_blur_radius: radius of a box blur that, repeated, approximates sigma"""
+    sigma2 = radius * radius / passes
+    length = math.sqrt(12.0 * sigma2 + 1.0)
+    inner = math.floor((length - 1.0) / 2.0)
+    extra = (2 * inner + 1) * (inner * (inner + 1) - 3 * sigma2)
+    extra /= 6 * (sigma2 - (inner + 1) * (inner + 1))
+    return inner + extra
+
+
+def _along(array, axis, start, length):
+    """View of length values along axis, from start"""
+    index = [slice(None)] * array.ndim
+    index[axis] = slice(start, start + length)
+    return array[tuple(index)]
+
+
+def _window_sums(array, width, axis):
+    """Sums of width consecutive values along axis.
+
+    Short windows add shifted views; long ones are built from power-of-two
+    partial sums, so the work grows with log(width).
+    """
+    count = array.shape[axis] - width + 1
+    if width <= 4:
+        result = _along(array, axis, 0, count).copy()
+        for shift in range(1, width):
+            result += _along(array, axis, shift, count)
+        return result
+
+    result = None
+    block, size, offset = array, 1, 0
+    while True:
+        if width & size:
+            piece = _along(block, axis, offset, count)
+            if result is None:
+                result = piece.copy()
+            else:
+                result += piece
+            offset += size
+        if size * 2 > width:
+            return result
+        block = _along(block, axis, 0, block.shape[axis] - size) + _along(block, axis, size, block.shape[axis] - size)
+        size *= 2
+
+
+def _box_blur(array, radius, axis):
+    """Pillow's box blur with a fractional radius along one axis (edges repeated)"""
+    np = _numpy
+    whole = int(radius)
+    inner_weight = 1.0 / (radius * 2 + 1)
+    edge_weight = (1.0 - (whole * 2 + 1) * inner_weight) / 2
+    length = array.shape[axis]
+    # Edges repeated by hand: np.pad costs more than the strip it pads
+    shape = list(array.shape)
+    shape[axis] = length + 2 * whole + 2
+    padded = np.empty(shape, dtype=array.dtype)
+    _along(padded, axis, whole + 1, length)[...] = array
+    _along(padded, axis, 0, whole + 1)[...] = _along(array, axis, 0, 1)
+    _along(padded, axis, length + whole + 1, whole + 1)[...] = _along(array, axis, length - 1, 1)
+
+    result = _window_sums(_along(padded, axis, 1, length + 2 * whole), 2 * whole + 1, axis)
+    result *= np.float32(inner_weight)
+    if edge_weight:
+        edges = _along(padded, axis, 0, length) + _along(padded, axis, 2 * whole + 2, length)
+        edges *= np.float32(edge_weight)
+        result += edges
+    return result
+
+
+# ==================== 16-BIT COLOUR ====================
+# Pillow reads and writes 16-bit grayscale ('I;16'), but keeps only the high
+# bytes of 16-bit RGB(A). These read and write just that case.
+
+def _png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def read_png16(data):
+    """uint16 array (height, width, 3/4) of a 16-bit RGB(A) PNG.
+
+    PNG filters work byte by byte, each against the same byte of the
+    neighbouring pixels, so the high and the low bytes of the filtered rows
+    form two valid 8-bit images. They are stacked into one 8-bit PNG, with
+    an empty row between them, and Pillow undoes the filters of both at once.
+    """
+    np = _numpy
+    header, idat, position = None, [], 8
+    while position + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        body = data[position + 8:position + 8 + length]
+        if chunk_type == b'IHDR':
+            header = body
+        elif chunk_type == b'IDAT':
+            idat.append(body)
+        elif chunk_type == b'IEND':
+            break
+        position += 12 + length
+    width, height, bits, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header[:13])
+    if bits != 16 or color_type not in (2, 6) or interlace:
+        raise ValueError(f'16-bit PNG with color type {color_type}, interlace {interlace}')
+    channels = 3 if color_type == 2 else 4
+
+    row_bytes = width * channels * 2 + 1
+    rows = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)[:height * row_bytes]
+    rows = rows.reshape(height, row_bytes)
+    stacked = np.zeros((2 * height + 1, width * channels + 1), dtype=np.uint8)
+    stacked[:height, 0] = stacked[height + 1:, 0] = rows[:, 0]
+    stacked[:height, 1:] = rows[:, 1::2]
+    stacked[height + 1:, 1:] = rows[:, 2::2]
+
+    png = (b'\x89PNG\r\n\x1a\n'
+           + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, 2 * height + 1, 8, color_type, 0, 0, 0))
+           + _png_chunk(b'IDAT', zlib.compress(stacked.tobytes(), 0))
+           + _png_chunk(b'IEND', b''))
+    with Image.open(io.BytesIO(png)) as img:
+        planes = np.asarray(img)
+    result = planes[:height].astype(np.uint16) << 8
+    result |= planes[height + 1:]
+    return result
+
+
+def read_tiff16(img, data):
+    """uint16 array (height, width, 3/4) of a 16-bit RGB(A) TIFF with uncompressed or deflated strips"""
+    np = _numpy
+    tags = img.tag_v2
+    compression = tags.get(259, 1)
+    if compression not in (1, 8, 32946) or 322 in tags or tags.get(284, 1) != 1:
+        raise ValueError(f'16-bit TIFF with compression {compression}, tiles or separate planes')
+    strips = [data[offset:offset + count] for offset, count in zip(tags[273], tags[279])]
+    if compression != 1:
+        strips = [zlib.decompress(strip) for strip in strips]
+
+    channels = len(img.getbands())
+    samples = img.width * img.height * channels
+    pixels = np.frombuffer(b''.join(strips), dtype=tags._endian + 'u2')[:samples]
+    pixels = pixels.reshape(img.height, img.width, channels)
+    if tags.get(317, 1) == 2:
+        # Horizontal predictor: every sample is stored as the difference to the one on its left
+        pixels = np.cumsum(pixels, axis=1, dtype=np.uint16)
+    return pixels
+
+
+def write_png16(data, compress_level=6, icc_profile=None, exif=None):
+    """16-bit PNG of a uint16 array (height, width, 3/4), rows filtered with 'Up'"""
+    np = _numpy
+    height, width, channels = data.shape
+    color_type = {3: 2, 4: 6}[channels]
+    rows = data.astype('>u2').view(np.uint8).reshape(height, width * channels * 2)
+
+    filtered = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+
+    chunks = [_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 16, color_type, 0, 0, 0))]
+    if icc_profile:
+        chunks.append(_png_chunk(b'iCCP', b'ICC Profile\0\0' + zlib.compress(icc_profile)))
+    if exif:
+        chunks.append(_png_chunk(b'eXIf', exif[6:] if exif.startswith(b'Exif\0\0') else exif))
+    chunks.append(_png_chunk(b'IDAT', zlib.compress(filtered.tobytes(), compress_level)))
+    chunks.append(_png_chunk(b'IEND', b''))
+    return b'\x89PNG\r\n\x1a\n' + b''.join(chunks)
+
+
+def write_tiff16(data, compression=None, icc_profile=None):
+    """16-bit baseline TIFF (little-endian, one strip) of a uint16 array (height, width, 3/4), optionally deflated"""
+    height, width, channels = data.shape
+    pixels = data.astype('<u2').tobytes()
+    deflate = compression in ('tiff_adobe_deflate', 'tiff_deflate')
+    if deflate:
+        pixels = zlib.compress(pixels, 6)
+
+    # Values that do not fit into the entries are stored after the pixels
+    extra = b''
+    entries = []
+    offset_base = 8 + len(pixels)
+
+    def add(tag, value_type, values):
+        nonlocal extra
+        fmt = {3: 'H', 4: 'I', 7: 'B'}[value_type]
+        packed = struct.pack(f'<{len(values)}{fmt}', *values)
+        if len(packed) <= 4:
+            entries.append(struct.pack('<HHI', tag, value_type, len(values)) + packed.ljust(4, b'\0'))
+        else:
+            if (offset_base + len(extra)) % 2:
+                extra += b'\0'
+            entries.append(struct.pack('<HHII', tag, value_type, len(values), offset_base + len(extra)))
+            extra += packed
+
+    add(256, 4, [width])
+    add(257, 4, [height])
+    add(258, 3, [16] * channels)
+    add(259, 3, [8 if deflate else 1])
+    add(262, 3, [2])
+    add(273, 4, [8])
+    add(277, 3, [channels])
+    add(278, 4, [height])
+    add(279, 4, [len(pixels)])
+    add(284, 3, [1])
+    if channels == 4:
+        add(338, 3, [2])
+    if icc_profile:
+        add(34675, 7, list(icc_profile))
+
+    if (offset_base + len(extra)) % 2:
+        extra += b'\0'
+    ifd_offset = offset_base + len(extra)
+    ifd = struct.pack('<H', len(entries)) + b''.join(entries) + struct.pack('<I', 0)
+    return b'II*\0' + struct.pack('<I', ifd_offset) + pixels + extra + ifd
@@ -0,0 +1,184 @@
+"""
+Bildwerkzeug - Resumable uploads
+
+tus-like protocol: an upload is created with its total size, the bytes are
+appended in chunks at the current offset (a dropped connection resumes from
+there) and the complete file is checked against its SHA-256 before it is
+handed to the normal ingest. Partial files live in the user's upload folder,
+so any worker can continue an upload.
+"""
+
+import base64
+import glob
+import hashlib
+import json
+import os
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent chunks for one upload are not detected
+    fcntl = None
+
+
+PARTIAL_FOLDER = '.partial'
+READ_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """Raised for invalid upload requests, with the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _paths(folder, upload_id):
+    if not upload_id.isalnum():
+        raise UploadError('Upload not found', 404)
+    base = os.path.join(folder, PARTIAL_FOLDER, upload_id)
+    return base + '.json', base + '.part'
+
+
+def create_upload(folder, filename, size, sha256=None, ttl_hours=None, max_dimension=0):
+    """Creates an empty upload of size bytes. Returns its state."""
+    upload_id = uuid.uuid4().hex
+    state = {
+        'id': upload_id,
+        'filename': filename,
+        'size': size,
+        'sha256': sha256.lower() if sha256 else None,
+        'ttl_hours': ttl_hours,
+        'max_dimension': max_dimension,
+        'created_at': time.time()
+    }
+    state_path, data_path = _paths(folder, upload_id)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    open(data_path, 'wb').close()
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    return {**state, 'offset': 0}
+
+
+def load_upload(folder, upload_id):
+    """Returns the state of an upload including its current offset, or None"""
+    state_path, data_path = _paths(folder, upload_id)
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        state['offset'] = os.path.getsize(data_path)
+    except (OSError, ValueError):
+        return None
+    return state
+
+
+def parse_checksum(header):
+    """Parses an Upload-Checksum header ('sha256 <base64 digest>'). Returns the digest or None."""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise UploadError('Only sha256 checksums are supported')
+    try:
+        return base64.b64decode(value.strip(), validate=True)
+    except ValueError:
+        raise UploadError('Invalid Upload-Checksum header')
+
+
+def append_chunk(folder, upload_id, offset, stream, checksum=None):
+    """Appends the bytes of stream at offset. Returns the new offset.
+
+    offset must match the bytes received so far. If checksum (raw SHA-256)
+    is given and does not match the chunk, the chunk is discarded.
+    """
+    state = load_upload(folder, upload_id)
+    if state is None:
+        raise UploadError('Upload not found', 404)
+
+    _, data_path = _paths(folder, upload_id)
+    with open(data_path, 'r+b') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise UploadError('Another chunk of this upload is being written', 423)
+
+        current = os.fstat(f.fileno()).st_size
+        if offset != current:
+            raise UploadError(f'Offset mismatch, upload is at {current}', 409)
+
+        digest = hashlib.sha256()
+        f.seek(current)
+        written = 0
+        try:
+            while True:
+                data = stream.read(READ_SIZE)
+                if not data:
+                    break
+                written += len(data)
+                if current + written > state['size']:
+                    raise UploadError('Chunk exceeds the upload size', 413)
+                digest.update(data)
+                f.write(data)
+            if checksum is not None and digest.digest() != checksum:
+                raise UploadError('Checksum mismatch', 460)
+        except Exception:
+            # Keep the upload resumable at the last good offset
+            f.truncate(current)
+            raise
+        return current + written
+
+
+def finish_upload(folder, upload_id, sha256=None):
+    """Verifies a complete upload. Returns (path of the data, state).
+
+    The data file is left in place for the caller to move; remove_upload
+    cleans up afterwards.
+    """
+    state = load_upload(folder, upload_id)
+    if state is None:
+        raise UploadError('Upload not found', 404)
+    if state['offset'] != state['size']:
+        raise UploadError(f"Upload incomplete ({state['offset']} of {state['size']} bytes)", 409)
+
+    _, data_path = _paths(folder, upload_id)
+    digest = hashlib.sha256()
+    with open(data_path, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(data)
+    state['sha256_actual'] = digest.hexdigest()
+
+    expected = (sha256 or state.get('sha256') or '').lower()
+    if expected and expected != state['sha256_actual']:
+        raise UploadError('Checksum mismatch', 460)
+    return data_path, state
+
+
+def remove_upload(folder, upload_id):
+    """Deletes an upload and its data"""
+    for path in _paths(folder, upload_id):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def prune_uploads(upload_folder, max_age_seconds):
+    """Deletes partial uploads without a new chunk for max_age_seconds. Returns the count."""
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    pattern = os.path.join(glob.escape(upload_folder), 'user_*', PARTIAL_FOLDER, '*.json')
+    for state_path in glob.glob(pattern):
+        data_path = state_path[:-len('.json')] + '.part'
+        try:
+            last_change = max(os.path.getmtime(state_path),
+                              os.path.getmtime(data_path) if os.path.exists(data_path) else 0)
+            if last_change < cutoff:
+                for path in (state_path, data_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,250 @@
+"""
+Bildwerkzeug - Workspaces spread over several nodes
+
+Each user's upload folder (the workspace) lives on one node. Which one is
+decided by a consistent hash ring over the user id: every node takes
+VIRTUAL_NODES points on the ring and a user belongs to the first point
+after the hash of their id. Adding a node only moves the users that now
+fall on its points; all others stay where they are.
+
+Nodes tell a reverse proxy where a user belongs with a response header and
+a cookie. Workspaces are moved between nodes as tar archives, signed with
+the secret the nodes share. While a workspace is sent, this node keeps
+serving it but refuses writes; requests only go to the new node once it
+has confirmed the import.
+"""
+
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes are only held back by the marker
+    fcntl = None
+
+
+# Points per node on the ring; more spread the users more evenly
+VIRTUAL_NODES = 128
+
+# Response header and cookie naming the node that holds the user's workspace
+SHARD_HEADER = 'X-Bildwerkzeug-Shard'
+SHARD_COOKIE = 'bildwerkzeug_shard'
+
+# Signed transfers older than this many seconds are refused
+SIGNATURE_MAX_AGE = 300
+
+# Files in a workspace: the marker of a running move and the lock writes hold (neither is sent)
+MOVING_MARKER = '.moving'
+WRITE_LOCK = '.write.lock'
+
+
+class ShardError(Exception):
+    """Invalid shard configuration, signature or workspace archive"""
+
+
+class WorkspaceMoving(ShardError):
+    """The workspace is being sent to another node (or just left this one)"""
+
+
+def parse_nodes(text):
+    """{name: base URL} from 'name=url,name=url'"""
+    nodes = {}
+    for entry in filter(None, (part.strip() for part in (text or '').split(','))):
+        name, sep, url = entry.partition('=')
+        if not sep or not name.strip() or not url.strip():
+            raise ShardError(f'Invalid shard node {entry!r} (expected name=url)')
+        nodes[name.strip()] = url.strip().rstrip('/')
+    return nodes
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring of node names"""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        if not nodes:
+            raise ShardError('No shard nodes')
+        points = sorted((_hash(f'{node}#{index}'), node) for node in nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+        self.nodes = sorted(set(nodes))
+
+    def node_for(self, key):
+        """Name of the node a key (user id) belongs to"""
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+# ==================== SIGNED TRANSFERS ====================
+
+def sign(secret, user_id, digest, timestamp=None):
+    """Headers for sending a workspace archive (digest: its SHA-256 in hex) to another node"""
+    timestamp = str(int(timestamp if timestamp is not None else time.time()))
+    return {
+        'X-Shard-Timestamp': timestamp,
+        'X-Shard-Digest': digest,
+        'X-Shard-Signature': _signature(secret, user_id, digest, timestamp)
+    }
+
+
+def verify(secret, user_id, headers):
+    """Raises ShardError unless headers were made by sign() with the same secret recently.
+    Returns the digest the archive must have."""
+    if not secret:
+        raise ShardError('SHARD_SECRET is not set')
+    timestamp = headers.get('X-Shard-Timestamp')
+    digest = headers.get('X-Shard-Digest') or ''
+    try:
+        age = abs(time.time() - int(timestamp))
+    except (TypeError, ValueError):
+        raise ShardError('Invalid timestamp')
+    if age > SIGNATURE_MAX_AGE:
+        raise ShardError('Signature expired')
+    if not hmac.compare_digest(_signature(secret, user_id, digest, timestamp), headers.get('X-Shard-Signature') or ''):
+        raise ShardError('Invalid signature')
+    return digest
+
+
+def _signature(secret, user_id, digest, timestamp):
+    message = f'{timestamp}:{user_id}:{digest}'.encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+# ==================== WORKSPACE ARCHIVES ====================
+
+def pack_workspace(folder, fileobj):
+    """Writes the files of a workspace folder into fileobj as an uncompressed tar archive.
+    Returns the SHA-256 hex digest of the archive."""
+    with tarfile.open(fileobj=fileobj, mode='w') as archive:
+        for root, _, files in os.walk(folder):
+            for filename in sorted(files):
+                if root == folder and filename in (MOVING_MARKER, WRITE_LOCK):
+                    continue
+                path = os.path.join(root, filename)
+                archive.add(path, arcname=os.path.relpath(path, folder), recursive=False)
+    fileobj.seek(0)
+    return copy_with_digest(fileobj, None)
+
+
+def copy_with_digest(source, target, chunk_size=1024 * 1024):
+    """Copies a file object into target (None: only reads it). Returns the SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+        if target is not None:
+            target.write(chunk)
+    return digest.hexdigest()
+
+
+def unpack_workspace(fileobj, folder):
+    """Extracts a workspace archive into folder (which must not exist yet)"""
+    partial = f'{folder}.importing'
+    shutil.rmtree(partial, ignore_errors=True)
+    try:
+        with tarfile.open(fileobj=fileobj, mode='r') as archive:
+            members = archive.getmembers()
+            for member in members:
+                if not (member.isfile() or member.isdir()):
+                    raise ShardError(f'Unexpected entry {member.name!r}')
+            # Refuses absolute paths and paths leaving the folder
+            archive.extractall(partial, members=members, filter='data')
+    except ShardError:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    except (tarfile.TarError, OSError) as e:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise ShardError(f'Invalid workspace archive: {e}')
+    os.rename(partial, folder)
+
+
+# ==================== MOVING WORKSPACES ====================
+
+def lock_for_writing(folder):
+    """Shared lock a request writing to a workspace folder holds, so a move waits for it.
+    
+    Returns the open lock file; closing it releases the lock. Raises
+    WorkspaceMoving while the workspace is being moved or once it is gone.
+    """
+    marker = os.path.join(folder, MOVING_MARKER)
+    if os.path.exists(marker):
+        raise WorkspaceMoving('Workspace is being moved to another node')
+    try:
+        lock_file = open(os.path.join(folder, WRITE_LOCK), 'a')
+    except FileNotFoundError:
+        raise WorkspaceMoving('Workspace was moved to another node')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        # The move may have started while the lock was taken
+        if os.path.exists(marker):
+            raise WorkspaceMoving('Workspace is being moved to another node')
+    except OSError:
+        lock_file.close()
+        raise WorkspaceMoving('Workspace is being moved to another node')
+    except WorkspaceMoving:
+        lock_file.close()
+        raise
+    return lock_file
+
+
+@contextmanager
+def holding_writes(folder):
+    """Refuses new writes to a workspace (see lock_for_writing) and waits for running ones.
+    
+    Reads go on as before. The marker is removed afterwards, unless the
+    block has moved the folder away.
+    """
+    marker = os.path.join(folder, MOVING_MARKER)
+    with open(marker, 'w') as f:
+        f.write(str(os.getpid()))
+    lock_file = open(os.path.join(folder, WRITE_LOCK), 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+    finally:
+        lock_file.close()
+        if os.path.exists(marker):
+            os.remove(marker)
+
+
+def push_workspace(base_url, secret, user_id, folder, timeout=600):
+    """Sends a workspace folder to the node at base_url. Returns its answer (dict)."""
+    with tempfile.TemporaryFile() as archive:
+        digest = pack_workspace(folder, archive)
+        size = archive.seek(0, os.SEEK_END)
+        archive.seek(0)
+        request = urllib.request.Request(
+            f'{base_url}/internal/workspaces/{urllib.parse.quote(str(user_id))}',
+            data=archive, method='PUT',
+            headers={'Content-Type': 'application/x-tar', 'Content-Length': str(size),
+                     **sign(secret, user_id, digest)}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get('error')
+            except ValueError:
+                message = None
+            raise ShardError(f'{base_url}: {message or e}')
+        except urllib.error.URLError as e:
+            raise ShardError(f'{base_url}: {e.reason}')
@@ -0,0 +1,138 @@
+"""
+Bildwerkzeug - Near-duplicate detection
+
+Every image gets a 64-bit difference hash (dHash) of its thumbnail: one bit
+per pair of neighbouring cells of a 9x8 grayscale copy, set where the right
+one is brighter. Burst shots and re-exports of the same picture have hashes
+that differ in few bits. The hashes of a user are kept in a BK-tree, which
+only visits the subtrees that can hold hashes within the searched Hamming
+distance. The tree is built once per worker and user and rebuilt when the
+user's images change.
+"""
+
+import threading
+
+from PIL import Image
+
+
+HASH_SIZE = 8
+
+# Users whose trees are kept per worker
+MAX_CACHED_INDEXES = 256
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def dhash(img):
+    """Difference hash of a Pillow image as 16 hex digits"""
+    gray = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = value << 1 | (pixels[row * (HASH_SIZE + 1) + col + 1] > left)
+    return f'{value:016x}'
+
+
+def hamming(a, b):
+    """Number of differing bits of two hashes (ints)"""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree of hashes under the Hamming distance.
+
+    Every child sits at a known distance from its parent; by the triangle
+    inequality a search within max_distance of a value only has to descend
+    into children whose distance lies within max_distance of the value's
+    distance to the parent.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value, item):
+        """Adds item under hash value (an int)"""
+        self.size += 1
+        node = [value, [item], {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, max_distance):
+        """Items with a hash within max_distance of value, as (distance, item) sorted by distance"""
+        found = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+
+def index_for(user_id, entries):
+    """BK-tree of a user's (image_id, hash) entries, cached while the entries stay the same"""
+    signature = tuple(entries)
+    with _indexes_lock:
+        cached = _indexes.get(user_id)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+    tree = BKTree()
+    for image_id, image_hash in entries:
+        tree.add(int(image_hash, 16), image_id)
+
+    with _indexes_lock:
+        if len(_indexes) >= MAX_CACHED_INDEXES:
+            _indexes.clear()
+        _indexes[user_id] = (signature, tree)
+    return tree
+
+
+def find_similar(tree, image_hash, max_distance):
+    """(distance, image_id) of the images within max_distance of a hash (hex)"""
+    return tree.search(int(image_hash, 16), max_distance)
+
+
+def group_similar(entries, tree, max_distance):
+    """Groups of at least two image ids linked by hashes within max_distance, in upload order"""
+    parent = {image_id: image_id for image_id, _ in entries}
+
+    def root(image_id):
+        while parent[image_id] != image_id:
+            parent[image_id] = parent[parent[image_id]]
+            image_id = parent[image_id]
+        return image_id
+
+    for image_id, image_hash in entries:
+        for _, other_id in find_similar(tree, image_hash, max_distance):
+            first, second = root(image_id), root(other_id)
+            if first != second:
+                parent[second] = first
+
+    groups = {}
+    for image_id, _ in entries:
+        groups.setdefault(root(image_id), []).append(image_id)
+    return [members for members in groups.values() if len(members) > 1]
@@ -16,17 +16,34 @@ let originalHeight = 0;
 let uploadedImages = [];  // {id, filename, width, height}
 let currentImageId = null;
 let currentImageData = null;  // Base64 des aktuellen Bildes (vom Server geladen)
+let similarGroups = {};  // Bild-ID -> Nummer der Gruppe ähnlicher Bilder
+let listingVersion = null;  // Stand der Bilderliste auf dem Server
+let activeBatchId = null;  // Batch, dessen Fortschritt angezeigt wird
 
 // ==================== SERVER API ====================
 
+// Bilder pro Seite beim Laden der Liste
+const IMAGE_PAGE_SIZE = 200;
+
 async function loadImagesFromServer() {
     try {
-        const response = await fetch('/api/images');
-        const data = await response.json();
+        // Seitenweise laden, bis kein Cursor mehr zurückkommt
+        let images = [];
+        let cursor = null;
+        let data;
+        do {
+            const query = `limit=${IMAGE_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '');
+            const response = await fetch(`/api/images?${query}`);
+            data = await response.json();
+            if (!data.success) return null;
+            images = images.concat(data.images);
+            cursor = data.next_cursor;
+        } while (cursor);
         
-        if (data.success && data.images && data.images.length > 0) {
+        listingVersion = data.version;
+        if (images.length > 0) {
             return {
-                images: data.images,
+                images: images,
                 currentId: data.current_id
             };
         }
@@ -36,6 +53,151 @@ async function loadImagesFromServer() {
     return null;
 }
 
+async function syncGallery() {
+    // Nur die seit dem letzten Stand geänderten Einträge holen und einarbeiten
+    if (listingVersion === null) {
+        const serverData = await loadImagesFromServer();
+        uploadedImages = serverData ? serverData.images : [];
+        updateGallery();
+        return;
+    }
+    try {
+        const response = await fetch(`/api/images/changes?since=${listingVersion}`);
+        if (response.status === 304) return;
+        const data = await response.json();
+        if (!data.success) return;
+        
+        if (data.reset) {
+            uploadedImages = data.changed;
+        } else {
+            const deleted = new Set(data.deleted);
+            uploadedImages = uploadedImages.filter(img => !deleted.has(img.id));
+            data.changed.forEach(entry => {
+                const index = uploadedImages.findIndex(img => img.id === entry.id);
+                if (index >= 0) {
+                    // Bilddaten gehören zur alten Version
+                    uploadedImages[index] = entry;
+                } else {
+                    uploadedImages.push(entry);
+                }
+            });
+        }
+        listingVersion = data.version;
+        updateGallery();
+    } catch (e) {
+        console.error('Error syncing gallery:', e);
+    }
+}
+
+// ==================== SERVER-EVENTS ====================
+
+// Millisekunden, die ein Batch höchstens auf die Verbindung für Events wartet
+const EVENTS_CONNECT_TIMEOUT = 2000;
+
+let eventSource = null;
+let eventsActive = 0;  // Laufende Batches, die Events brauchen
+let eventsPolling = false;
+let eventStreamUnavailable = false;  // Server streamt nicht (Gunicorn), stattdessen abfragen
+
+function startEvents() {
+    // Der Server meldet bearbeitete Bilder und den Fortschritt von Batches.
+    // Verbunden wird nur, solange ein Batch läuft; das Promise ist erfüllt,
+    // sobald Events ankommen können (spätestens nach EVENTS_CONNECT_TIMEOUT)
+    eventsActive++;
+    if (eventsActive > 1) return Promise.resolve();
+    const timeout = new Promise(resolve => setTimeout(resolve, EVENTS_CONNECT_TIMEOUT));
+    if (!window.EventSource || eventStreamUnavailable) return Promise.race([startPolling(), timeout]);
+    
+    return Promise.race([timeout, new Promise(resolve => {
+        // EventSource verbindet sich nach Abbrüchen selbst wieder
+        const source = new EventSource('/api/events');
+        eventSource = source;
+        source.addEventListener('image', event => onServerEvent('image', JSON.parse(event.data)));
+        source.addEventListener('batch', event => onServerEvent('batch', JSON.parse(event.data)));
+        source.onopen = () => resolve();
+        source.onerror = () => {
+            // Kein Stream (Gunicorn antwortet mit 501): auf Abfragen umstellen
+            if (source.readyState !== EventSource.CLOSED) return;
+            if (eventSource === source) eventSource = null;
+            eventStreamUnavailable = true;
+            if (eventsActive > 0) startPolling().then(resolve);
+            else resolve();
+        };
+    })]);
+}
+
+function stopEvents() {
+    eventsActive = Math.max(0, eventsActive - 1);
+    if (eventsActive > 0) return;
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+    // Die Abfrage endet nach der laufenden Anfrage von selbst
+}
+
+function startPolling() {
+    return new Promise(resolve => pollEvents(resolve));
+}
+
+async function pollEvents(ready) {
+    // Jede Anfrage wartet nur kurz auf neue Events, dann wird erneut gefragt
+    if (eventsPolling) return ready();
+    eventsPolling = true;
+    let after = null;
+    try {
+        while (eventsActive > 0) {
+            try {
+                const url = after === null ? '/api/events/poll' : `/api/events/poll?after=${after}`;
+                const response = await fetch(url);
+                const data = await response.json();
+                if (!data.success) throw new Error(data.error);
+                data.events.forEach(event => onServerEvent(event.type, event.data));
+                after = data.last_id;
+                ready();
+            } catch (e) {
+                // Netzwerkfehler: kurz warten, dann erneut versuchen
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+    } finally {
+        eventsPolling = false;
+        ready();
+    }
+}
+
+function onServerEvent(type, data) {
+    if (type === 'image') onImageEvent(data);
+    else if (type === 'batch') onBatchEvent(data);
+}
+
+function onImageEvent(data) {
+    const img = uploadedImages.find(i => i.id === data.id);
+    if (!img || img.version === data.version) return;
+    img.width = data.width;
+    img.height = data.height;
+    img.version = data.version;
+    // Bilddaten gehören zur alten Version
+    delete img.imageData;
+    
+    // Nur das Vorschaubild dieses Bildes neu laden
+    const thumb = document.querySelector(`.gallery-item[data-id="${data.id}"] img`);
+    if (thumb) thumb.src = thumbnailUrl(img);
+}
+
+function onBatchEvent(data) {
+    if (data.batch !== activeBatchId) return;
+    document.getElementById('loadingProgress').textContent = ` ${data.done}/${data.total}`;
+}
+
+function newBatchId() {
+    return Math.random().toString(36).slice(2, 10);
+}
+
+function thumbnailUrl(img) {
+    return `/api/images/${img.id}/thumbnail?v=${img.version || 0}`;
+}
+
 async function uploadImageToServer(imageData, filename) {
     const response = await fetch('/api/images', {
         method: 'POST',
@@ -45,6 +207,65 @@ async function uploadImageToServer(imageData, filename) {
     return await response.json();
 }
 
+// Ab dieser Größe wird in Teilen hochgeladen (fortsetzbar bei Verbindungsabbruch)
+const CHUNKED_UPLOAD_MIN_BYTES = 8 * 1024 * 1024;
+
+async function uploadFileChunked(file) {
+    const created = await (await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    })).json();
+    if (!created.success) return created;
+    
+    const uploadId = created.upload.id;
+    const chunkSize = created.chunk_size;
+    let offset = 0;
+    let failures = 0;
+    
+    while (offset < file.size) {
+        const chunk = await file.slice(offset, offset + chunkSize).arrayBuffer();
+        const headers = {
+            'Content-Type': 'application/offset+octet-stream',
+            'Upload-Offset': String(offset)
+        };
+        // Prüfsumme je Teil (WebCrypto nur in sicheren Kontexten verfügbar)
+        if (window.crypto && crypto.subtle) {
+            const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', chunk));
+            headers['Upload-Checksum'] = 'sha256 ' + btoa(String.fromCharCode(...digest));
+        }
+        
+        try {
+            const response = await fetch(`/api/uploads/${uploadId}`, { method: 'PATCH', headers, body: chunk });
+            if (response.ok) {
+                offset = parseInt(response.headers.get('Upload-Offset'));
+                failures = 0;
+                continue;
+            }
+            if (![409, 423, 460].includes(response.status) && response.status < 500) {
+                return await response.json();
+            }
+        } catch (e) {
+            console.warn('Chunk upload failed, resuming:', e);
+        }
+        
+        if (++failures > 5) {
+            return { success: false, error: t('uploadError') };
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+        // Beim Server nachfragen, wie viel schon angekommen ist
+        const status = await fetch(`/api/uploads/${uploadId}`);
+        if (status.ok) offset = parseInt(status.headers.get('Upload-Offset'));
+    }
+    
+    const response = await fetch(`/api/uploads/${uploadId}/finish`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: '{}'
+    });
+    return await response.json();
+}
+
 async function getImageFromServer(imageId) {
     const response = await fetch(`/api/images/${imageId}`);
     return await response.json();
@@ -172,6 +393,7 @@ async function continueSession() {
             if (currentImg) {
                 currentImg.imageData = imageData.image;
                 showEditor(currentImg);
+                displayServerImage(imageData);
             }
         }
         console.log(t('loaded'), uploadedImages.length, t('imagesFromStorage'));
@@ -202,6 +424,10 @@ document.addEventListener('DOMContentLoaded', () => {
     setupSliders();
     setupAspectRatio();
     setupAddMoreInput();
+    loadPresets();
+    loadExportFormats();
+    setupTileViewer();
+    setupHistoryShortcuts();
     
     // Check if saved images exist
     checkForSavedImages().then(hasSaved => {
@@ -275,6 +501,17 @@ async function handleFiles(files, append = false) {
         
         for (const file of imageFiles) {
             try {
+                if (file.size >= CHUNKED_UPLOAD_MIN_BYTES) {
+                    // Große Datei: in Teilen hochladen, angezeigt wird die Serverversion
+                    const result = await uploadFileChunked(file);
+                    if (result.success) {
+                        newImages.push({ ...result.image });
+                    } else if (result.error) {
+                        showToast(result.error, 'error');
+                    }
+                    continue;
+                }
+                
                 const imageData = await readFileAsBase64(file);
                 
                 // Bild auf Server hochladen
@@ -285,6 +522,8 @@ async function handleFiles(files, append = false) {
                         ...result.image,
                         imageData: imageData  // For immediate display
                     });
+                } else if (result.error) {
+                    showToast(result.error, 'error');
                 }
             } catch (e) {
                 console.error('Fehler bei Datei:', file.name, e);
@@ -306,6 +545,10 @@ async function handleFiles(files, append = false) {
             currentImageId = newImages[0].id;
             currentImageData = newImages[0].imageData;
             showEditor(newImages[0]);
+            if (!newImages[0].imageData) {
+                const imageData = await getImageFromServer(currentImageId);
+                if (imageData.success) displayServerImage(imageData);
+            }
         }
         
     } catch (error) {
@@ -337,9 +580,11 @@ function showEditor(imgData) {
     
     // Bild anzeigen
     if (imgData.imageData) {
+        hideTiledImage();
         previewImage.src = imgData.imageData;
         currentImageData = imgData.imageData;
     } else if (currentImageData) {
+        hideTiledImage();
         previewImage.src = currentImageData;
     }
     
@@ -364,11 +609,14 @@ function updateGallery() {
     uploadedImages.forEach(img => {
         const item = document.createElement('div');
         item.className = 'gallery-item' + (img.id === currentImageId ? ' active' : '');
+        item.dataset.id = img.id;
         item.onclick = () => selectImage(img.id);
         
+        const group = similarGroups[img.id];
         item.innerHTML = `
-            <img src="/api/images/${img.id}/thumbnail" alt="${img.filename}">
+            <img src="${thumbnailUrl(img)}" alt="${img.filename}">
             <button class="remove-btn" onclick="event.stopPropagation(); removeImage('${img.id}')">×</button>
+            ${group ? `<span class="group-badge" title="${t('similarGroup')} ${group}">${group}</span>` : ''}
             <span class="filename">${img.filename}</span>
         `;
         
@@ -376,6 +624,43 @@ function updateGallery() {
     });
 }
 
+async function groupSimilarImages() {
+    if (uploadedImages.length < 2) {
+        showToast(t('noSimilarImages'));
+        return;
+    }
+    
+    try {
+        const response = await fetch('/api/images/groups');
+        const data = await response.json();
+        if (!data.success) {
+            showToast(data.error || t('processingError'), 'error');
+            return;
+        }
+        
+        // Ähnliche Bilder nebeneinander und mit Gruppennummer anzeigen
+        similarGroups = {};
+        const order = [];
+        data.groups.forEach((group, index) => {
+            group.forEach(member => {
+                similarGroups[member.id] = index + 1;
+                order.push(member.id);
+            });
+        });
+        const position = id => order.includes(id) ? order.indexOf(id) : order.length;
+        uploadedImages.sort((a, b) => position(a.id) - position(b.id));
+        updateGallery();
+        
+        if (data.groups.length) {
+            showToast(`${t('similarGroupsFound')}: ${data.groups.length}`, 'success');
+        } else {
+            showToast(t('noSimilarImages'));
+        }
+    } catch (error) {
+        showToast(t('processingError'), 'error');
+    }
+}
+
 async function selectImage(imageId) {
     if (imageId === currentImageId) return;
     
@@ -387,12 +672,11 @@ async function selectImage(imageId) {
         const imageData = await getImageFromServer(imageId);
         if (imageData.success) {
             currentImageId = imageId;
-            currentImageData = imageData.image;
             imgData.imageData = imageData.image;
             imgData.width = imageData.width;
             imgData.height = imageData.height;
             
-            previewImage.src = imageData.image;
+            displayServerImage(imageData);
             document.getElementById('imageName').textContent = imgData.filename;
             updateDimensions(imageData.width, imageData.height);
             
@@ -459,16 +743,18 @@ async function processImage(operation, params = {}) {
     showLoading(true);
 
     try {
-        if (operation === 'reset') {
-            // Reset via server API
-            const response = await fetch(`/api/images/${currentImageId}/reset`, {
+        if (['reset', 'undo', 'redo'].includes(operation)) {
+            // Zurücksetzen bzw. Verlauf über die Server-API
+            const response = await fetch(`/api/images/${currentImageId}/${operation}`, {
                 method: 'POST'
             });
             const data = await response.json();
             
-            if (data.success) {
-                currentImageData = data.image;
-                previewImage.src = data.image;
+            if (response.status === 409) {
+                // Kein Schritt mehr im Verlauf
+                showToast(t(operation === 'undo' ? 'nothingToUndo' : 'nothingToRedo'));
+            } else if (data.success) {
+                displayServerImage(data);
                 updateDimensions(data.width, data.height);
                 
                 // Lokale Daten aktualisieren
@@ -480,7 +766,7 @@ async function processImage(operation, params = {}) {
                 }
                 
                 updateGallery();
-                showToast(t('resetSuccess'), 'success');
+                showToast(t(`${operation}Success`), 'success');
             } else {
                 showToast(data.error || t('processingError'), 'error');
             }
@@ -499,8 +785,7 @@ async function processImage(operation, params = {}) {
             const data = await response.json();
 
             if (data.success) {
-                currentImageData = data.image;
-                previewImage.src = data.image;
+                displayServerImage(data);
                 updateDimensions(data.width, data.height);
                 
                 // Lokale Daten aktualisieren
@@ -545,6 +830,8 @@ async function applyToAllImages(operation, params = {}) {
     }
     
     showLoading(true);
+    activeBatchId = newBatchId();
+    await startEvents();
     
     try {
         const imageIds = uploadedImages.map(img => img.id);
@@ -552,32 +839,22 @@ async function applyToAllImages(operation, params = {}) {
         const response = await fetch('/api/process_batch', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ image_ids: imageIds, operation, params })
+            body: JSON.stringify({ image_ids: imageIds, operation, params, batch_id: activeBatchId })
         });
         
         const data = await response.json();
         
         if (data.success) {
-            // Lokale Daten aktualisieren
-            data.results.forEach(result => {
-                const img = uploadedImages.find(i => i.id === result.id);
-                if (img) {
-                    img.width = result.width;
-                    img.height = result.height;
-                    // imageData will be updated on next load
-                    delete img.imageData;
-                }
-            });
+            // Nur die geänderten Einträge vom Server übernehmen
+            await syncGallery();
             
             // Aktuelles Bild neu laden
             const imageData = await getImageFromServer(currentImageId);
             if (imageData.success) {
-                currentImageData = imageData.image;
-                previewImage.src = imageData.image;
+                displayServerImage(imageData);
                 updateDimensions(imageData.width, imageData.height);
             }
             
-            updateGallery();
             showToast(`${data.processed} ${t('batchSuccess')}`, 'success');
         } else {
             showToast(data.error || t('batchError'), 'error');
@@ -586,6 +863,7 @@ async function applyToAllImages(operation, params = {}) {
         showToast(t('networkError') + error.message, 'error');
     }
     
+    stopEvents();
     showLoading(false);
 }
 
@@ -625,7 +903,9 @@ function resizeToMaxSize() {
         return;
     }
     
-    processImage('resize_max_size', { max_size_mb: maxSizeMB, format, quality });
+    // Größe so prüfen, wie der Download kodiert wird
+    const profile = document.getElementById('downloadProfile').value;
+    processImage('resize_max_size', { max_size_mb: maxSizeMB, format, quality, profile });
 }
 
 function rotate(angle) {
@@ -665,6 +945,15 @@ function adjustSaturation() {
     processImage('saturation', { factor });
 }
 
+function autoCropParams() {
+    const aspect = document.getElementById('autoCropAspect').value;
+    return aspect ? { aspect } : {};
+}
+
+function autoCrop() {
+    processImage('auto_crop', autoCropParams());
+}
+
 function crop() {
     const left = parseInt(document.getElementById('cropLeft').value) || 0;
     const top = parseInt(document.getElementById('cropTop').value) || 0;
@@ -684,6 +973,33 @@ function resetImage() {
     resetSliders();
 }
 
+function undoImage() {
+    processImage('undo');
+    resetSliders();
+}
+
+function redoImage() {
+    processImage('redo');
+    resetSliders();
+}
+
+function setupHistoryShortcuts() {
+    // Strg+Z / Strg+Y (bzw. Strg+Umschalt+Z), nicht in Eingabefeldern
+    document.addEventListener('keydown', (e) => {
+        if (!(e.ctrlKey || e.metaKey) || !currentImageId || editor.classList.contains('hidden')) return;
+        if (e.target.closest('input, textarea, select')) return;
+        
+        const key = e.key.toLowerCase();
+        if (key === 'z' && !e.shiftKey) {
+            e.preventDefault();
+            undoImage();
+        } else if (key === 'y' || (key === 'z' && e.shiftKey)) {
+            e.preventDefault();
+            redoImage();
+        }
+    });
+}
+
 async function newImage() {
     showLoading(true);
     await clearAllImagesFromServer();
@@ -716,8 +1032,9 @@ function batchResizeToMaxSize() {
     const maxSizeMB = parseFloat(document.getElementById('maxFileSizeMB').value);
     const format = document.getElementById('maxSizeFormat').value;
     const quality = parseInt(document.getElementById('maxSizeQuality').value);
+    const profile = document.getElementById('downloadProfile').value;
     if (maxSizeMB <= 0) { showToast(t('invalidFileSize'), 'error'); return; }
-    applyToAllImages('resize_max_size', { max_size_mb: maxSizeMB, format, quality });
+    applyToAllImages('resize_max_size', { max_size_mb: maxSizeMB, format, quality, profile });
 }
 
 function batchRotate(angle) { applyToAllImages('rotate', { angle }); }
@@ -728,10 +1045,122 @@ function batchSharpen() { applyToAllImages('sharpen', { factor: parseFloat(docum
 function batchAdjustBrightness() { applyToAllImages('brightness', { factor: parseFloat(document.getElementById('brightness').value) }); }
 function batchAdjustContrast() { applyToAllImages('contrast', { factor: parseFloat(document.getElementById('contrast').value) }); }
 function batchAdjustSaturation() { applyToAllImages('saturation', { factor: parseFloat(document.getElementById('saturation').value) }); }
+function batchAutoCrop() { applyToAllImages('auto_crop', autoCropParams()); }
+
+// ==================== VORLAGEN ====================
+
+async function loadPresets() {
+    try {
+        const response = await fetch('/api/presets');
+        const data = await response.json();
+        if (!data.success || data.presets.length === 0) return;
+        
+        const select = document.getElementById('presetSelect');
+        select.innerHTML = '';
+        data.presets.forEach(preset => {
+            const option = document.createElement('option');
+            option.value = preset.id;
+            option.textContent = preset.name;
+            select.appendChild(option);
+        });
+        document.getElementById('presetSection').classList.remove('hidden');
+    } catch (e) {
+        console.error('Error loading presets:', e);
+    }
+}
+
+async function applyPreset() {
+    if (!currentImageId) {
+        showToast(t('uploadFirst'), 'error');
+        return;
+    }
+    
+    const presetId = document.getElementById('presetSelect').value;
+    showLoading(true);
+    
+    try {
+        const response = await fetch(`/api/presets/${presetId}/apply`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ image_id: currentImageId })
+        });
+        const data = await response.json();
+        
+        if (data.success) {
+            displayServerImage(data);
+            updateDimensions(data.width, data.height);
+            
+            const currentImg = uploadedImages.find(img => img.id === currentImageId);
+            if (currentImg) {
+                currentImg.width = data.width;
+                currentImg.height = data.height;
+                currentImg.imageData = data.image;
+            }
+            
+            updateGallery();
+            showToast(t('applySuccess'), 'success');
+        } else {
+            showToast(data.error || t('processingError'), 'error');
+        }
+    } catch (error) {
+        showToast(t('networkError') + error.message, 'error');
+    }
+    
+    showLoading(false);
+}
+
+async function batchApplyPreset() {
+    if (uploadedImages.length === 0) {
+        showToast(t('noImagesLoaded'), 'error');
+        return;
+    }
+    
+    const presetId = document.getElementById('presetSelect').value;
+    showLoading(true);
+    activeBatchId = newBatchId();
+    await startEvents();
+    
+    try {
+        const response = await fetch(`/api/presets/${presetId}/apply`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ image_ids: uploadedImages.map(img => img.id), batch_id: activeBatchId })
+        });
+        const data = await response.json();
+        
+        if (data.success) {
+            await syncGallery();
+            
+            const imageData = await getImageFromServer(currentImageId);
+            if (imageData.success) {
+                displayServerImage(imageData);
+                updateDimensions(imageData.width, imageData.height);
+            }
+            
+            showToast(`${data.processed} ${t('batchSuccess')}`, 'success');
+        } else {
+            showToast(data.error || t('batchError'), 'error');
+        }
+    } catch (error) {
+        showToast(t('networkError') + error.message, 'error');
+    }
+    
+    stopEvents();
+    showLoading(false);
+}
 
 // ==================== DOWNLOAD ====================
 
 async function downloadImage() {
+    if (currentImageId && !currentImageData && tileViewer.info) {
+        // Kachelansicht: das Bild liegt nur auf dem Server vor
+        return exportInBackground(
+            document.getElementById('downloadFormat').value,
+            parseInt(document.getElementById('downloadQuality').value),
+            document.getElementById('downloadProfile').value,
+            [currentImageId]
+        );
+    }
     if (!currentImageId || !currentImageData) {
         showToast(t('noImageToDownload'), 'error');
         return;
@@ -742,6 +1171,7 @@ async function downloadImage() {
     
     const format = document.getElementById('downloadFormat').value;
     const quality = document.getElementById('downloadQuality').value;
+    const profile = document.getElementById('downloadProfile').value;
     
     try {
         const response = await fetch('/api/download', {
@@ -751,7 +1181,8 @@ async function downloadImage() {
                 image: currentImageData,
                 filename: currentImg.filename,
                 format,
-                quality: parseInt(quality)
+                quality: parseInt(quality),
+                profile
             })
         });
         
@@ -765,6 +1196,7 @@ async function downloadImage() {
             a.click();
             document.body.removeChild(a);
             URL.revokeObjectURL(url);
+            showToast(describeExport(response), 'success');
         } else {
             showToast(t('downloadError'), 'error');
         }
@@ -781,6 +1213,12 @@ async function downloadAllImages() {
     
     const format = document.getElementById('downloadFormat').value;
     const quality = document.getElementById('downloadQuality').value;
+    const profile = document.getElementById('downloadProfile').value;
+    
+    // Langsame Formate werden auf dem Server im Hintergrund kodiert
+    if (backgroundFormats.has(format)) {
+        return exportInBackground(format, parseInt(quality), profile);
+    }
     
     showLoading(true);
     
@@ -789,6 +1227,11 @@ async function downloadAllImages() {
         const imagesToDownload = [];
         for (const img of uploadedImages) {
             const imageData = await getImageFromServer(img.id);
+            if (imageData.tiled) {
+                // Sehr große Bilder werden auf dem Server exportiert
+                showLoading(false);
+                return exportInBackground(format, parseInt(quality), profile);
+            }
             if (imageData.success) {
                 imagesToDownload.push({
                     filename: img.filename,
@@ -803,7 +1246,8 @@ async function downloadAllImages() {
             body: JSON.stringify({
                 images: imagesToDownload,
                 format,
-                quality: parseInt(quality)
+                quality: parseInt(quality),
+                profile
             })
         });
         
@@ -817,7 +1261,270 @@ async function downloadAllImages() {
             a.click();
             document.body.removeChild(a);
             URL.revokeObjectURL(url);
-            showToast(`${uploadedImages.length} ${t('imagesDownloaded')}`, 'success');
+            showToast(`${uploadedImages.length} ${t('imagesDownloaded')} ${describeExport(response)}`, 'success');
+        } else {
+            showToast(t('downloadError'), 'error');
+        }
+    } catch (error) {
+        showToast(t('networkError') + error.message, 'error');
+    }
+    
+    showLoading(false);
+}
+
+async function downloadRenditions() {
+    if (!currentImageId) {
+        showToast(t('noImageToDownload'), 'error');
+        return;
+    }
+    
+    const widths = document.getElementById('renditionWidths').value
+        .split(',').map(w => parseInt(w)).filter(w => w > 0);
+    if (widths.length === 0) {
+        showToast(t('invalidValues'), 'error');
+        return;
+    }
+    
+    showLoading(true);
+    
+    try {
+        const response = await fetch('/api/renditions', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                image_id: currentImageId,
+                widths,
+                formats: [document.getElementById('downloadFormat').value],
+                quality: parseInt(document.getElementById('downloadQuality').value),
+                profile: document.getElementById('downloadProfile').value
+            })
+        });
+        
+        if (response.ok) {
+            const blob = await response.blob();
+            const url = URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = 'renditions.zip';
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
+            URL.revokeObjectURL(url);
+        } else {
+            const result = await response.json();
+            showToast(result.error || t('downloadError'), 'error');
+        }
+    } catch (error) {
+        showToast(t('networkError') + error.message, 'error');
+    }
+    
+    showLoading(false);
+}
+
+// ==================== TILE VIEWER ====================
+
+const tileViewer = {
+    canvas: document.getElementById('tileCanvas'),
+    info: null,        // Beschreibung der Kachelpyramide vom Server
+    scale: 1,          // Bildschirmpixel pro Bildpixel
+    offsetX: 0,
+    offsetY: 0,
+    tiles: new Map(),  // geladene Kacheln der aktuellen Version
+    drag: null
+};
+
+function displayServerImage(data) {
+    // Sehr große Bilder kommen als Kachelpyramide statt als Base64
+    if (data.tiled) {
+        currentImageData = null;
+        showTiledImage(data.tiles);
+    } else {
+        hideTiledImage();
+        currentImageData = data.image;
+        previewImage.src = data.image;
+    }
+}
+
+function showTiledImage(info) {
+    const canvas = tileViewer.canvas;
+    const sameImage = tileViewer.info && tileViewer.info.url === info.url;
+    previewImage.classList.add('hidden');
+    canvas.classList.remove('hidden');
+    if (sameImage) return;
+    
+    tileViewer.info = info;
+    tileViewer.tiles = new Map();
+    canvas.width = canvas.clientWidth;
+    canvas.height = canvas.clientHeight;
+    
+    // Ganzes Bild einpassen
+    tileViewer.scale = Math.min(canvas.width / info.width, canvas.height / info.height);
+    tileViewer.offsetX = (canvas.width - info.width * tileViewer.scale) / 2;
+    tileViewer.offsetY = (canvas.height - info.height * tileViewer.scale) / 2;
+    drawTiles();
+}
+
+function hideTiledImage() {
+    tileViewer.info = null;
+    tileViewer.tiles = new Map();
+    tileViewer.canvas.classList.add('hidden');
+    previewImage.classList.remove('hidden');
+}
+
+function loadTile(level, col, row) {
+    const key = `${level}/${col}_${row}`;
+    let tile = tileViewer.tiles.get(key);
+    if (!tile) {
+        tile = new Image();
+        tile.onload = () => drawTiles();
+        tile.src = tileViewer.info.url
+            .replace('{level}', level).replace('{col}', col).replace('{row}', row);
+        tileViewer.tiles.set(key, tile);
+    }
+    return tile.complete && tile.naturalWidth ? tile : null;
+}
+
+function drawTiles() {
+    const { canvas, info, scale, offsetX, offsetY } = tileViewer;
+    if (!info) return;
+    const ctx = canvas.getContext('2d');
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    
+    // Kleinste Stufe, die mindestens die Bildschirmauflösung hat
+    const level = Math.max(0, Math.min(info.max_level, info.max_level + Math.ceil(Math.log2(scale))));
+    const levelScale = Math.pow(2, info.max_level - level);  // Bildpixel pro Stufenpixel
+    const tileSpan = info.tile_size * levelScale;            // Bildpixel pro Kachel
+    
+    // Nur sichtbare Kacheln laden
+    const firstCol = Math.max(0, Math.floor(-offsetX / scale / tileSpan));
+    const firstRow = Math.max(0, Math.floor(-offsetY / scale / tileSpan));
+    const lastCol = Math.min(Math.ceil(info.width / tileSpan) - 1, Math.floor((canvas.width - offsetX) / scale / tileSpan));
+    const lastRow = Math.min(Math.ceil(info.height / tileSpan) - 1, Math.floor((canvas.height - offsetY) / scale / tileSpan));
+    
+    for (let row = firstRow; row <= lastRow; row++) {
+        for (let col = firstCol; col <= lastCol; col++) {
+            const tile = loadTile(level, col, row);
+            if (tile) {
+                ctx.drawImage(
+                    tile,
+                    offsetX + col * tileSpan * scale,
+                    offsetY + row * tileSpan * scale,
+                    tile.naturalWidth * levelScale * scale,
+                    tile.naturalHeight * levelScale * scale
+                );
+            }
+        }
+    }
+}
+
+function setupTileViewer() {
+    const canvas = tileViewer.canvas;
+    
+    canvas.addEventListener('wheel', (e) => {
+        if (!tileViewer.info) return;
+        e.preventDefault();
+        // Um die Mausposition zoomen
+        const factor = e.deltaY < 0 ? 1.25 : 0.8;
+        const rect = canvas.getBoundingClientRect();
+        const x = e.clientX - rect.left;
+        const y = e.clientY - rect.top;
+        tileViewer.offsetX = x - (x - tileViewer.offsetX) * factor;
+        tileViewer.offsetY = y - (y - tileViewer.offsetY) * factor;
+        tileViewer.scale *= factor;
+        drawTiles();
+    }, { passive: false });
+    
+    canvas.addEventListener('pointerdown', (e) => {
+        tileViewer.drag = { x: e.clientX, y: e.clientY };
+        canvas.classList.add('dragging');
+        canvas.setPointerCapture(e.pointerId);
+    });
+    canvas.addEventListener('pointermove', (e) => {
+        if (!tileViewer.drag) return;
+        tileViewer.offsetX += e.clientX - tileViewer.drag.x;
+        tileViewer.offsetY += e.clientY - tileViewer.drag.y;
+        tileViewer.drag = { x: e.clientX, y: e.clientY };
+        drawTiles();
+    });
+    canvas.addEventListener('pointerup', () => {
+        tileViewer.drag = null;
+        canvas.classList.remove('dragging');
+    });
+    
+    window.addEventListener('resize', () => {
+        if (!tileViewer.info) return;
+        canvas.width = canvas.clientWidth;
+        canvas.height = canvas.clientHeight;
+        drawTiles();
+    });
+}
+
+// ==================== EXPORT FORMATS ====================
+
+let backgroundFormats = new Set();
+
+async function loadExportFormats() {
+    try {
+        const response = await fetch('/api/formats');
+        const data = await response.json();
+        if (!data.success) return;
+        
+        // Nur Formate anbieten, die der Server kodieren kann
+        const select = document.getElementById('downloadFormat');
+        const selected = select.value;
+        select.innerHTML = '';
+        data.formats.filter(format => format.name !== 'jpg').forEach(format => {
+            const option = document.createElement('option');
+            option.value = format.name;
+            option.textContent = format.name === 'jxl' ? 'JPEG XL' : format.name.toUpperCase().replace('WEBP', 'WebP');
+            select.appendChild(option);
+        });
+        select.value = selected;
+        backgroundFormats = new Set(data.formats.filter(format => format.background).map(format => format.name));
+        document.getElementById('downloadProfile').value = data.default_profile;
+    } catch (e) {
+        console.error('Error loading export formats:', e);
+    }
+}
+
+async function exportInBackground(format, quality, profile, imageIds = null) {
+    showLoading(true);
+    
+    try {
+        const response = await fetch('/api/exports', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ format, quality, profile, image_ids: imageIds })
+        });
+        const result = await response.json();
+        if (!response.ok) {
+            showToast(result.error || t('downloadError'), 'error');
+            showLoading(false);
+            return;
+        }
+        
+        let job = result.job;
+        while (job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const status = await (await fetch(`/api/exports/${job.id}`)).json();
+            if (!status.success) break;
+            job = status.job;
+        }
+        
+        const download = await fetch(`/api/exports/${job.id}/download`);
+        if (download.ok) {
+            const blob = await download.blob();
+            const url = URL.createObjectURL(blob);
+            const a = document.createElement('a');
+            a.href = url;
+            a.download = job.total === 1
+                ? job.items[0].filename.replace(/\.[^.]+$/, '') + '_edited.' + format
+                : 'images_edited.zip';
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
+            URL.revokeObjectURL(url);
+            showToast(`${job.done} ${t('imagesDownloaded')} ${describeExport(download)}`, 'success');
         } else {
             showToast(t('downloadError'), 'error');
         }
@@ -830,6 +1537,13 @@ async function downloadAllImages() {
 
 // ==================== UI HELPERS ====================
 
+function describeExport(response) {
+    // Größe und Kodierzeit aus den Antwort-Headern
+    const bytes = parseInt(response.headers.get('X-Output-Bytes') || '0');
+    const ms = parseFloat(response.headers.get('X-Encode-Time-Ms') || '0');
+    return `${(bytes / 1024).toFixed(1)} KB, ${t('encodedIn')} ${Math.round(ms)} ms`;
+}
+
 function setupSliders() {
     const sliders = [
         { id: 'blurRadius', display: 'blurValue' },
@@ -906,6 +1620,10 @@ function setScalePercent(value) {
 
 function showLoading(show) {
     loading.classList.toggle('hidden', !show);
+    if (!show) {
+        activeBatchId = null;
+        document.getElementById('loadingProgress').textContent = '';
+    }
 }
 
 function showToast(message, type = 'error') {
@@ -45,6 +45,12 @@ const translations = {
         format: 'Format:',
         quality: 'Quality:',
         compress: 'Compress',
+        exportProfile: 'Encoding:',
+        profileFast: 'Fast',
+        profileBalanced: 'Balanced',
+        profileSmallest: 'Smallest file',
+        renditionWidths: 'Widths (srcset):',
+        downloadRenditions: '📐 Sizes as ZIP',
         
         // Rotate & Flip
         rotateFlip: '🔄 Rotate & Flip',
@@ -66,6 +72,15 @@ const translations = {
         contrast: 'Contrast:',
         saturation: 'Saturation:',
         
+        // Auto
+        autoAdjust: '✨ Auto',
+        autoLevels: 'Auto levels',
+        autoContrast: 'Auto contrast',
+        autoWhiteBalance: 'Auto white balance',
+        aspectRatio: 'Aspect ratio:',
+        aspectFree: 'Free',
+        autoCrop: 'Crop to subject',
+        
         // Crop
         crop: '✂️ Crop',
         left: 'Left:',
@@ -74,8 +89,16 @@ const translations = {
         bottom: 'Bottom:',
         cropBtn: 'Crop',
         
+        // Presets
+        presets: '📋 Presets',
+        applyPreset: 'Apply',
+        
         // Actions
         actions: '💾 Actions',
+        undo: '⟲ Undo',
+        redo: '⟳ Redo',
+        undoHint: 'Undo (Ctrl+Z)',
+        redoHint: 'Redo (Ctrl+Y)',
         reset: '↩ Reset',
         newImage: '📁 New Image',
         download: '⬇ Download',
@@ -84,6 +107,11 @@ const translations = {
         // Gallery
         uploadedImages: '🖼️ Uploaded Images',
         addMore: '➕ Add more',
+        groupSimilar: '👯 Similar',
+        groupSimilarHint: 'Group similar images (near-duplicates, burst shots)',
+        similarGroup: 'Similar images, group',
+        similarGroupsFound: 'Groups of similar images',
+        noSimilarImages: 'No similar images found',
         
         // Welcome Screen
         newImagesTitle: 'Edit new images',
@@ -103,6 +131,10 @@ const translations = {
         uploadFirst: 'Please upload an image first!',
         imageNotFound: 'Image not found!',
         resetSuccess: 'Reset!',
+        undoSuccess: 'Undone',
+        redoSuccess: 'Redone',
+        nothingToUndo: 'Nothing to undo',
+        nothingToRedo: 'Nothing to redo',
         applySuccess: 'Successfully applied!',
         compressedTo: 'Compressed to ~',
         newSize: 'New size:',
@@ -118,6 +150,7 @@ const translations = {
         noImageToDownload: 'No image to download!',
         downloadError: 'Download error',
         imagesDownloaded: 'images downloaded!',
+        encodedIn: 'encoded in',
         imageRemoved: 'Image removed',
         storageFull: 'Storage full - older images will be removed',
         imagesNotSaved: 'Images could not be saved',
@@ -168,6 +201,12 @@ const translations = {
         format: 'Format:',
         quality: 'Qualität:',
         compress: 'Komprimieren',
+        exportProfile: 'Kodierung:',
+        profileFast: 'Schnell',
+        profileBalanced: 'Ausgewogen',
+        profileSmallest: 'Kleinste Datei',
+        renditionWidths: 'Breiten (srcset):',
+        downloadRenditions: '📐 Größen als ZIP',
         
         // Rotate & Flip
         rotateFlip: '🔄 Drehen & Spiegeln',
@@ -189,6 +228,15 @@ const translations = {
         contrast: 'Kontrast:',
         saturation: 'Sättigung:',
         
+        // Auto
+        autoAdjust: '✨ Automatisch',
+        autoLevels: 'Tonwerte automatisch',
+        autoContrast: 'Kontrast automatisch',
+        autoWhiteBalance: 'Weißabgleich automatisch',
+        aspectRatio: 'Seitenverhältnis:',
+        aspectFree: 'Frei',
+        autoCrop: 'Auf Motiv zuschneiden',
+        
         // Crop
         crop: '✂️ Zuschneiden',
         left: 'Links:',
@@ -197,8 +245,16 @@ const translations = {
         bottom: 'Unten:',
         cropBtn: 'Zuschneiden',
         
+        // Presets
+        presets: '📋 Vorlagen',
+        applyPreset: 'Anwenden',
+        
         // Actions
         actions: '💾 Aktionen',
+        undo: '⟲ Rückgängig',
+        redo: '⟳ Wiederholen',
+        undoHint: 'Rückgängig (Strg+Z)',
+        redoHint: 'Wiederholen (Strg+Y)',
         reset: '↩ Zurücksetzen',
         newImage: '📁 Neues Bild',
         download: '⬇ Herunterladen',
@@ -207,6 +263,11 @@ const translations = {
         // Gallery
         uploadedImages: '🖼️ Hochgeladene Bilder',
         addMore: '➕ Mehr hinzufügen',
+        groupSimilar: '👯 Ähnliche',
+        groupSimilarHint: 'Ähnliche Bilder gruppieren (Beinahe-Duplikate, Serienbilder)',
+        similarGroup: 'Ähnliche Bilder, Gruppe',
+        similarGroupsFound: 'Gruppen ähnlicher Bilder',
+        noSimilarImages: 'Keine ähnlichen Bilder gefunden',
         
         // Welcome Screen
         newImagesTitle: 'Neue Bilder bearbeiten',
@@ -226,6 +287,10 @@ const translations = {
         uploadFirst: 'Bitte zuerst ein Bild hochladen!',
         imageNotFound: 'Bild nicht gefunden!',
         resetSuccess: 'Zurückgesetzt!',
+        undoSuccess: 'Rückgängig gemacht',
+        redoSuccess: 'Wiederholt',
+        nothingToUndo: 'Nichts rückgängig zu machen',
+        nothingToRedo: 'Nichts zu wiederholen',
         applySuccess: 'Erfolgreich angewendet!',
         compressedTo: 'Komprimiert auf ~',
         newSize: 'Neue Größe:',
@@ -241,6 +306,7 @@ const translations = {
         noImageToDownload: 'Kein Bild zum Herunterladen!',
         downloadError: 'Fehler beim Download',
         imagesDownloaded: 'Bilder heruntergeladen!',
+        encodedIn: 'kodiert in',
         imageRemoved: 'Bild entfernt',
         storageFull: 'Speicherplatz voll - ältere Bilder werden entfernt',
         imagesNotSaved: 'Bilder konnten nicht gespeichert werden',
@@ -0,0 +1,248 @@
+"""
+Bildwerkzeug - Image statistics and automatic operations
+
+Statistics are computed from a small proxy of an image (at most STATS_SIZE
+px on the longer side) whenever a version is stored, and kept next to it:
+per-channel and luminance histograms, an entropy map and an edge-density
+map on a coarse grid. The automatic operations are resolved from them into
+plain levels and crop operations, so their parameters for a whole batch
+are known without decoding the full images again.
+"""
+
+import math
+
+from PIL import Image, ImageFilter, ImageOps
+
+
+# Longest side of the proxy statistics are computed from
+STATS_SIZE = 256
+
+# Proxy pixels per grid cell of the entropy and edge maps
+GRID_CELL = 16
+
+# Stored statistics of another version are computed again
+STATS_VERSION = 1
+
+
+def parse_aspect(value):
+    """Aspect ratio (width / height) from a number or 'width:height'"""
+    if isinstance(value, str) and ':' in value:
+        width, height = value.split(':', 1)
+        aspect = float(width) / float(height)
+    else:
+        aspect = float(value)
+    if not math.isfinite(aspect) or aspect <= 0:
+        raise ValueError(f'Invalid aspect ratio: {value!r}')
+    return aspect
+
+
+# Automatic operations and their parameter types
+AUTO_PARAM_TYPES = {
+    'auto_levels': {'clip': float},
+    'auto_contrast': {'clip': float},
+    'auto_white_balance': {'strength': float},
+    'auto_crop': {'aspect': parse_aspect, 'padding': float, 'coverage': float},
+}
+AUTO_OPERATIONS = tuple(AUTO_PARAM_TYPES)
+
+# White balance gains are kept within this range
+MAX_WHITE_BALANCE_GAIN = 2.0
+
+
+def make_proxy(img):
+    """A copy of a Pillow image scaled down to at most STATS_SIZE (RGB or RGBA)"""
+    mode = 'RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB'
+    proxy = img.convert(mode) if img.mode != mode else img.copy()
+    proxy.thumbnail((STATS_SIZE, STATS_SIZE), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return proxy
+
+
+def compute_stats(img, size=None):
+    """Statistics of a Pillow image (or its proxy). size: of the full image, if img is a proxy."""
+    proxy = make_proxy(img)
+    size = size or img.size
+    width, height = proxy.size
+    # Transparent pixels do not count
+    mask = proxy.getchannel('A').point(lambda alpha: 255 if alpha else 0) if proxy.mode == 'RGBA' else None
+    colour = proxy.convert('RGB')
+    luma = proxy.convert('L')
+    histogram = colour.histogram(mask)
+
+    cols = max(1, round(width / GRID_CELL))
+    rows = max(1, round(height / GRID_CELL))
+    entropy = [
+        [round(luma.crop(_cell_box(col, row, cols, rows, width, height)).entropy(), 3) for col in range(cols)]
+        for row in range(rows)
+    ]
+
+    # Kernel filters leave the border pixels as they are, so they are cleared
+    edges = luma.filter(ImageFilter.FIND_EDGES)
+    if width > 2 and height > 2:
+        edges = ImageOps.expand(edges.crop((1, 1, width - 1, height - 1)), 1, 0)
+    edge_cells = list(edges.resize((cols, rows), Image.Resampling.BOX).getdata())
+
+    return {
+        'version': STATS_VERSION,
+        'width': size[0],
+        'height': size[1],
+        'grid': [cols, rows],
+        'histogram': {
+            'red': histogram[0:256],
+            'green': histogram[256:512],
+            'blue': histogram[512:768],
+            'luma': luma.histogram(mask)
+        },
+        'entropy': entropy,
+        'edges': [[round(value / 255, 4) for value in edge_cells[row * cols:(row + 1) * cols]] for row in range(rows)]
+    }
+
+
+def _cell_box(col, row, cols, rows, width, height):
+    return (col * width // cols, row * height // rows, (col + 1) * width // cols, (row + 1) * height // rows)
+
+
+def saliency_map(stats):
+    """Edge density weighted by entropy per grid cell: high where there is detail"""
+    return [
+        [edge * entropy / 8 for edge, entropy in zip(edge_row, entropy_row)]
+        for edge_row, entropy_row in zip(stats['edges'], stats['entropy'])
+    ]
+
+
+# ==================== AUTOMATIC OPERATIONS ====================
+
+def _clip_bounds(histogram, clip):
+    """Darkest and brightest value after ignoring clip percent of the pixels at each end"""
+    total = sum(histogram)
+    if not total:
+        return 0, 255
+    cut = total * clip / 100
+    low, count = 0, 0
+    for value, pixels in enumerate(histogram):
+        count += pixels
+        if count > cut:
+            low = value
+            break
+    high, count = 255, 0
+    for value in range(255, -1, -1):
+        count += histogram[value]
+        if count > cut:
+            high = value
+            break
+    return (low, high) if low < high else (0, 255)
+
+
+def _mean(histogram):
+    total = sum(histogram)
+    return sum(value * pixels for value, pixels in enumerate(histogram)) / total if total else 127.5
+
+
+def auto_levels(stats, clip=0.5):
+    """Stretches every channel to the full range (also removes colour casts in the shadows and highlights)"""
+    bounds = [_clip_bounds(stats['histogram'][band], clip) for band in ('red', 'green', 'blue')]
+    return 'levels', {'black': [low for low, _ in bounds], 'white': [high for _, high in bounds]}
+
+
+def auto_contrast(stats, clip=0.5):
+    """Stretches the luminance to the full range, the same for all channels (colours stay as they are)"""
+    low, high = _clip_bounds(stats['histogram']['luma'], clip)
+    return 'levels', {'black': [low] * 3, 'white': [high] * 3}
+
+
+def auto_white_balance(stats, strength=1.0):
+    """Gray world: scales the channels so that their averages match"""
+    means = [_mean(stats['histogram'][band]) for band in ('red', 'green', 'blue')]
+    gray = sum(means) / 3
+    white = []
+    for mean in means:
+        gain = gray / mean if mean else 1.0
+        gain = min(MAX_WHITE_BALANCE_GAIN, max(1 / MAX_WHITE_BALANCE_GAIN, gain))
+        gain = 1 + (gain - 1) * strength
+        white.append(round(255 / gain, 2))
+    return 'levels', {'black': [0, 0, 0], 'white': white}
+
+
+def _mass_range(weights, coverage):
+    """First and last index of the smallest centred range holding coverage of the weights"""
+    total = sum(weights)
+    cut = total * (1 - coverage) / 2
+    start, count = 0, 0
+    for index, weight in enumerate(weights):
+        count += weight
+        if count > cut:
+            start = index
+            break
+    end, count = len(weights) - 1, 0
+    for index in range(len(weights) - 1, -1, -1):
+        count += weights[index]
+        if count > cut:
+            end = index
+            break
+    return start, max(start, end)
+
+
+def auto_crop(stats, aspect=None, padding=0.05, coverage=0.9):
+    """Crops to the detailed part of the image (the subject), optionally to an aspect ratio (width / height)"""
+    width, height = stats['width'], stats['height']
+    cols, rows = stats['grid']
+    saliency = saliency_map(stats)
+
+    # Uniform detail (the background) does not count
+    values = sorted(value for row in saliency for value in row)
+    median = values[len(values) // 2]
+    weights = [[max(0.0, value - median) for value in row] for row in saliency]
+    if not any(any(row) for row in weights):
+        left, top, right, bottom = 0.0, 0.0, 1.0, 1.0
+    else:
+        col_start, col_end = _mass_range([sum(row[col] for row in weights) for col in range(cols)], coverage)
+        row_start, row_end = _mass_range([sum(row) for row in weights], coverage)
+        left, right = col_start / cols, (col_end + 1) / cols
+        top, bottom = row_start / rows, (row_end + 1) / rows
+        pad_x, pad_y = (right - left) * padding, (bottom - top) * padding
+        left, right = max(0.0, left - pad_x), min(1.0, right + pad_x)
+        top, bottom = max(0.0, top - pad_y), min(1.0, bottom + pad_y)
+
+    # In pixels of the full image
+    left, right = left * width, right * width
+    top, bottom = top * height, bottom * height
+    if aspect:
+        left, top, right, bottom = _fit_aspect(left, top, right, bottom, aspect, width, height)
+
+    box = [int(round(left)), int(round(top)), int(round(right)), int(round(bottom))]
+    box[2] = max(box[2], box[0] + 1)
+    box[3] = max(box[3], box[1] + 1)
+    return 'crop', dict(zip(('left', 'top', 'right', 'bottom'), box))
+
+
+def _fit_aspect(left, top, right, bottom, aspect, width, height):
+    """Grows the box around its centre to width/height = aspect, shrinking it where the image ends"""
+    box_width, box_height = right - left, bottom - top
+    if box_width / box_height < aspect:
+        box_width = box_height * aspect
+    else:
+        box_height = box_width / aspect
+    if box_width > width:
+        box_width, box_height = width, width / aspect
+    if box_height > height:
+        box_width, box_height = height * aspect, height
+
+    centre_x, centre_y = (left + right) / 2, (top + bottom) / 2
+    left = min(max(0.0, centre_x - box_width / 2), width - box_width)
+    top = min(max(0.0, centre_y - box_height / 2), height - box_height)
+    return left, top, left + box_width, top + box_height
+
+
+_RESOLVERS = {
+    'auto_levels': auto_levels,
+    'auto_contrast': auto_contrast,
+    'auto_white_balance': auto_white_balance,
+    'auto_crop': auto_crop,
+}
+
+
+def resolve_auto_operation(operation, params, stats):
+    """Turns an automatic operation into the plain one it stands for. Returns (operation, params)."""
+    params = params or {}
+    types = AUTO_PARAM_TYPES[operation]
+    arguments = {name: types[name](params[name]) for name in types if params.get(name) is not None}
+    return _RESOLVERS[operation](stats, **arguments)
@@ -0,0 +1,57 @@
+"""
+Bildwerkzeug - Test setup
+
+The modules are imported from the repository root. The Flask app is
+imported once per test run from a temporary folder, so its uploads and
+database do not touch the working copy.
+"""
+
+import base64
+import io
+import os
+import random
+import sys
+
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def png_bytes(width=64, height=48, color=(200, 30, 30), noise_seed=None):
+    """PNG of a flat colour, or of random pixels (which hardly compress) with noise_seed"""
+    if noise_seed is None:
+        img = Image.new('RGB', (width, height), color)
+    else:
+        size = width * height * 3
+        pixels = random.Random(noise_seed).getrandbits(size * 8).to_bytes(size, 'little')
+        img = Image.frombytes('RGB', (width, height), pixels)
+    buf = io.BytesIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def data_url(data):
+    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """The app module, run without login from a temporary folder"""
+    folder = tmp_path_factory.mktemp('app')
+    previous = os.getcwd()
+    os.environ['LOGIN_REQUIRED'] = 'false'
+    os.environ['DATABASE_URL'] = f'sqlite:///{folder / "bildwerkzeug.db"}'
+    os.chdir(folder)
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(previous)
+
+
+@pytest.fixture
+def client(app_module):
+    """Test client with its own anonymous session (and so its own workspace)"""
+    return app_module.app.test_client()
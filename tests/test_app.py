@@ -0,0 +1,87 @@
+import pytest
+
+from conftest import data_url, png_bytes
+
+
+def upload(client, name, data=None):
+    response = client.post('/api/images', json={'image': data_url(data or png_bytes()), 'filename': name})
+    return response
+
+
+def listing(client):
+    response = client.get('/api/images')
+    assert response.status_code == 200
+    return response.json
+
+
+def test_listing_version_advances_only_on_changes(client):
+    first = upload(client, 'a.png').json['image']['id']
+    version = listing(client)['version']
+
+    response = client.get('/api/images', headers={'If-None-Match': f'"{version}"'})
+    assert response.status_code == 304
+
+    second = upload(client, 'b.png').json['image']['id']
+    changes = client.get(f'/api/images/changes?since={version}').json
+    assert changes['version'] > version and not changes['reset']
+    assert [image['id'] for image in changes['changed']] == [second]
+    assert first not in [image['id'] for image in changes['changed']]
+    assert client.get('/api/images', headers={'If-None-Match': f'"{version}"'}).status_code == 200
+
+
+def test_deleted_images_are_listed_as_tombstones(client):
+    ids = [upload(client, f'{index}.png').json['image']['id'] for index in range(3)]
+    version = listing(client)['version']
+
+    assert client.delete(f'/api/images/{ids[1]}').status_code == 200
+    changes = client.get(f'/api/images/changes?since={version}').json
+    assert changes['deleted'] == [ids[1]]
+    assert changes['changed'] == [] and not changes['reset']
+    assert ids[1] not in [image['id'] for image in listing(client)['images']]
+
+    # Versions from before the known tombstones (or from the future) get the whole list
+    assert client.get(f'/api/images/changes?since={version - 1000}').json['reset']
+    assert client.get(f"/api/images/changes?since={changes['version'] + 1}").json['reset']
+
+
+def test_only_the_last_tombstones_are_kept(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MAX_TOMBSTONES', 2)
+    previous = {'images': [{'id': str(index)} for index in range(4)], 'current_id': None}
+    app_module.stamp_listing_version({}, previous)
+    start = previous['version']
+
+    for removed in range(3):
+        metadata = {'images': [image for image in previous['images'] if image['id'] != str(removed)],
+                    'current_id': None}
+        app_module.stamp_listing_version(previous, metadata)
+        previous = metadata
+
+    assert previous['version'] == start + 3
+    assert [entry['id'] for entry in previous['deleted']] == ['1', '2']
+    # A client at start + 1 missed the forgotten deletion of '0'
+    assert previous['tombstones_from'] == start + 1
+
+
+def test_upload_over_quota_is_refused(client, app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'USER_QUOTA_MB', 1)
+    assert upload(client, 'small.png').status_code == 200
+
+    response = upload(client, 'noise.png', png_bytes(700, 700, noise_seed=1))
+    assert response.status_code == 413
+    assert response.json['error'] == 'Storage quota exceeded'
+    assert len(listing(client)['images']) == 1
+
+
+def test_edit_over_quota_is_refused_and_keeps_the_image(client, app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'USER_QUOTA_MB', 1)
+    image_id = upload(client, 'small.png').json['image']['id']
+
+    response = client.put(f'/api/images/{image_id}', json={'image': data_url(png_bytes(500, 500, noise_seed=2))})
+    assert response.status_code == 413
+    assert client.get(f'/api/images/{image_id}').status_code == 200
+    assert client.get(f'/api/images/{image_id}/history').json['history']['steps'] == []
+
+
+@pytest.mark.parametrize('since', ['', 'abc'])
+def test_changes_need_a_version(client, since):
+    assert client.get(f'/api/images/changes?since={since}').status_code == 400
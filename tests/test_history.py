@@ -0,0 +1,116 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import history
+from conftest import png_bytes
+from imaging import apply_operation_to_image
+
+OPERATIONS = [
+    ('rotate', {'angle': 90}),
+    ('brightness', {'factor': 1.2}),
+    ('flip_horizontal', {}),
+    ('brightness', {'factor': 0.8}),
+    ('rotate', {'angle': 90}),
+    ('flip_vertical', {}),
+    ('contrast', {'factor': 1.3}),
+]
+
+
+@pytest.fixture
+def original():
+    return Image.open(io.BytesIO(png_bytes(9, 6, noise_seed=2))).convert('RGB')
+
+
+def edit(history_dir, img, max_steps=50, keyframe_interval=3, max_bytes=50 * 1024 * 1024):
+    """Applies OPERATIONS one by one and records them. Returns the image after every step (the original first)."""
+    results = [img]
+    for operation, params in OPERATIONS:
+        img = apply_operation_to_image(img, operation, params)
+        step = history.prepare(history_dir, img, history.operation_step(operation, params), max_steps,
+                               keyframe_interval)
+        history.record(history_dir, step, max_steps, max_bytes)
+        results.append(img)
+    return results
+
+
+def keyframe_files(history_dir):
+    return sorted(name for name in os.listdir(history_dir) if name.endswith('.png'))
+
+
+def test_restore_replays_from_the_nearest_keyframe(tmp_path, original):
+    results = edit(str(tmp_path), original)
+    saved = history.load(str(tmp_path))
+
+    assert saved['position'] == len(OPERATIONS)
+    assert [step['keyframe'] is not None for step in saved['steps']] == [False, False, True] * 2 + [False]
+    for position, expected in enumerate(results):
+        img = history.restore(str(tmp_path), saved, position, lambda: original)
+        assert img.tobytes() == expected.tobytes()
+
+
+def test_trim_makes_the_first_kept_keyframe_the_base(tmp_path, original):
+    results = edit(str(tmp_path), original, max_steps=4, keyframe_interval=2)
+    saved = history.load(str(tmp_path))
+
+    assert len(saved['steps']) <= 4
+    assert saved['base'] is not None
+    assert saved['position'] == len(saved['steps'])
+    # Only the base and the keyframes of the kept steps stay on disk
+    kept = [step['keyframe'] for step in saved['steps'] if step['keyframe']]
+    assert keyframe_files(str(tmp_path)) == sorted(kept + [saved['base']])
+
+    first = len(results) - 1 - len(saved['steps'])
+    for position in range(len(saved['steps']) + 1):
+        img = history.restore(str(tmp_path), saved, position, lambda: pytest.fail('original loaded'))
+        assert img.tobytes() == results[first + position].tobytes()
+
+
+def test_trim_by_bytes_frees_the_dropped_keyframes(tmp_path, original):
+    results = edit(str(tmp_path), original, keyframe_interval=1, max_bytes=1)
+    saved = history.load(str(tmp_path))
+
+    # Over budget with every step a keyframe: only the current image is kept, as the base
+    assert saved['steps'] == [] and saved['position'] == 0
+    assert keyframe_files(str(tmp_path)) == [saved['base']]
+    img = history.restore(str(tmp_path), saved, 0, lambda: pytest.fail('original loaded'))
+    assert img.tobytes() == results[-1].tobytes()
+
+
+def test_undo_and_redo_move_between_steps(tmp_path, original):
+    results = edit(str(tmp_path), original)
+
+    img, saved = history.move(str(tmp_path), -2, lambda: original)
+    assert saved['position'] == len(OPERATIONS) - 2
+    assert img.tobytes() == results[-3].tobytes()
+    img, saved = history.move(str(tmp_path), 1, lambda: original)
+    assert img.tobytes() == results[-2].tobytes()
+    with pytest.raises(history.HistoryError):
+        history.move(str(tmp_path), 2, lambda: original)
+
+
+def test_recording_after_undo_drops_the_steps_to_redo(tmp_path, original):
+    edit(str(tmp_path), original)
+    history.move(str(tmp_path), -4, lambda: original)
+
+    step = history.prepare(str(tmp_path), original, history.pixels_step(), 50, 3)
+    delta = history.record(str(tmp_path), step, 50, 50 * 1024 * 1024)
+    saved = history.load(str(tmp_path))
+
+    assert len(saved['steps']) == len(OPERATIONS) - 4 + 1
+    assert saved['position'] == len(saved['steps'])
+    # The pixels step got a keyframe, the keyframe of step 6 was removed
+    assert delta < step['bytes']
+    kept = [step['keyframe'] for step in saved['steps'] if step['keyframe']]
+    assert keyframe_files(str(tmp_path)) == sorted(kept)
+
+
+def test_discard_removes_the_keyframe_of_a_prepared_step(tmp_path, original):
+    step = history.prepare(str(tmp_path), original, history.pixels_step(), 50, 3)
+    assert step['bytes'] > 0 and keyframe_files(str(tmp_path)) == [step['keyframe']]
+
+    history.discard(str(tmp_path), step)
+    assert keyframe_files(str(tmp_path)) == []
+    assert history.load(str(tmp_path))['steps'] == []
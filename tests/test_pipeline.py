@@ -0,0 +1,76 @@
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import png_bytes
+from imaging import apply_operation_to_image
+from pipeline import POINT, TRANSPOSE, PipelineError, compile_operations, parse_operations, run_pipeline
+
+
+def noise_image(width=7, height=5):
+    return Image.open(io.BytesIO(png_bytes(width, height, noise_seed=1))).convert('RGB')
+
+
+def one_by_one(img, operations):
+    for entry in operations:
+        img = apply_operation_to_image(img, entry['operation'], entry.get('params', {}))
+    return img
+
+
+@pytest.mark.parametrize('operations', [
+    [{'operation': 'brightness', 'params': {'factor': 1.3}},
+     {'operation': 'brightness', 'params': {'factor': 0.6}},
+     {'operation': 'brightness', 'params': {'factor': 1.1}}],
+    [{'operation': 'rotate', 'params': {'angle': 90}},
+     {'operation': 'flip_horizontal'},
+     {'operation': 'rotate', 'params': {'angle': 180}},
+     {'operation': 'flip_vertical'}],
+    [{'operation': 'rotate', 'params': {'angle': 270}},
+     {'operation': 'brightness', 'params': {'factor': 1.2}},
+     {'operation': 'rotate', 'params': {'angle': 90}},
+     {'operation': 'contrast', 'params': {'factor': 1.0}},
+     {'operation': 'flip_horizontal'}],
+    [{'operation': 'flip_horizontal'}, {'operation': 'flip_horizontal'},
+     {'operation': 'grayscale'}],
+])
+def test_fused_steps_match_the_operations_one_by_one(operations):
+    img = noise_image()
+    fused = run_pipeline(img, compile_operations(operations))
+    expected = one_by_one(img, operations)
+    assert fused.size == expected.size
+    assert fused.tobytes() == expected.tobytes()
+
+
+def test_fusion_merges_neighbours_and_drops_no_ops():
+    steps = compile_operations([
+        {'operation': 'brightness', 'params': {'factor': 1.5}},
+        {'operation': 'brightness', 'params': {'factor': 2}},
+        {'operation': 'rotate', 'params': {'angle': 90}},
+        {'operation': 'rotate', 'params': {'angle': 270}},
+        {'operation': 'sharpen', 'params': {'factor': 1.0}},
+        {'operation': 'resize_percent', 'params': {'percent': 50}},
+        {'operation': 'resize_percent', 'params': {'percent': 50}},
+    ])
+    assert [step.operation for step in steps] == [POINT, 'resize_percent']
+    assert steps[0].params['factor'] == 3.0
+    assert steps[1].params['percent'] == 25.0
+    assert TRANSPOSE not in [step.operation for step in steps]
+
+
+def test_fused_resizes_give_the_size_of_the_resizes_one_by_one():
+    operations = [{'operation': 'resize_percent', 'params': {'percent': 50}},
+                  {'operation': 'resize_percent', 'params': {'percent': 50}}]
+    img = noise_image(40, 24)
+    assert run_pipeline(img, compile_operations(operations)).size == one_by_one(img, operations).size
+
+
+@pytest.mark.parametrize('operations', [
+    [],
+    [{'operation': 'unknown'}],
+    [{'operation': 'blur', 'params': {'radius': 'wide'}}],
+    [{'operation': 'crop', 'params': {'left': -1, 'top': 0, 'right': 5, 'bottom': 5}}],
+])
+def test_invalid_operations_are_rejected(operations):
+    with pytest.raises(PipelineError):
+        parse_operations(operations)
@@ -0,0 +1,103 @@
+import base64
+import hashlib
+import io
+
+import pytest
+
+import resumable
+from resumable import UploadError
+
+DATA = bytes(range(256)) * 40
+
+
+class FailingStream:
+    """Yields some bytes, then fails like a dropped connection"""
+
+    def __init__(self, data):
+        self.chunks = [data]
+
+    def read(self, size):
+        if self.chunks:
+            return self.chunks.pop()
+        raise OSError('connection reset')
+
+
+@pytest.fixture
+def upload(tmp_path):
+    return resumable.create_upload(str(tmp_path), 'photo.png', len(DATA), hashlib.sha256(DATA).hexdigest())
+
+
+def offset_of(folder, upload):
+    return resumable.load_upload(folder, upload['id'])['offset']
+
+
+def test_chunks_are_appended_at_the_offset(tmp_path, upload):
+    folder = str(tmp_path)
+    assert upload['offset'] == 0
+
+    offset = resumable.append_chunk(folder, upload['id'], 0, io.BytesIO(DATA[:1000]))
+    assert offset == 1000 == offset_of(folder, upload)
+    offset = resumable.append_chunk(folder, upload['id'], offset, io.BytesIO(DATA[1000:]))
+    assert offset == len(DATA)
+
+    path, state = resumable.finish_upload(folder, upload['id'])
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert state['sha256_actual'] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_wrong_offset_is_refused(tmp_path, upload):
+    folder = str(tmp_path)
+    resumable.append_chunk(folder, upload['id'], 0, io.BytesIO(DATA[:100]))
+
+    with pytest.raises(UploadError) as error:
+        resumable.append_chunk(folder, upload['id'], 50, io.BytesIO(DATA[50:100]))
+    assert error.value.status == 409
+    assert offset_of(folder, upload) == 100
+
+
+def test_chunk_checksum_mismatch_truncates_to_the_last_good_offset(tmp_path, upload):
+    folder = str(tmp_path)
+    resumable.append_chunk(folder, upload['id'], 0, io.BytesIO(DATA[:100]),
+                           checksum=hashlib.sha256(DATA[:100]).digest())
+
+    wrong = resumable.parse_checksum('sha256 ' + base64.b64encode(hashlib.sha256(b'other').digest()).decode())
+    with pytest.raises(UploadError) as error:
+        resumable.append_chunk(folder, upload['id'], 100, io.BytesIO(DATA[100:200]), checksum=wrong)
+    assert error.value.status == 460
+    assert offset_of(folder, upload) == 100
+
+
+def test_failed_stream_and_oversized_chunk_are_truncated(tmp_path, upload):
+    folder = str(tmp_path)
+    with pytest.raises(OSError):
+        resumable.append_chunk(folder, upload['id'], 0, FailingStream(DATA[:300]))
+    assert offset_of(folder, upload) == 0
+
+    with pytest.raises(UploadError) as error:
+        resumable.append_chunk(folder, upload['id'], 0, io.BytesIO(DATA + b'extra'))
+    assert error.value.status == 413
+    assert offset_of(folder, upload) == 0
+
+
+def test_finish_checks_completeness_and_the_whole_file(tmp_path, upload):
+    folder = str(tmp_path)
+    resumable.append_chunk(folder, upload['id'], 0, io.BytesIO(DATA[:10]))
+    with pytest.raises(UploadError) as error:
+        resumable.finish_upload(folder, upload['id'])
+    assert error.value.status == 409
+
+    resumable.append_chunk(folder, upload['id'], 10, io.BytesIO(DATA[10:]))
+    with pytest.raises(UploadError) as error:
+        resumable.finish_upload(folder, upload['id'], sha256=hashlib.sha256(b'other').hexdigest())
+    assert error.value.status == 460
+
+
+def test_invalid_checksum_headers_and_ids(tmp_path):
+    assert resumable.parse_checksum(None) is None
+    for header in ('md5 abc', 'sha256 not-base64!'):
+        with pytest.raises(UploadError):
+            resumable.parse_checksum(header)
+    with pytest.raises(UploadError) as error:
+        resumable.append_chunk(str(tmp_path), '../escape', 0, io.BytesIO(b''))
+    assert error.value.status == 404
@@ -0,0 +1,48 @@
+import pytest
+
+import sharding
+from sharding import HashRing, ShardError
+
+USERS = [str(user_id) for user_id in range(2000)] + [f'anon_{index:04x}' for index in range(1000)]
+
+
+def assignments(ring):
+    return {user: ring.node_for(user) for user in USERS}
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = assignments(HashRing(['a', 'b', 'c']))
+    after = assignments(HashRing(['a', 'b', 'c', 'd']))
+
+    moved = [user for user in USERS if before[user] != after[user]]
+    assert all(after[user] == 'd' for user in moved)
+    # About a quarter of the keys belong to the new node
+    assert 0.15 < len(moved) / len(USERS) < 0.35
+
+
+def test_removing_a_node_only_moves_its_keys():
+    before = assignments(HashRing(['a', 'b', 'c', 'd']))
+    after = assignments(HashRing(['a', 'b', 'c']))
+
+    assert all(before[user] == 'd' for user in USERS if before[user] != after[user])
+
+
+def test_assignment_does_not_depend_on_node_order():
+    assert assignments(HashRing(['c', 'a', 'b'])) == assignments(HashRing(['a', 'b', 'c']))
+
+
+def test_keys_are_spread_over_all_nodes():
+    counts = {}
+    for node in assignments(HashRing(['a', 'b', 'c'])).values():
+        counts[node] = counts.get(node, 0) + 1
+    assert set(counts) == {'a', 'b', 'c'}
+    assert min(counts.values()) > len(USERS) / 3 * 0.7
+
+
+def test_parse_nodes():
+    assert sharding.parse_nodes(' a=http://one/ , b=http://two ') == {'a': 'http://one', 'b': 'http://two'}
+    assert sharding.parse_nodes('') == {}
+    with pytest.raises(ShardError):
+        sharding.parse_nodes('a')
+    with pytest.raises(ShardError):
+        HashRing({})
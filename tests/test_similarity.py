@@ -0,0 +1,45 @@
+import io
+import random
+
+import pytest
+from PIL import Image
+
+from conftest import png_bytes
+from similarity import BKTree, dhash, hamming
+
+
+@pytest.fixture
+def hashes():
+    rnd = random.Random(3)
+    values = [rnd.getrandbits(64) for _ in range(300)]
+    # Near-duplicates: a few flipped bits, and one exact duplicate
+    values += [value ^ (1 << rnd.randrange(64)) ^ (1 << rnd.randrange(64)) for value in values[:50]]
+    values.append(values[0])
+    return values
+
+
+@pytest.mark.parametrize('max_distance', [0, 2, 5, 12, 64])
+def test_search_finds_what_brute_force_finds(hashes, max_distance):
+    tree = BKTree()
+    for index, value in enumerate(hashes):
+        tree.add(value, index)
+    assert len(tree) == len(hashes)
+
+    for query in hashes[:20] + [random.Random(4).getrandbits(64)]:
+        expected = sorted((hamming(query, value), index) for index, value in enumerate(hashes)
+                          if hamming(query, value) <= max_distance)
+        found = tree.search(query, max_distance)
+        assert sorted(found) == expected
+        assert [distance for distance, _ in found] == sorted(distance for distance, _ in found)
+
+
+def test_empty_tree_finds_nothing():
+    assert BKTree().search(0, 64) == []
+
+
+def test_dhash_of_resized_copy_is_close():
+    img = Image.open(io.BytesIO(png_bytes(12, 8, noise_seed=5))).resize((300, 200), Image.Resampling.BILINEAR)
+    original = int(dhash(img), 16)
+    assert len(dhash(img)) == 16
+    assert hamming(original, int(dhash(img.resize((150, 100))), 16)) <= 4
+    assert hamming(original, int(dhash(img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)), 16)) > 10
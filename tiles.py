@@ -0,0 +1,160 @@
+"""
+Bildwerkzeug - Tile pyramids for zoomable viewing of large images
+
+DeepZoom-style layout: level max_level is the full image, every level below
+halves the size, level 0 is a single pixel. Levels are cut into tiles lazily
+on first request: the requested level is reduced from the full image once
+and every smaller level that is still missing is derived from it. A file
+lock per pyramid lets only one worker of a host build it; the others wait
+and then serve the finished levels.
+"""
+
+import contextlib
+import math
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are kept apart
+    fcntl = None
+
+from imaging import open_image, pillow_image
+
+
+TILE_SIZE = 256
+TILE_QUALITY = 85
+
+_DONE_MARKER = '.done'
+_LOCK_FILE = '.lock'
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def max_level(width, height):
+    """Level of the full-size image"""
+    return math.ceil(math.log2(max(width, height, 1)))
+
+
+def level_size(width, height, level):
+    """Size of the image at a level"""
+    factor = 2 ** (max_level(width, height) - level)
+    return math.ceil(width / factor), math.ceil(height / factor)
+
+
+def tile_format_for(mode):
+    """PNG for images with transparency, JPEG otherwise"""
+    return 'png' if mode in ('RGBA', 'LA', 'PA', 'P') else 'jpeg'
+
+
+def describe(width, height, tile_format):
+    """Description of a pyramid for the viewer"""
+    return {
+        'width': width,
+        'height': height,
+        'tile_size': TILE_SIZE,
+        'overlap': 0,
+        'format': tile_format,
+        'max_level': max_level(width, height)
+    }
+
+
+def estimate_bytes(source_bytes, top_level, level):
+    """Rough size of a level and all smaller ones, from the size of the encoded full image"""
+    return int(source_bytes / 4 ** (top_level - level) * 4 / 3)
+
+
+def tile_path(tiles_dir, level, col, row, tile_format):
+    return os.path.join(tiles_dir, str(level), f'{col}_{row}.{tile_format}')
+
+
+def _lock_for(tiles_dir):
+    with _locks_lock:
+        if len(_locks) > 1000:
+            _locks.clear()
+        return _locks.setdefault(tiles_dir, threading.Lock())
+
+
+@contextlib.contextmanager
+def _building(tiles_dir):
+    """Holds the pyramid for this thread and, with a blocking file lock, for this process"""
+    with _lock_for(tiles_dir):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(tiles_dir, exist_ok=True)
+        with open(os.path.join(tiles_dir, _LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _write_level(level_img, level_dir, tile_format):
+    """Cuts one level into tiles. Returns the bytes written."""
+    os.makedirs(level_dir, exist_ok=True)
+    written = 0
+    for top in range(0, level_img.height, TILE_SIZE):
+        for left in range(0, level_img.width, TILE_SIZE):
+            tile = level_img.crop((left, top, min(left + TILE_SIZE, level_img.width),
+                                   min(top + TILE_SIZE, level_img.height)))
+            path = os.path.join(level_dir, f'{left // TILE_SIZE}_{top // TILE_SIZE}.{tile_format}')
+            # Written next to it and moved into place, so a tile is never seen half-written
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            if tile_format == 'jpeg':
+                tile.save(tmp_path, 'JPEG', quality=TILE_QUALITY)
+            else:
+                tile.save(tmp_path, 'PNG', compress_level=1)
+            written += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+
+    # Marks the level as complete; tiles are only served from complete levels
+    open(os.path.join(level_dir, _DONE_MARKER), 'w').close()
+    return written
+
+
+def level_ready(tiles_dir, level):
+    return os.path.exists(os.path.join(tiles_dir, str(level), _DONE_MARKER))
+
+
+def ensure_level(source_path, tiles_dir, level, tile_format):
+    """Generates a level and all missing smaller ones.
+    Returns the bytes written by this call (0 if another worker built the level)."""
+    with _building(tiles_dir):
+        if level_ready(tiles_dir, level):
+            return 0
+
+        img = pillow_image(open_image(source_path))
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if tile_format == 'png' else 'RGB')
+
+        top_level = max_level(img.width, img.height)
+        factor = 2 ** (top_level - level)
+        level_img = img.reduce(factor) if factor > 1 else img
+
+        written = 0
+        while True:
+            if not level_ready(tiles_dir, level):
+                written += _write_level(level_img, os.path.join(tiles_dir, str(level)), tile_format)
+            if level == 0:
+                break
+            level -= 1
+            level_img = level_img.reduce(2)
+        return written
+
+
+def remove_tiles(tiles_root):
+    """Deletes all pyramids below tiles_root. Returns the bytes freed."""
+    if not os.path.isdir(tiles_root):
+        return 0
+    freed = 0
+    for folder, _, files in os.walk(tiles_root):
+        for name in files:
+            try:
+                freed += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    shutil.rmtree(tiles_root, ignore_errors=True)
+    return freed